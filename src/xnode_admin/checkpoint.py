@@ -0,0 +1,55 @@
+import json
+import logging
+import os
+import time
+
+from xnode_admin.config_cache import atomic_write
+
+log = logging.getLogger(__name__)
+
+DEFAULT_STATE = {
+    "configHash": None, # Config hash and system path of the last successful switch.
+    "systemPath": None,
+    "generation": None, # Last generation values seen from the Studio.
+    "pendingGeneration": None, # Config generation to push once its switch is confirmed, set while switching.
+    "wantsUpdate": False,
+    "status": "online", # Status of the operation in progress, "online" when idle.
+    "lastUpdateCheck": 0, # 0 until the first check, the interval then counts from when the agent first started.
+}
+
+
+class Checkpoint:
+    '''
+    The agent's state, kept in the state directory so a restart (e.g. by a switch or an update) can carry on where
+    the previous process stopped instead of rebuilding first. Written atomically, and only when something changed.
+    '''
+    def __init__(self, state_directory):
+        self.path = os.path.join(state_directory, ".xnode-agent-state.json")
+        self.state = dict(DEFAULT_STATE)
+        try:
+            with open(self.path, "r") as f:
+                stored = json.load(f)
+            self.state.update({key: stored[key] for key in DEFAULT_STATE if key in stored})
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            log.warning("Ignoring unreadable agent checkpoint: %s", e)
+        if not self.state["lastUpdateCheck"]:
+            # First start, or a checkpoint from before checks were recorded: wait a full interval from now, so a fresh
+            # or upgraded fleet doesn't run all its update checks at once. Saved with the next update.
+            self.state["lastUpdateCheck"] = time.time()
+
+    def get(self, key):
+        return self.state[key]
+
+    def update(self, **fields):
+        changed = {key: value for key, value in fields.items() if self.state.get(key) != value}
+        if len(changed) == 0:
+            return
+        self.state.update(changed)
+        self.state["savedAt"] = time.time()
+        atomic_write(self.path, json.dumps(self.state, indent=2))
+
+    def system_matches(self, config_hash, system_path):
+        # True if the last switch this checkpoint saw is what's running, with the config that's in the state directory.
+        return self.state["configHash"] == config_hash and self.state["systemPath"] == system_path
@@ -0,0 +1,149 @@
+import asyncio
+import logging
+import os
+import re
+import time
+
+from xnode_admin import exporter
+
+log = logging.getLogger(__name__)
+
+
+class CommandRunner:
+    '''
+    Runs commands as child processes without blocking the event loop. Every nix invocation goes through the current
+    runner (see set_runner), so a ScriptedRunner can stand in for nix on machines that don't have it.
+    '''
+    async def run(self, args, capture=True, cwd=None):
+        # Returns (returncode, stdout, stderr), the output is None when not captured.
+        if capture:
+            process = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, cwd=cwd)
+        else:
+            process = await asyncio.create_subprocess_exec(*args, cwd=cwd)
+        stdout, stderr = await process.communicate()
+        return process.returncode, stdout, stderr
+
+    async def stream(self, args, on_line, cwd=None):
+        # Hands each line of the combined output to on_line as soon as it's printed, returns the exit code.
+        process = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, limit=1024 * 1024, cwd=cwd)
+        while True:
+            try:
+                line = await process.stdout.readline()
+            except ValueError:
+                # Line longer than the stream limit, take what's buffered and carry on.
+                line = await process.stdout.read(1024 * 1024)
+            if not line:
+                break
+            await on_line(line.decode('utf-8', errors='replace'))
+        return await process.wait()
+
+
+class ScriptedCommand:
+    '''
+    How a ScriptedRunner answers the commands matching pattern (a regex searched in the space separated arguments):
+    after delay seconds it prints output line by line, line_delay seconds apart, then stderr, and exits with returncode.
+    action, if set, is called with the arguments and working directory first, e.g. to create files the command would.
+    '''
+    def __init__(self, pattern, returncode=0, output=(), stderr="", delay=0, line_delay=0, action=None):
+        self.pattern = re.compile(pattern)
+        self.returncode = returncode
+        self.output = list(output)
+        self.stderr = stderr
+        self.delay = delay
+        self.line_delay = line_delay
+        self.action = action
+
+
+class ScriptedRunner(CommandRunner):
+    # Answers commands from a list of ScriptedCommands (the first match wins) instead of running them.
+    def __init__(self, commands=()):
+        self.commands = list(commands)
+        self.calls = [] # (args, cwd) of every command, in order.
+
+    def lookup(self, args):
+        command_line = " ".join(args)
+        for command in self.commands:
+            if command.pattern.search(command_line):
+                return command
+        return None
+
+    async def answer(self, args, cwd, on_line=None):
+        self.calls.append((list(args), cwd))
+        command = self.lookup(args)
+        if command == None:
+            log.warning('No scripted answer for %s', " ".join(args))
+            return 127, [], "command not found\n"
+        if command.action != None:
+            command.action(args, cwd)
+        await asyncio.sleep(command.delay)
+        for line in command.output:
+            await asyncio.sleep(command.line_delay)
+            if on_line != None:
+                await on_line(line if line.endswith("\n") else line + "\n")
+        return command.returncode, command.output, command.stderr
+
+    async def run(self, args, capture=True, cwd=None):
+        returncode, output, stderr = await self.answer(args, cwd)
+        if not capture:
+            return returncode, None, None
+        return returncode, "".join(line if line.endswith("\n") else line + "\n" for line in output).encode('utf-8'), stderr.encode('utf-8')
+
+    async def stream(self, args, on_line, cwd=None):
+        returncode, _, stderr = await self.answer(args, cwd, on_line)
+        for line in stderr.splitlines(keepends=True):
+            await on_line(line)
+        return returncode
+
+
+runner = CommandRunner()
+SUBCOMMAND = re.compile(r"^[a-z][a-z-]*$")
+
+
+def set_runner(new_runner):
+    # Replaces the runner every command goes through, returns the previous one.
+    global runner
+    previous, runner = runner, new_runner
+    return previous
+
+
+def command_name(args):
+    # Short, low cardinality name for metrics: the program without wrappers like nice, and its subcommand if any.
+    args = list(args)
+    while len(args) > 0 and (os.path.basename(args[0]) in ["nice", "ionice"] or args[0].startswith("-") or args[0].isdigit()):
+        args.pop(0)
+    if len(args) == 0:
+        return ""
+    name = os.path.basename(args[0])
+    subcommands = [arg for arg in args[1:] if SUBCOMMAND.match(arg)]
+    if len(subcommands) > 0:
+        return name + " " + subcommands[0]
+    return name
+
+
+def record(args, started, returncode):
+    seconds = time.time() - started
+    result = "error" if returncode == None else "ok" if returncode == 0 else "failed"
+    exporter.command_seconds.observe(seconds, command=command_name(args), result=result)
+    log.debug('%s exited with %s after %.2fs', command_name(args), returncode, seconds)
+
+
+async def run_command(args, capture=True, cwd=None):
+    # Runs a command without blocking the event loop, returns (returncode, stdout, stderr).
+    started = time.time()
+    returncode = None
+    try:
+        returncode, stdout, stderr = await runner.run(args, capture, cwd)
+        return returncode, stdout, stderr
+    finally:
+        record(args, started, returncode)
+
+
+async def stream_command(args, on_line, cwd=None):
+    # Runs a command and hands each line of its combined output to on_line as soon as it's printed.
+    started = time.time()
+    returncode = None
+    try:
+        returncode = await runner.stream(args, on_line, cwd)
+        return returncode
+    finally:
+        record(args, started, returncode)
@@ -0,0 +1,91 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+log = logging.getLogger(__name__)
+
+
+def atomic_write(path, content):
+    # Writes to a temporary file in the same directory and renames it over path, readers never see a partial file.
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile("w", dir=directory, prefix="." + os.path.basename(path) + ".", delete=False) as f:
+        temp_path = f.name
+        try:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        except BaseException:
+            os.remove(temp_path)
+            raise
+    os.replace(temp_path, path)
+
+
+def write_file_if_changed(path, content) -> bool:
+    # Returns True if the file had to be (re)written.
+    try:
+        with open(path, "r") as f:
+            if f.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+    atomic_write(path, content)
+    return True
+
+
+def normalize_nix(content):
+    # Whitespace-only differences don't change what nix builds.
+    lines = [line.rstrip() for line in content.strip().splitlines()]
+    return "\n".join(line for line in lines if line != "")
+
+
+def config_hash(state_directory):
+    # Hash of everything that decides which system gets built: flake.nix, config.nix and the locked inputs.
+    digest = hashlib.sha256()
+    for name in ["flake.nix", "config.nix", "flake.lock"]:
+        digest.update(name.encode("utf-8") + b"\0")
+        try:
+            with open(os.path.join(state_directory, name), "r") as f:
+                content = f.read()
+        except FileNotFoundError:
+            content = ""
+        if name.endswith(".nix"):
+            content = normalize_nix(content)
+        digest.update(content.encode("utf-8") + b"\0")
+    return digest.hexdigest()
+
+
+def current_system_path():
+    return os.path.realpath("/run/current-system")
+
+
+class SystemCache:
+    '''
+    Maps config hashes to the nix store path of the system they built, most recently used last.
+    Lets the agent skip nixos-rebuild when a new generation renders to a config that is already running.
+    '''
+    def __init__(self, state_directory, max_entries=16):
+        self.path = os.path.join(state_directory, ".xnode-system-cache.json")
+        self.max_entries = max_entries
+        self.entries = {}
+        try:
+            with open(self.path, "r") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError) as e:
+            if not isinstance(e, FileNotFoundError):
+                log.warning("Ignoring unreadable system cache: %s", e)
+
+    def lookup(self, config_hash):
+        return self.entries.get(config_hash)
+
+    def is_running(self, config_hash):
+        system_path = self.lookup(config_hash)
+        return system_path != None and system_path == current_system_path()
+
+    def record(self, config_hash, system_path):
+        self.entries.pop(config_hash, None)
+        self.entries[config_hash] = system_path
+        while len(self.entries) > self.max_entries:
+            del self.entries[next(iter(self.entries))]
+        atomic_write(self.path, json.dumps(self.entries, indent=2))
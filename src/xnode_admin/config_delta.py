@@ -0,0 +1,154 @@
+import copy
+import hashlib
+import json
+import logging
+import os
+
+from xnode_admin.config_cache import atomic_write
+
+log = logging.getLogger(__name__)
+
+
+def studio_config_hash(config):
+    # Hash of a Studio config as both sides see it: sorted keys, compact separators.
+    return hashlib.sha256(json.dumps(config, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+class ConfigStore:
+    '''
+    The last verified Studio config and its generation, kept in the state directory.
+    Its hash is sent along with getXnodeServices so the Studio can answer with a patch against it.
+    '''
+    def __init__(self, state_directory):
+        self.path = os.path.join(state_directory, "studio_config.json")
+        self.generation = None
+        self.config = None
+        self.hash = None
+        try:
+            with open(self.path, "r") as f:
+                stored = json.load(f)
+            self.generation = stored["generation"]
+            self.config = stored["config"]
+            self.hash = studio_config_hash(self.config)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            log.warning("Ignoring unreadable stored config: %s", e)
+
+    def save(self, generation, config):
+        atomic_write(self.path, json.dumps({"generation": generation, "config": config}))
+        self.generation = generation
+        self.config = config
+        self.hash = studio_config_hash(config)
+
+
+def parse_pointer(pointer):
+    # JSON pointer (RFC 6901) to a list of reference tokens.
+    if pointer == "":
+        return []
+    if not pointer.startswith("/"):
+        raise ValueError("Invalid JSON pointer: " + pointer)
+    return [token.replace("~1", "/").replace("~0", "~") for token in pointer[1:].split("/")]
+
+
+def resolve_parent(document, tokens):
+    target = document
+    for token in tokens[:-1]:
+        target = target[int(token)] if isinstance(target, list) else target[token]
+    return target
+
+
+def list_index(target, token, allow_end):
+    if token == "-" and allow_end:
+        return len(target)
+    index = int(token)
+    if index < 0 or index > len(target) or (index == len(target) and not allow_end):
+        raise IndexError("List index out of range: " + token)
+    return index
+
+
+def get_value(document, tokens):
+    if len(tokens) == 0:
+        return document
+    parent = resolve_parent(document, tokens)
+    if isinstance(parent, list):
+        return parent[list_index(parent, tokens[-1], False)]
+    return parent[tokens[-1]]
+
+
+def remove_value(document, tokens):
+    parent = resolve_parent(document, tokens)
+    if isinstance(parent, list):
+        return parent.pop(list_index(parent, tokens[-1], False))
+    return parent.pop(tokens[-1])
+
+
+def add_value(document, tokens, value):
+    if len(tokens) == 0:
+        return value
+    parent = resolve_parent(document, tokens)
+    if isinstance(parent, list):
+        parent.insert(list_index(parent, tokens[-1], True), value)
+    else:
+        parent[tokens[-1]] = value
+    return document
+
+
+def apply_patch(document, operations):
+    '''
+    Applies a JSON patch (RFC 6902: add, remove, replace, move, copy, test) to a copy of document.
+    Raises ValueError, KeyError or IndexError if the patch doesn't apply, the original is never modified.
+    '''
+    document = copy.deepcopy(document)
+    for operation in operations:
+        op = operation["op"]
+        tokens = parse_pointer(operation["path"])
+        if op == "add":
+            document = add_value(document, tokens, copy.deepcopy(operation["value"]))
+        elif op == "remove":
+            remove_value(document, tokens)
+        elif op == "replace":
+            get_value(document, tokens)
+            if len(tokens) == 0:
+                document = copy.deepcopy(operation["value"])
+            else:
+                remove_value(document, tokens)
+                document = add_value(document, tokens, copy.deepcopy(operation["value"]))
+        elif op == "move":
+            value = remove_value(document, parse_pointer(operation["from"]))
+            document = add_value(document, tokens, value)
+        elif op == "copy":
+            value = copy.deepcopy(get_value(document, parse_pointer(operation["from"])))
+            document = add_value(document, tokens, value)
+        elif op == "test":
+            if get_value(document, tokens) != operation["value"]:
+                raise ValueError("Patch test failed at " + operation["path"])
+        else:
+            raise ValueError("Unknown patch operation: " + str(op))
+    return document
+
+
+def pointer_token(key):
+    return str(key).replace("~", "~0").replace("/", "~1")
+
+
+def diff_config(old, new):
+    # A coarse patch from old to new, replacing whole top-level entries (e.g. one service). Used by the mock Studio.
+    operations = []
+    for key in old:
+        if key not in new:
+            operations.append({"op": "remove", "path": "/" + pointer_token(key)})
+    for key, value in new.items():
+        if key not in old:
+            operations.append({"op": "add", "path": "/" + pointer_token(key), "value": value})
+        elif isinstance(value, list) and isinstance(old[key], list):
+            for i in range(min(len(value), len(old[key]))):
+                if value[i] != old[key][i]:
+                    operations.append({"op": "replace", "path": "/" + pointer_token(key) + "/" + str(i), "value": value[i]})
+            for i in range(len(old[key]) - 1, len(value) - 1, -1):
+                operations.append({"op": "remove", "path": "/" + pointer_token(key) + "/" + str(i)})
+            for i in range(len(old[key]), len(value)):
+                operations.append({"op": "add", "path": "/" + pointer_token(key) + "/-", "value": value[i]})
+        elif value != old[key]:
+            operations.append({"op": "replace", "path": "/" + pointer_token(key), "value": value})
+    return operations
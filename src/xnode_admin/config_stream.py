@@ -0,0 +1,163 @@
+import binascii
+import re
+
+STRING_SPECIAL = re.compile(rb'["\\]')
+SCALAR_END = re.compile(rb'[,}\s]')
+ESCAPES = {
+    ord('"'): b'"',
+    ord('\\'): b'\\',
+    ord('/'): b'/',
+    ord('b'): b'\b',
+    ord('f'): b'\f',
+    ord('n'): b'\n',
+    ord('r'): b'\r',
+    ord('t'): b'\t',
+}
+WHITESPACE = b' \t\r\n'
+
+
+class JsonFieldReader:
+    '''
+    Incrementally reads a flat JSON object, e.g. {"message": "...", "hmac": "..."}, one chunk at a time.
+    String values are unescaped and handed to on_value(key, fragment) as UTF-8 fragments as soon as they arrive,
+    other scalars are handed over as their raw JSON text. Nothing is kept besides an incomplete escape sequence,
+    so a field can be hashed and stored without holding the raw document. Nested objects and arrays are rejected.
+    '''
+    def __init__(self, on_value):
+        self.on_value = on_value
+        self.state = "start"
+        self.key = bytearray()
+        self.current_key = None
+        self.pending = b""
+
+    def feed(self, chunk):
+        data = self.pending + bytes(chunk) if self.pending else bytes(chunk)
+        self.pending = b""
+        i, n = 0, len(data)
+        while i < n:
+            state = self.state
+
+            if state == "key" or state == "string":
+                match = STRING_SPECIAL.search(data, i)
+                end = match.start() if match else n
+                if end > i:
+                    self._emit(data[i:end])
+                if match == None:
+                    return
+                if data[end] == ord('"'):
+                    self._end_string()
+                    i = end + 1
+                    continue
+                i = self._unescape(data, end)
+                if i == None:
+                    # Escape sequence split across chunks, finish it with the next one.
+                    self.pending = data[end:]
+                    return
+                continue
+
+            if state == "scalar":
+                match = SCALAR_END.search(data, i)
+                end = match.start() if match else n
+                if end > i:
+                    self._emit(data[i:end])
+                if match == None:
+                    return
+                self.state = "comma_or_end"
+                i = end
+                continue
+
+            c = data[i]
+            i += 1
+            if c in WHITESPACE:
+                continue
+            if state == "start" and c == ord('{'):
+                self.state = "first_key"
+            elif (state == "first_key" or state == "next_key") and c == ord('"'):
+                self.key = bytearray()
+                self.state = "key"
+            elif state == "first_key" and c == ord('}'):
+                self.state = "done"
+            elif state == "colon" and c == ord(':'):
+                self.state = "value"
+            elif state == "value" and c == ord('"'):
+                self.state = "string"
+            elif state == "value" and c not in b'{[':
+                self.state = "scalar"
+                i -= 1
+            elif state == "comma_or_end" and c == ord(','):
+                self.state = "next_key"
+            elif state == "comma_or_end" and c == ord('}'):
+                self.state = "done"
+            else:
+                raise ValueError("Unexpected " + repr(chr(c)) + " in JSON document (state " + state + ")")
+
+    def close(self):
+        if self.state != "done" or self.pending:
+            raise ValueError("Incomplete JSON document")
+
+    def _emit(self, fragment):
+        if self.state == "key":
+            self.key += fragment
+        else:
+            self.on_value(self.current_key, fragment)
+
+    def _end_string(self):
+        if self.state == "key":
+            self.current_key = self.key.decode('utf-8')
+            self.state = "colon"
+        else:
+            self.state = "comma_or_end"
+
+    def _unescape(self, data, start):
+        # Decodes the escape sequence at data[start] (a backslash), returns the index after it or None if incomplete.
+        if start + 1 >= len(data):
+            return None
+        escape = data[start + 1]
+        if escape != ord('u'):
+            if escape not in ESCAPES:
+                raise ValueError("Invalid escape sequence in JSON string")
+            self._emit(ESCAPES[escape])
+            return start + 2
+
+        if start + 6 > len(data):
+            return None
+        code = int(data[start + 2:start + 6], 16)
+        end = start + 6
+        if 0xD800 <= code < 0xDC00:
+            # High surrogate, combine with the low surrogate that should follow.
+            if start + 12 > len(data):
+                return None
+            if data[start + 6:start + 8] == b'\\u':
+                low = int(data[start + 8:start + 12], 16)
+                if 0xDC00 <= low < 0xE000:
+                    code = 0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)
+                    end = start + 12
+        self._emit(chr(code).encode('utf-8', errors='surrogatepass'))
+        return end
+
+
+class Base64Decoder:
+    # Decodes base64 text handed over in arbitrary fragments into a single bytearray.
+    def __init__(self):
+        self.output = bytearray()
+        self.carry = b""
+
+    def write(self, fragment):
+        data = self.carry + bytes(fragment).translate(None, WHITESPACE)
+        usable = len(data) - len(data) % 4
+        self.output += binascii.a2b_base64(data[:usable])
+        self.carry = data[usable:]
+
+    def close(self):
+        if self.carry:
+            raise ValueError("Truncated base64 data")
+        return self.output
+
+
+def read_fields(buffer, on_value, chunk_size=1024 * 1024):
+    # Runs a JsonFieldReader over an in-memory document without copying it as a whole.
+    reader = JsonFieldReader(on_value)
+    view = memoryview(buffer)
+    for offset in range(0, len(view), chunk_size):
+        reader.feed(view[offset:offset + chunk_size])
+    reader.close()
@@ -0,0 +1,603 @@
+import json
+import logging
+import math
+import re
+
+from xnode_admin.config_cache import atomic_write
+
+log = logging.getLogger(__name__)
+
+# Attribute names that can be written without quotes.
+NIX_IDENTIFIER = re.compile(r"^[A-Za-z_][A-Za-z0-9_'-]*$")
+NIX_INTEGER = re.compile(r"^-?[0-9]+$")
+NIX_FLOAT = re.compile(r"^-?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][+-]?[0-9]+)?$")
+# Paths nix accepts as literals, anything else is written as a string.
+NIX_PATH = re.compile(r"^\.?(/[A-Za-z0-9._+-]+)+$")
+NIX_ATTR_PATH = re.compile(r"^[A-Za-z_][A-Za-z0-9_'-]*(\.[A-Za-z_][A-Za-z0-9_'-]*)*$")
+# Characters escaped in double quoted nix strings, "${" would start an interpolation.
+NIX_STRING_SPECIAL = re.compile(r'[\\"\n\r\t]|\$\{')
+NIX_STRING_ESCAPES = {"\\": "\\\\", '"': '\\"', "${": "\\${", "\n": "\\n", "\r": "\\r", "\t": "\\t"}
+NIX_STRING_TOKEN = re.compile(r'"(?:[^"\\$]|\\.|\$(?!\{))*"')
+NIX_LIST_TOKEN = re.compile(r'\s*("(?:[^"\\$]|\\.|\$(?!\{))*"|[^\s\[\]"]+)')
+STRING_END = re.compile(r'(?<!\\)"')
+NIX_LITERAL_TOKEN = re.compile(r'\s*(?:("(?:[^"\\$]|\\.|\$(?!\{))*")|([\[\]{}=;])|([^\s\[\]{}=;"]+))')
+ENUM_CHOICE = re.compile(r'"((?:[^"\\]|\\.)*)"|([^\s,"]+)')
+RANGE_SUFFIX = re.compile(r"^(.*?);? between (-?[0-9.]+) and (-?[0-9.]+) \(both inclusive\)$")
+
+MIN_INT = -2 ** 63
+MAX_INT = 2 ** 63 - 1
+
+# Compiled renderers by type description, see compile_type.
+compiled_types = {}
+unsupported_types = set() # Descriptions of types warned about.
+MAX_COMPILED_TYPES = 4096
+
+
+class ConfigError(ValueError):
+    # A Studio config, or one of its values, that can't be rendered to valid nix.
+    pass
+
+
+def nix_string(value):
+    if NIX_STRING_SPECIAL.search(value) == None:
+        return '"' + value + '"'
+    return '"' + NIX_STRING_SPECIAL.sub(lambda match: NIX_STRING_ESCAPES[match.group(0)], value) + '"'
+
+
+def nix_string_value(token):
+    # The value of a double quoted nix string literal, the inverse of nix_string.
+    escapes = {"n": "\n", "r": "\r", "t": "\t"}
+    return re.sub(r'\\(.)', lambda match: escapes.get(match.group(1), match.group(1)), token[1:-1], flags=re.DOTALL)
+
+
+def nix_attr_name(name):
+    if NIX_IDENTIFIER.match(name):
+        return name
+    return nix_string(name)
+
+
+def nix_float(value):
+    # Nix float literals need digits before the exponent to include a dot, e.g. 1.0e-05 rather than 1e-05.
+    text = repr(float(value))
+    if "e" in text and "." not in text:
+        mantissa, exponent = text.split("e")
+        text = mantissa + ".0e" + exponent
+    return text
+
+
+def json_to_nix(value):
+    # Any JSON value as a nix expression, for options that take arbitrary values.
+    if value == None:
+        return "null"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, float):
+        if not math.isfinite(value):
+            raise ConfigError("%s isn't a number nix can represent" % value)
+        return nix_float(value)
+    if isinstance(value, str):
+        return nix_string(value)
+    if isinstance(value, list):
+        return "[ " + "".join(json_to_nix(item) + " " for item in value) + "]"
+    if isinstance(value, dict):
+        return "{ " + "".join(nix_attr_name(str(key)) + " = " + json_to_nix(item) + "; " for key, item in value.items()) + "}"
+    raise ConfigError("unexpected value %r" % (value,))
+
+
+def nix_literal(text):
+    # The value of a plain nix literal (strings, numbers, booleans, null, paths, lists and attribute sets of them), the
+    # inverse of json_to_nix. Raises ConfigError for anything else, such as expressions and interpolated strings.
+    tokens = []
+    position = 0
+    while text[position:].strip() != "":
+        match = NIX_LITERAL_TOKEN.match(text, position)
+        if match == None:
+            raise ConfigError("%s isn't a plain value" % text)
+        tokens.append(match.group(1) or match.group(2) or match.group(3))
+        position = match.end()
+    tokens.append(None)
+
+    def parse(i):
+        token = tokens[i]
+        if token in [None, "]", "}", "=", ";"]:
+            raise ConfigError("%s isn't a plain value" % text)
+        if token.startswith('"'):
+            return nix_string_value(token), i + 1
+        if token == "[":
+            items, i = [], i + 1
+            while tokens[i] != "]":
+                item, i = parse(i)
+                items.append(item)
+            return items, i + 1
+        if token == "{":
+            attrs, i = {}, i + 1
+            while tokens[i] != "}":
+                name = tokens[i]
+                if name == None or not (name.startswith('"') or NIX_ATTR_PATH.match(name)) or tokens[i + 1] != "=":
+                    raise ConfigError("%s isn't a plain value" % text)
+                item, i = parse(i + 2)
+                if tokens[i] != ";":
+                    raise ConfigError("%s isn't a plain value" % text)
+                i += 1
+                names = [nix_string_value(name)] if name.startswith('"') else name.split(".")
+                target = attrs
+                for part in names[:-1]:
+                    target = target.setdefault(part, {})
+                    if not isinstance(target, dict):
+                        raise ConfigError("%s isn't a plain value" % text)
+                target[names[-1]] = item
+            return attrs, i + 1
+        if token in ["true", "false", "null"]:
+            return {"true": True, "false": False, "null": None}[token], i + 1
+        if NIX_INTEGER.match(token):
+            return int(token), i + 1
+        if NIX_FLOAT.match(token):
+            return float(token), i + 1
+        if NIX_PATH.match(token):
+            return token, i + 1
+        raise ConfigError("%s isn't a plain value" % text)
+
+    value, i = parse(0)
+    if tokens[i] != None:
+        raise ConfigError("%s isn't a plain value" % text)
+    return value
+
+
+def check_balanced(text):
+    # Cheap sanity check for raw nix expressions: brackets match and strings are closed.
+    closing = {"(": ")", "[": "]", "{": "}"}
+    stack = []
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if char == '"':
+            match = NIX_STRING_TOKEN.match(text, i)
+            if match == None:
+                # Interpolations inside the string, skip to the closing quote.
+                end = STRING_END.search(text, i + 1)
+                if end == None:
+                    raise ConfigError("unterminated string in %s" % text)
+                i = end.end()
+                continue
+            i = match.end()
+            continue
+        if text.startswith("''", i):
+            end = text.find("''", i + 2)
+            if end < 0:
+                raise ConfigError("unterminated string in %s" % text)
+            i = end + 2
+            continue
+        if char in closing:
+            stack.append(closing[char])
+        elif char in ")]}":
+            if len(stack) == 0 or stack.pop() != char:
+                raise ConfigError("unbalanced %s in %s" % (char, text))
+        i += 1
+    if len(stack) > 0:
+        raise ConfigError("missing %s in %s" % (stack[-1], text))
+
+
+def text_value(value):
+    # Strings, paths and packages only come as JSON strings, so "string or signed integer" keeps numbers numbers.
+    if not isinstance(value, str):
+        raise ConfigError("expected a string, got %s" % json.dumps(value))
+    return value
+
+
+def render_bool(value):
+    if value is True or value == "true":
+        return "true"
+    if value is False or value == "false":
+        return "false"
+    raise ConfigError("expected true or false, got %s" % json.dumps(value))
+
+
+def integer_renderer(minimum=MIN_INT, maximum=MAX_INT):
+    def render(value):
+        if isinstance(value, bool) or not (isinstance(value, int) or (isinstance(value, str) and NIX_INTEGER.match(value))):
+            raise ConfigError("expected an integer, got %s" % json.dumps(value))
+        number = int(value)
+        if number < minimum or number > maximum:
+            raise ConfigError("%s is outside of %s to %s" % (number, minimum, maximum))
+        return str(number)
+    return render
+
+
+def render_float(value):
+    if isinstance(value, bool) or not (isinstance(value, (int, float)) or (isinstance(value, str) and NIX_FLOAT.match(value))):
+        raise ConfigError("expected a number, got %s" % json.dumps(value))
+    number = float(value)
+    if not math.isfinite(number):
+        raise ConfigError("%s isn't a number nix can represent" % value)
+    return nix_float(number)
+
+
+def render_number(value):
+    try:
+        return integer_renderer()(value)
+    except ConfigError:
+        return render_float(value)
+
+
+def string_renderer(check=None, message=""):
+    def render(value):
+        text = text_value(value)
+        if check != None and not check(text):
+            raise ConfigError("%s isn't %s" % (json.dumps(text), message))
+        return nix_string(text)
+    return render
+
+
+def path_renderer(absolute=False, prefix=""):
+    def render(value):
+        text = text_value(value)
+        if not text.startswith("/") and (absolute or not text.startswith("./")):
+            raise ConfigError("expected an absolute path, got %s" % json.dumps(text))
+        if not text.startswith(prefix):
+            raise ConfigError("%s isn't below %s" % (json.dumps(text), prefix))
+        if NIX_PATH.match(text):
+            return text
+        # Spaces and other special characters, nix converts the string to a path.
+        return nix_string(text)
+    return render
+
+
+def render_package(value):
+    text = text_value(value)
+    if not NIX_ATTR_PATH.match(text):
+        raise ConfigError("expected a package such as pkgs.hello, got %s" % json.dumps(text))
+    return text
+
+
+def render_null(value):
+    if value == None or value == "null":
+        return "null"
+    raise ConfigError("expected null, got %s" % json.dumps(value))
+
+
+def render_raw(value):
+    # Values of options without a precise type are written as they are, after a syntax sanity check.
+    if not isinstance(value, str):
+        return json_to_nix(value)
+    if value.strip() == "":
+        raise ConfigError("empty value")
+    check_balanced(value)
+    return value
+
+
+def collection_value(value, opening):
+    # Lists and attribute sets arrive as JSON, either as they are or encoded in a string.
+    if isinstance(value, str) and value.strip().startswith(opening):
+        try:
+            return json.loads(value)
+        except ValueError:
+            pass
+    return value
+
+
+def list_renderer(render_item):
+    def render(value):
+        value = collection_value(value, "[")
+        if isinstance(value, str):
+            # Older Studios send the nix list itself, e.g. [ "a" "b" ].
+            text = value.strip()
+            if not text.startswith("[") or not text.endswith("]"):
+                raise ConfigError("expected a list, got %s" % json.dumps(value))
+            value, position = [], 1
+            while position < len(text) - 1:
+                match = NIX_LIST_TOKEN.match(text, position)
+                if match == None:
+                    break
+                token = match.group(1)
+                value.append(nix_string_value(token) if token.startswith('"') else token)
+                position = match.end()
+            if text[position:-1].strip() != "":
+                raise ConfigError("can't read list %s" % text)
+        if not isinstance(value, list):
+            raise ConfigError("expected a list, got %s" % json.dumps(value))
+        return "[ " + "".join(render_item(item) + " " for item in value) + "]"
+    return render
+
+
+def attrs_renderer(render_item):
+    def render(value):
+        value = collection_value(value, "{")
+        if not isinstance(value, dict):
+            raise ConfigError("expected an attribute set, got %s" % json.dumps(value))
+        return "{ " + "".join(nix_attr_name(str(key)) + " = " + render_item(item) + "; " for key, item in value.items()) + "}"
+    return render
+
+
+def enum_renderer(choices):
+    # choices maps the accepted values to their nix text.
+    def render(value):
+        if isinstance(value, bool):
+            text = render_bool(value)
+        elif isinstance(value, (int, float)):
+            text = str(value)
+        else:
+            text = text_value(value)
+        if text not in choices:
+            raise ConfigError("%s isn't one of %s" % (json.dumps(text), ", ".join(choices.values())))
+        return choices[text]
+    return render
+
+
+def either_renderer(renderers, type_name):
+    def render(value):
+        for render_alternative in renderers:
+            try:
+                return render_alternative(value)
+            except ConfigError:
+                pass
+        raise ConfigError("%s doesn't fit %s" % (json.dumps(value), type_name))
+    return render
+
+
+def range_renderer(render_number_type, minimum, maximum):
+    def render(value):
+        text = render_number_type(value)
+        if float(text) < minimum or float(text) > maximum:
+            raise ConfigError("%s is outside of %s to %s" % (text, minimum, maximum))
+        return text
+    return render
+
+
+def in_parentheses(text):
+    # True for "(...)" where the first parenthesis closes at the end.
+    if not text.startswith("(") or not text.endswith(")"):
+        return False
+    depth = 0
+    for i, char in enumerate(text):
+        if char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+            if depth == 0 and i < len(text) - 1:
+                return False
+    return True
+
+
+def split_top_level(text, separator):
+    # Splits on separator outside of parentheses and quotes, e.g. for "null or (list of (string or package))".
+    parts, depth, quoted, start, i = [], 0, False, 0, 0
+    while i < len(text):
+        char = text[i]
+        if char == '"' and (i == 0 or text[i - 1] != "\\"):
+            quoted = not quoted
+        elif not quoted and char == "(":
+            depth += 1
+        elif not quoted and char == ")":
+            depth -= 1
+        elif not quoted and depth == 0 and text.startswith(separator, i):
+            parts.append(text[start:i])
+            i += len(separator)
+            start = i
+            continue
+        i += 1
+    parts.append(text[start:])
+    return parts
+
+
+SIMPLE_TYPES = {
+    "": render_raw, # Untyped values were always written as they are.
+    "raw": render_raw,
+    "raw value": render_raw,
+    "anything": render_raw,
+    "unspecified value": render_raw,
+    "submodule": render_raw,
+    "attribute set": render_raw,
+    "JSON value": render_raw,
+    "TOML value": render_raw,
+    "YAML value": render_raw,
+    "null": render_null,
+    "boolean": render_bool,
+    "bool": render_bool,
+    "int": integer_renderer(),
+    "integer": integer_renderer(),
+    "signed integer": integer_renderer(),
+    "unsigned integer": integer_renderer(0),
+    "unsigned integer, meaning >=0": integer_renderer(0),
+    "positive integer, meaning >0": integer_renderer(1),
+    "float": render_float,
+    "floating point number": render_float,
+    "number": render_number,
+    "string": string_renderer(),
+    "str": string_renderer(),
+    "non-empty string": string_renderer(lambda text: text.strip() != "", "a non-empty string"),
+    "single-line string": string_renderer(lambda text: "\n" not in text.rstrip("\n"), "a single line"),
+    "(optionally newline-terminated) single-line string": string_renderer(lambda text: "\n" not in text.rstrip("\n"), "a single line"),
+    "path": path_renderer(),
+    "absolute path": path_renderer(True),
+    "path in the Nix store": path_renderer(True, "/nix/store/"),
+    "package": render_package,
+}
+
+
+def build_type(type_name):
+    # A function rendering values of the described type (as NixOS describes option types) or None if unsupported.
+    if type_name in SIMPLE_TYPES:
+        return SIMPLE_TYPES[type_name]
+    if type_name.startswith("/") or type_name.startswith("./"):
+        # Legacy Studio types that name a file, the value is written as it is.
+        return render_raw
+
+    # Types whose description ends in free text that may contain " or ".
+    if type_name.startswith("string matching the pattern "):
+        try:
+            pattern = re.compile(type_name[len("string matching the pattern "):])
+        except re.error:
+            return None
+        return string_renderer(lambda text: pattern.fullmatch(text) != None, "matching " + pattern.pattern)
+    if type_name.startswith("strings concatenated with "):
+        return string_renderer()
+    if type_name.startswith("string, not containing newlines"):
+        forbidden = "\n:" if "colons" in type_name else "\n"
+        return string_renderer(lambda text: not any(char in text for char in forbidden), "free of " + repr(forbidden))
+    if type_name.startswith("one of ") or (type_name.startswith("value ") and type_name.endswith(" (singular enum)")):
+        choices = {}
+        listed = type_name[len("one of "):] if type_name.startswith("one of ") else type_name[len("value "):-len(" (singular enum)")]
+        for quoted, bare in ENUM_CHOICE.findall(listed):
+            if bare != "":
+                choices[bare] = bare
+            else:
+                choices[nix_string_value('"' + quoted + '"')] = '"' + quoted + '"'
+        return enum_renderer(choices) if len(choices) > 0 else None
+    if type_name.startswith("function that evaluates to"):
+        return render_raw
+
+    if in_parentheses(type_name):
+        return compile_type(type_name[1:-1].strip())
+    # NixOS puts compound element types in parentheses, so a container's element type runs to the end.
+    for prefix, container in [("list of ", list_renderer), ("non-empty list of ", list_renderer), ("attribute set of ", attrs_renderer), ("lazy attribute set of ", attrs_renderer)]:
+        if type_name.startswith(prefix):
+            render_item = compile_type(type_name[len(prefix):].strip())
+            return container(render_item) if render_item != None else None
+    match = RANGE_SUFFIX.match(type_name)
+    if match:
+        # E.g. "16 bit unsigned integer; between 0 and 65535 (both inclusive)".
+        render_base = compile_type(match.group(1))
+        return range_renderer(render_base, float(match.group(2)), float(match.group(3))) if render_base != None else None
+
+    alternatives = split_top_level(type_name, " or ")
+    if len(alternatives) > 1:
+        renderers = [compile_type(alternative.strip()) for alternative in alternatives]
+        if None in renderers:
+            return None
+        return either_renderer(renderers, type_name)
+
+    if re.match(r"^[0-9]+ bit (un)?signed integer;?$", type_name):
+        return integer_renderer()
+    return None
+
+
+def compile_type(type_name):
+    # Memoized build_type, every distinct type description is only parsed once.
+    render = compiled_types.get(type_name, False)
+    if render is False:
+        if len(compiled_types) >= MAX_COMPILED_TYPES:
+            compiled_types.clear()
+        render = compiled_types[type_name] = build_type(type_name)
+    return render
+
+
+def render_value(type_name, value):
+    # Renders an option value as nix, raises ConfigError if it doesn't fit the type. Values of types that aren't
+    # supported (yet) are written raw, like before types were checked, with a warning the first time the type is seen.
+    try:
+        render = compiled_types[type_name]
+    except (KeyError, TypeError):
+        render = compile_type(type_name) if isinstance(type_name, str) else None
+    if render == None:
+        description = json.dumps(type_name)
+        if description not in unsupported_types:
+            if len(unsupported_types) >= MAX_COMPILED_TYPES:
+                unsupported_types.clear()
+            unsupported_types.add(description)
+            log.warning("Unsupported option type %s, values of this type are written without checking.", description)
+        return render_raw(value)
+    return render(value)
+
+
+class OptionIndex:
+    '''
+    NixOS option types by full option path (e.g. "services.nginx.enable"), loaded from a JSON option index such as
+    the one NixScraper generates. Types are compiled once when the index is loaded, so checking an option against
+    it is a dict lookup. Options of types this module can't check are left out.
+    '''
+    def __init__(self, option_types=None):
+        self.types = {}
+        self.renderers = {}
+        for name, type_name in (option_types or {}).items():
+            self.add(name, type_name)
+
+    def add(self, name, type_name):
+        render = compile_type(type_name)
+        if render != None:
+            self.types[name] = type_name
+            self.renderers[name] = render
+
+    def lookup(self, name):
+        return self.renderers.get(name)
+
+    @staticmethod
+    def load(path):
+        # Reads {"name": "type"}, {"name": {"type": ...}} or [{"name": ..., "type": ...}].
+        with open(path, "r") as f:
+            options = json.load(f)
+        if isinstance(options, list):
+            options = {option["name"]: option["type"] for option in options if "name" in option and "type" in option}
+        option_types = {name: option["type"] if isinstance(option, dict) else option for name, option in options.items()}
+        index = OptionIndex({name: type_name for name, type_name in option_types.items() if isinstance(type_name, str)})
+        log.info("Loaded %s option types from %s, %s distinct.", len(index.types), path, len(set(index.types.values())))
+        return index
+
+    def save(self, path):
+        atomic_write(path, json.dumps(self.types, sort_keys=True))
+
+
+def check_compatible(path, declared, rendered, expected_type, render_expected):
+    # The value as written for its declared type has to be a value of the option's real type. Both are compared as nix
+    # values, so a raw "[\"a\"]" fits a list of strings just like a list declared as one.
+    try:
+        value = nix_literal(rendered)
+    except ConfigError:
+        log.warning("%s is written as a nix expression, it can't be checked against %s.", path, expected_type)
+        return
+    try:
+        expected = nix_literal(render_expected(value))
+    except ConfigError as e:
+        raise ConfigError("declared as %s, but the option is a %s: %s" % (json.dumps(declared), expected_type, e))
+    if json.dumps(value, sort_keys=True) != json.dumps(expected, sort_keys=True):
+        raise ConfigError("declared as %s, but the option is a %s" % (json.dumps(declared), expected_type))
+
+
+def check_option(option, prefix, option_index, errors):
+    # Checks a module ({nixName, options}) or an option ({nixName, type, value}) and everything below it.
+    if not isinstance(option, dict):
+        errors.append("%s: expected an object, got %s" % (prefix, json.dumps(option)[:100]))
+        return
+    name = option.get("nixName")
+    if not isinstance(name, str) or "" in name.split("."):
+        errors.append("%s: missing or invalid nixName %s" % (prefix, json.dumps(name)))
+        return
+    path = prefix + "." + name
+
+    if "options" in option:
+        if not isinstance(option["options"], list):
+            errors.append("%s: options isn't a list" % path)
+            return
+        for sub_option in option["options"]:
+            check_option(sub_option, path, option_index, errors)
+    elif "value" in option:
+        declared = option.get("type", "")
+        try:
+            rendered = render_value(declared, option["value"])
+            render_expected = option_index.lookup(path) if option_index != None else None
+            if render_expected != None and declared != option_index.types[path]:
+                check_compatible(path, declared, rendered, option_index.types[path], render_expected)
+        except ConfigError as e:
+            errors.append("%s: %s" % (path, e))
+
+
+def validate_config(studio_json_config, option_index=None, max_errors=20):
+    '''
+    Checks that every option of a Studio config renders to valid nix for its type (and, with an OptionIndex, for the
+    type NixOS declares), before anything is written or built. Returns the error messages, none if the config is fine.
+    '''
+    if not isinstance(studio_json_config, dict):
+        return ["config: expected an object"]
+    errors = []
+    for section, modules in studio_json_config.items():
+        if not NIX_IDENTIFIER.match(section):
+            errors.append("%s: invalid section name" % json.dumps(section))
+        elif not isinstance(modules, list):
+            errors.append("%s: expected a list" % section)
+        else:
+            for module in modules:
+                check_option(module, section, option_index, errors)
+    if len(errors) > max_errors:
+        errors = errors[:max_errors] + ["and %s more errors" % (len(errors) - max_errors)]
+    return errors
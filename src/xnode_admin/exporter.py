@@ -0,0 +1,249 @@
+import http.server
+import json
+import logging
+import math
+import os
+import socketserver
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Default histogram buckets in seconds, from a fast API call to a long rebuild.
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 1800, 3600)
+
+
+def format_labels(names, values, extra=""):
+    pairs = [name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    '''
+    A metric family with optional labels. Updates come from the agent's event loop and only hold the
+    registry lock for a dict lookup and an addition. The exporter thread holds it just long enough to copy the
+    values, formatting happens outside of it.
+    '''
+    kind = "untyped"
+
+    def __init__(self, registry, name, help_text, labels=()):
+        self.lock = registry.lock
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self.values = {}
+
+    def label_values(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def snapshot(self):
+        return dict(self.values)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self, values):
+        for key, value in values.items():
+            yield self.name + "_total" + format_labels(self.label_names, key), value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def samples(self, values):
+        for key, value in values.items():
+            yield self.name + format_labels(self.label_names, key), value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, registry, name, help_text, labels=(), buckets=SECONDS_BUCKETS):
+        super().__init__(registry, name, help_text, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state == None:
+                state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def snapshot(self):
+        return {key: (list(counts), total, count) for key, (counts, total, count) in self.values.items()}
+
+    def samples(self, values):
+        for key, (counts, total, count) in values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield self.name + "_bucket" + format_labels(self.label_names, key, 'le="' + format_value(bound) + '"'), cumulative
+            yield self.name + "_sum" + format_labels(self.label_names, key), total
+            yield self.name + "_count" + format_labels(self.label_names, key), count
+
+
+class Registry:
+    # The metrics exposed by the exporter, rendered in the Prometheus text format (version 0.0.4).
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+
+    def counter(self, name, help_text, labels=()):
+        return self.add(Counter(self, name, help_text, labels))
+
+    def gauge(self, name, help_text, labels=()):
+        return self.add(Gauge(self, name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=SECONDS_BUCKETS):
+        return self.add(Histogram(self, name, help_text, labels, buckets))
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self.lock:
+            snapshots = [(metric, metric.snapshot()) for metric in self.metrics]
+        out = []
+        for metric, values in snapshots:
+            out.append("# HELP " + metric.name + " " + metric.help + "\n")
+            out.append("# TYPE " + metric.name + " " + metric.kind + "\n")
+            for sample, value in metric.samples(values):
+                out.append(sample + " " + format_value(value) + "\n")
+        return "".join(out)
+
+
+REGISTRY = Registry()
+
+studio_request_seconds = REGISTRY.histogram("xnode_admin_studio_request_seconds", "Latency of Studio API calls.", ["endpoint"])
+studio_request_failures = REGISTRY.counter("xnode_admin_studio_request_failures", "Studio API calls that failed or didn't return a 2xx.", ["endpoint"])
+heartbeats = REGISTRY.counter("xnode_admin_heartbeats", "Heartbeats sent to the Studio.", ["result"])
+rebuild_seconds = REGISTRY.histogram("xnode_admin_rebuild_seconds", "Duration of each rebuild phase.", ["phase"])
+rebuilds = REGISTRY.counter("xnode_admin_rebuilds", "Rebuilds by outcome.", ["result"])
+gc_seconds = REGISTRY.histogram("xnode_admin_gc_seconds", "Duration of nix store garbage collections.")
+gc_freed_bytes = REGISTRY.counter("xnode_admin_gc_freed_bytes", "Bytes freed by nix store garbage collection.")
+update_check_seconds = REGISTRY.histogram("xnode_admin_update_check_seconds", "Duration of flake update checks.", ["result"])
+loop_lag_seconds = REGISTRY.histogram("xnode_admin_loop_lag_seconds", "How late the event loop woke up the metric sampler.", buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10))
+loop_last_tick = REGISTRY.gauge("xnode_admin_loop_last_tick_seconds", "Unix time the event loop last woke up the metric sampler.")
+generation = REGISTRY.gauge("xnode_admin_generation", "Last generation values seen from the Studio.", ["field"])
+command_seconds = REGISTRY.histogram("xnode_admin_command_seconds", "Duration of every nix (and other) command the agent ran.", ["command", "result"])
+prefetched_paths = REGISTRY.counter("xnode_admin_prefetched_paths", "Store paths downloaded ahead of a build.", ["result"])
+prefetched_bytes = REGISTRY.counter("xnode_admin_prefetched_bytes", "Estimated bytes downloaded ahead of a build.")
+
+
+class ExporterHandler(http.server.BaseHTTPRequestHandler):
+    # Serves /metrics in the Prometheus text format and /health as a small JSON document.
+    server_version = "xnode-admin"
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self.reply(200, "text/plain; version=0.0.4; charset=utf-8", self.server.registry.render())
+        elif self.path == "/health":
+            health = self.server.health()
+            self.reply(200 if health["healthy"] else 503, "application/json", json.dumps(health))
+        else:
+            self.reply(404, "text/plain", "Not found\n")
+
+    def reply(self, code, content_type, body):
+        body = body.encode('utf-8')
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would drown out everything else.
+        log.debug("%s", format % args)
+
+
+class TCPExporterServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class UnixExporterServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # Unix sockets have no peer address, give the handler something it can print.
+        request, _ = super().get_request()
+        return request, ("local", 0)
+
+
+class MetricsExporter:
+    '''
+    Local HTTP endpoint for node exporters, on a localhost port or a unix socket.
+    It runs on its own threads and only reads the registry, the event loop never waits on a scrape.
+    The agent counts as healthy while its event loop keeps waking up the metric sampler.
+    '''
+    def __init__(self, address, registry=REGISTRY, max_loop_stall=60):
+        self.address = address # Port number, "host:port", or a unix socket path.
+        self.registry = registry
+        self.max_loop_stall = max_loop_stall
+        self.server = None
+        self.started = time.time()
+
+    def health(self):
+        last_tick = self.registry_value(loop_last_tick)
+        if last_tick == None:
+            # Still doing the initial rebuild, the sampler hasn't started yet.
+            return {"healthy": True, "starting": True, "uptimeSeconds": time.time() - self.started}
+        stalled = time.time() - last_tick
+        return {"healthy": stalled < self.max_loop_stall, "loopStalledSeconds": stalled}
+
+    def registry_value(self, gauge):
+        with gauge.lock:
+            return gauge.values.get(())
+
+    def start(self):
+        address = str(self.address)
+        if address.startswith("/"):
+            if os.path.exists(address):
+                os.unlink(address)
+            self.server = UnixExporterServer(address, ExporterHandler)
+            os.chmod(address, 0o660)
+        else:
+            host, _, port = address.rpartition(":")
+            self.server = TCPExporterServer((host or "127.0.0.1", int(port)), ExporterHandler)
+        self.server.registry = self.registry
+        self.server.health = self.health
+        threading.Thread(target=self.server.serve_forever, name="metrics-exporter", daemon=True).start()
+        log.info("Serving metrics on %s", self.url())
+
+    def url(self):
+        if isinstance(self.server.server_address, str):
+            return "unix:" + self.server.server_address
+        host, port = self.server.server_address[:2]
+        return "http://" + host + ":" + str(port)
+
+    def stop(self):
+        if self.server != None:
+            self.server.shutdown()
+            self.server.server_close()
+            if isinstance(self.server.server_address, str) and os.path.exists(self.server.server_address):
+                os.unlink(self.server.server_address)
@@ -0,0 +1,92 @@
+import logging
+import re
+import time
+
+import psutil
+
+from xnode_admin import exporter
+from xnode_admin.commands import run_command
+
+log = logging.getLogger(__name__)
+
+SYSTEM_PROFILE = "/nix/var/nix/profiles/system"
+FREED_PATTERN = re.compile(r"(\d+) store paths deleted, ([\d.]+) (\w+) freed")
+
+
+class GarbageCollector:
+    '''
+    Decides when to run nix-store --gc instead of collecting after every rebuild.
+    Collection only starts once the store's filesystem crosses the usage watermark or drops below min_free_mb,
+    frees just enough to get back under both (capped at max_freed_mb), and runs at idle CPU and IO priority.
+    '''
+    def __init__(self, high_watermark=80.0, min_free_mb=2048, max_freed_mb=0, keep_generations=3, path="/"):
+        self.high_watermark = high_watermark
+        self.min_free_mb = min_free_mb
+        self.max_freed_mb = max_freed_mb # 0 means no limit.
+        self.keep_generations = keep_generations
+        self.path = path
+
+        self.runs = 0
+        self.last_run = None
+        self.last_seconds = 0.0
+        self.last_bytes_freed = 0
+
+    def bytes_to_free(self):
+        # How much has to go to get back under the watermark and above the free space minimum, 0 if nothing.
+        disk = psutil.disk_usage(self.path)
+        over_watermark = disk.used - disk.total * self.high_watermark / 100
+        under_min_free = self.min_free_mb * 1024 * 1024 - disk.free
+        needed = max(over_watermark, under_min_free, 0)
+        if needed > 0 and self.max_freed_mb > 0:
+            needed = min(needed, self.max_freed_mb * 1024 * 1024)
+        return int(needed)
+
+    async def collect_if_needed(self, force=False):
+        needed = self.bytes_to_free()
+        if needed == 0 and not force:
+            return False
+
+        log.info('Running gc, need to free %s bytes.', needed)
+        start = time.time()
+        free_before = psutil.disk_usage(self.path).free
+
+        if self.keep_generations > 0:
+            returncode, stdout, stderr = await run_command(idle_priority([
+                '/run/current-system/sw/bin/nix-env', '--profile', SYSTEM_PROFILE,
+                '--delete-generations', '+' + str(self.keep_generations),
+            ]))
+            if returncode != 0:
+                log.warning('Failed to delete old system generations: %s', stderr.decode('utf-8', errors='replace'))
+
+        gc_command = ['/run/current-system/sw/bin/nix-store', '--gc']
+        if needed > 0:
+            gc_command += ['--max-freed', str(needed)]
+        returncode, stdout, stderr = await run_command(idle_priority(gc_command))
+        if returncode != 0:
+            log.error('Garbage collection failed: %s', stderr.decode('utf-8', errors='replace')[-4096:])
+
+        self.runs += 1
+        self.last_run = time.time()
+        self.last_seconds = self.last_run - start
+        self.last_bytes_freed = max(psutil.disk_usage(self.path).free - free_before, 0)
+        exporter.gc_seconds.observe(self.last_seconds)
+        exporter.gc_freed_bytes.inc(self.last_bytes_freed)
+        match = FREED_PATTERN.search(stderr.decode('utf-8', errors='replace') + stdout.decode('utf-8', errors='replace'))
+        if match:
+            log.info('Garbage collection: %s', match.group(0))
+        log.info('Done with gc in %.1f seconds, freed %s bytes.', self.last_seconds, self.last_bytes_freed)
+        return returncode == 0
+
+    def report(self):
+        # Fields added to the heartbeat.
+        return {
+            "gcRuns": self.runs,
+            "gcLastRun": self.last_run,
+            "gcLastSeconds": self.last_seconds,
+            "gcLastBytesFreed": self.last_bytes_freed,
+        }
+
+
+def idle_priority(command):
+    # Lowest CPU priority and the idle IO scheduling class, so gc doesn't slow down running services.
+    return ['/run/current-system/sw/bin/nice', '-n', '19', '/run/current-system/sw/bin/ionice', '-c', '3'] + command
@@ -0,0 +1,86 @@
+import logging
+import random
+import time
+
+from xnode_admin.intervals import hinted_seconds
+
+log = logging.getLogger(__name__)
+
+
+class GenerationPoller:
+    '''
+    Decides how getXnodeGeneration is called.
+    Long-polling is tried first: the Studio holds the request open until the generation changes or wait seconds
+    pass, so changes arrive immediately with one request per wait period. Studios that don't answer with
+    "longPoll": true get adaptive polling instead, starting at base_interval and backing off exponentially (with
+    jitter, so a fleet doesn't synchronise) while nothing changes or the Studio is unreachable.
+    Config changes are only applied once configWant stayed the same for quiet_period seconds (but never held back
+    longer than max_settle), so a burst of edits in the Studio becomes a single rebuild.
+    The Studio can ask for a longer polling interval with "intervals": {"generation": s}, kept within base_interval
+    and max_interval.
+    '''
+    def __init__(self, base_interval=10, max_interval=60, max_error_interval=300, long_poll_wait=60, long_poll_retry=60 * 30, jitter=0.2, quiet_period=5, max_settle=60):
+        self.base_interval = base_interval
+        self.max_interval = max_interval
+        self.max_error_interval = max_error_interval
+        self.wait = long_poll_wait # 0 disables long-polling.
+        self.long_poll_retry = long_poll_retry
+        self.jitter = jitter
+        self.quiet_period = quiet_period # 0 applies every config generation as soon as it's seen.
+        self.max_settle = max_settle
+
+        self.long_poll_supported = None
+        self.long_poll_checked = 0
+        self.unchanged = 0
+        self.failures = 0
+        self.last_generation = None
+        self.interval_hint = None
+
+    def long_poll_wait(self):
+        # Seconds the Studio may hold the next request, 0 for a plain poll.
+        if self.wait <= 0:
+            return 0
+        if self.long_poll_supported == False and self.long_poll_checked + self.long_poll_retry > time.time():
+            return 0
+        return self.wait
+
+    def hint(self, seconds):
+        # Polling interval the Studio asked for, None (or 0) goes back to base_interval.
+        seconds = hinted_seconds(seconds)
+        self.interval_hint = min(max(seconds, self.base_interval), self.max_interval) if seconds != None else None
+
+    def known_generation(self):
+        return self.last_generation
+
+    def record(self, generation_data, waited) -> bool:
+        # Returns True if the generation differs from the last one seen.
+        if generation_data == None:
+            self.failures += 1
+            return False
+        self.failures = 0
+
+        if waited > 0:
+            self.long_poll_supported = bool(generation_data.get("longPoll", False))
+            self.long_poll_checked = time.time()
+            if not self.long_poll_supported:
+                log.info('Studio doesn\'t support long-polling generations, falling back to polling.')
+
+        generation = {key: generation_data[key] for key in ["configWant", "configHave", "updateWant", "updateHave"]}
+        changed = generation != self.last_generation
+        self.last_generation = generation
+        if changed:
+            self.unchanged = 0
+        else:
+            self.unchanged += 1
+        return changed
+
+    def next_delay(self):
+        if self.failures > 0:
+            delay = min(self.base_interval * 2 ** (self.failures - 1), self.max_error_interval)
+        elif self.long_poll_supported and self.long_poll_wait() > 0:
+            # The Studio already held the request, ask again straight away.
+            return 0
+        else:
+            base = self.interval_hint if self.interval_hint != None else self.base_interval
+            delay = min(base * 2 ** max(self.unchanged - 1, 0), self.max_interval)
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
@@ -0,0 +1,128 @@
+import logging
+import time
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+# Usage levels (percentages) compared between heartbeats and checked against thresholds on every sample.
+LEVELS = ["cpu", "memory", "disk"]
+
+
+def percentage(used, total):
+    return 100.0 * used / total if total > 0 else 0.0
+
+
+def heartbeat_levels(heartbeat_message):
+    # Average usage over the interval a heartbeat covers.
+    return {
+        "cpu": heartbeat_message["cpuPercent"],
+        "memory": percentage(heartbeat_message["ramMbUsed"], heartbeat_message["ramMbTotal"]),
+        "disk": percentage(heartbeat_message["storageMbUsed"], heartbeat_message["storageMbTotal"]),
+    }
+
+
+def clamp(value, lowest, highest):
+    return min(max(value, lowest), highest)
+
+
+def hinted_seconds(value):
+    # A positive number of seconds, None for 0, null or anything that isn't a number, which drops the hint.
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+        return None
+    return value
+
+
+class IntervalController:
+    '''
+    Decides how often metrics are sampled, heartbeats are sent and updates are checked for.
+    Heartbeats go out every heartbeat_interval seconds while usage moves, and back off (doubling, up to
+    max_heartbeat_interval) while CPU, memory and disk usage stay within change_threshold percentage points of the
+    previous heartbeat. A sample crossing cpu_threshold, memory_threshold or disk_threshold sends one straight away,
+    at most one every min_heartbeat_spacing seconds. Metrics are sampled every sample_interval seconds, and every
+    rebuild_sample_interval seconds while a rebuild runs.
+    The Studio can ask for longer intervals with "intervals": {"heartbeat": s, "updateCheck": s} in a response,
+    hints are kept within the configured bounds and stay until the Studio sends 0 or null.
+    '''
+    def __init__(self, heartbeat_interval=30, max_heartbeat_interval=300, change_threshold=5.0, cpu_threshold=90.0, memory_threshold=90.0, disk_threshold=90.0, sample_interval=1, rebuild_sample_interval=0.25, update_check_interval=60 * 60 * 8, max_update_check_interval=60 * 60 * 24, min_heartbeat_spacing=5):
+        self.heartbeat_interval = heartbeat_interval
+        self.max_heartbeat_interval = max(max_heartbeat_interval, heartbeat_interval)
+        self.change_threshold = change_threshold
+        self.thresholds = {"cpu": cpu_threshold, "memory": memory_threshold, "disk": disk_threshold}
+        self.sample_interval = sample_interval
+        self.rebuild_sample_interval = min(rebuild_sample_interval, sample_interval)
+        self.update_check_interval = update_check_interval
+        self.max_update_check_interval = max(max_update_check_interval, update_check_interval)
+        self.min_heartbeat_spacing = min_heartbeat_spacing
+
+        self.stable = 0 # Heartbeats in a row without a significant change.
+        self.last_levels = None
+        self.last_heartbeat = time.time()
+        self.breached = set() # Levels above their threshold at the last sample.
+        self.heartbeat_hint = None
+        self.update_check_hint = None
+        self.rebuilds = 0
+
+    def current_heartbeat_interval(self):
+        base = self.heartbeat_interval
+        if self.heartbeat_hint != None:
+            base = clamp(self.heartbeat_hint, self.heartbeat_interval, self.max_heartbeat_interval)
+        return min(base * 2 ** self.stable, self.max_heartbeat_interval)
+
+    def heartbeat_delay(self, now=None):
+        # Seconds until the next heartbeat is due.
+        if now == None:
+            now = time.time()
+        return max(self.last_heartbeat + self.current_heartbeat_interval() - now, 0)
+
+    def record_heartbeat(self, levels, now=None):
+        # Called with the levels of every heartbeat sent, stretches the interval while they stay the same.
+        if now == None:
+            now = time.time()
+        if self.last_levels != None and all(abs(levels[level] - self.last_levels[level]) < self.change_threshold for level in LEVELS):
+            self.stable += 1
+        else:
+            self.stable = 0
+        self.last_levels = levels
+        self.last_heartbeat = now
+
+    def record_sample(self, levels, now=None) -> bool:
+        # Returns True if a level just crossed its threshold and a heartbeat should go out now.
+        if now == None:
+            now = time.time()
+        breached = set(level for level in LEVELS if levels[level] >= self.thresholds[level])
+        crossed = breached - self.breached
+        self.breached = breached
+        if len(crossed) == 0:
+            return False
+        log.info('%s usage crossed its threshold.', ", ".join(sorted(crossed)), extra={level: levels[level] for level in crossed})
+        # Back to the shortest interval either way, so the Studio hears about it soon if not straight away.
+        self.stable = 0
+        return now - self.last_heartbeat >= self.min_heartbeat_spacing
+
+    def current_sample_interval(self):
+        return self.rebuild_sample_interval if self.rebuilds > 0 else self.sample_interval
+
+    @contextmanager
+    def rebuilding(self):
+        # Samples more often while the body runs.
+        self.rebuilds += 1
+        try:
+            yield
+        finally:
+            self.rebuilds -= 1
+
+    def current_update_check_interval(self):
+        if self.update_check_hint != None:
+            return clamp(self.update_check_hint, self.update_check_interval, self.max_update_check_interval)
+        return self.update_check_interval
+
+    def apply_hints(self, hints):
+        # Only the intervals named in hints change.
+        if "heartbeat" in hints:
+            self.heartbeat_hint = hinted_seconds(hints["heartbeat"])
+        if "updateCheck" in hints:
+            self.update_check_hint = hinted_seconds(hints["updateCheck"])
+
+    def report(self):
+        # Fields added to the heartbeat.
+        return {"heartbeatIntervalSeconds": self.current_heartbeat_interval()}
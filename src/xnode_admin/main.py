@@ -1,19 +1,40 @@
 
+import logging
 import sys
 from xnode_admin.utils import parse_all_args
+from xnode_admin.logs import setup_logging
+from xnode_admin.exporter import MetricsExporter
+from xnode_admin.studio_client import StudioClient
+from xnode_admin.config_validation import OptionIndex
+from xnode_admin.gc_policy import GarbageCollector
+from xnode_admin.generation_poller import GenerationPoller
+from xnode_admin.intervals import IntervalController
+from xnode_admin.prefetch import Prefetcher
 from xnode_admin.xnode_builder import fetch_config_studio
 
+log = logging.getLogger("xnode_admin.main")
+
 def main():
     program_args = parse_all_args()
-    print("UUID:", program_args.uuid, "Access Token:", program_args.access_token, "Remote:", program_args.remote, "StateDir:", program_args.state_directory)
+    setup_logging(program_args.log_level, program_args.log_format == "json", program_args.log_burst, program_args.log_interval)
+    # The access token is a secret, it's never logged.
+    log.info("UUID: %s Remote: %s StateDir: %s", program_args.uuid, program_args.remote, program_args.state_directory)
     state_directory, remote, uuid, access_token = program_args.state_directory, program_args.remote, program_args.uuid, program_args.access_token
 
-    print("Running in Studio mode.")
+    log.info("Running in Studio mode.")
     if program_args.uuid and program_args.access_token and program_args.remote:
         # Remote repo is the studio's URL and User key is a preshared secret.
-        fetch_config_studio(remote, uuid, access_token, state_directory)
+        if program_args.metrics_listen:
+            MetricsExporter(program_args.metrics_listen).start()
+        studio = StudioClient(remote, program_args.pool_size, program_args.connect_timeout, program_args.read_timeout)
+        garbage_collector = GarbageCollector(program_args.gc_watermark, program_args.gc_min_free, program_args.gc_max_freed, program_args.gc_keep_generations)
+        generation_poller = GenerationPoller(program_args.generation_interval, program_args.generation_max_interval, long_poll_wait=program_args.long_poll_wait, quiet_period=program_args.config_quiet_period, max_settle=program_args.config_max_settle)
+        option_index = OptionIndex.load(program_args.option_index) if program_args.option_index else None
+        prefetcher = Prefetcher(program_args.prefetch_jobs, program_args.prefetch_batch) if program_args.prefetch_jobs > 0 else None
+        intervals = IntervalController(program_args.heartbeat_interval, program_args.max_heartbeat_interval, program_args.heartbeat_change_threshold, program_args.cpu_threshold, program_args.memory_threshold, program_args.disk_threshold, sample_interval=program_args.sample_interval, rebuild_sample_interval=program_args.rebuild_sample_interval, update_check_interval=program_args.update_check_interval, max_update_check_interval=program_args.max_update_check_interval)
+        fetch_config_studio(studio, uuid, access_token, state_directory, garbage_collector, generation_poller, program_args.max_config_size * 1024 * 1024, option_index, prefetcher, intervals)
     else:
-        print("Error: Studio mode requires a uuid, access token and remote url to interact with the API.")
+        log.error("Studio mode requires a uuid, access token and remote url to interact with the API.")
         sys.exit(1)
 
 if __name__ == "__main__":
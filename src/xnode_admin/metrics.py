@@ -0,0 +1,171 @@
+import math
+import time
+
+
+class P2Quantile:
+    '''
+    Streaming quantile estimate using the P-square algorithm (Jain & Chlamtac, 1985).
+    Keeps five markers regardless of how many samples are added.
+    '''
+    def __init__(self, p):
+        self.p = p
+        self.initial = []
+        self.heights = None
+        self.positions = None
+        self.desired = None
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    def add(self, x):
+        if self.heights is None:
+            self.initial.append(x)
+            if len(self.initial) == 5:
+                self.initial.sort()
+                self.heights = self.initial
+                self.positions = [1, 2, 3, 4, 5]
+                self.desired = [1, 1 + 2 * self.p, 1 + 4 * self.p, 3 + 2 * self.p, 5]
+            return
+
+        q, n = self.heights, self.positions
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        # Move the middle markers towards their desired positions.
+        for i in range(1, 4):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                height = self._parabolic(i, d)
+                if not (q[i - 1] < height < q[i + 1]):
+                    height = self._linear(i, d)
+                q[i] = height
+                n[i] += d
+
+    def _parabolic(self, i, d):
+        q, n = self.heights, self.positions
+        return q[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+            (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    def _linear(self, i, d):
+        q, n = self.heights, self.positions
+        return q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+
+    def value(self):
+        if self.heights is None:
+            # Fewer than five samples, the exact answer is cheap.
+            if len(self.initial) == 0:
+                return 0.0
+            ordered = sorted(self.initial)
+            return ordered[min(len(ordered) - 1, int(math.ceil(self.p * len(ordered))) - 1)]
+        return self.heights[2]
+
+
+class StreamingStats:
+    # Running count, mean, min, max and p95/p99 estimates in constant memory.
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = 0.0
+        self.min = 0.0
+        self.max = 0.0
+        self.p95 = P2Quantile(0.95)
+        self.p99 = P2Quantile(0.99)
+
+    def add(self, value):
+        self.count += 1
+        self.mean += (value - self.mean) / self.count
+        if self.count == 1 or value < self.min:
+            self.min = value
+        if self.count == 1 or value > self.max:
+            self.max = value
+        self.p95.add(value)
+        self.p99.add(value)
+
+
+class RollingWindows:
+    '''
+    Averages and peaks over the last 1, 5 and 15 minutes.
+    Samples are folded into fixed time buckets stored in a ring, so memory doesn't depend on the sample rate.
+    '''
+    def __init__(self, windows=(("1m", 60), ("5m", 300), ("15m", 900)), bucket_seconds=10):
+        self.windows = windows
+        self.bucket_seconds = bucket_seconds
+        slot_count = max(seconds for _, seconds in windows) // bucket_seconds
+        # Each slot is [bucket index, sum, count, max].
+        self.slots = [[-1, 0.0, 0, 0.0] for _ in range(slot_count)]
+
+    def add(self, value, now):
+        bucket = int(now // self.bucket_seconds)
+        slot = self.slots[bucket % len(self.slots)]
+        if slot[0] != bucket:
+            slot[0], slot[1], slot[2], slot[3] = bucket, 0.0, 0, value
+        slot[1] += value
+        slot[2] += 1
+        if value > slot[3]:
+            slot[3] = value
+
+    def summary(self, now):
+        current = int(now // self.bucket_seconds)
+        result = {}
+        for name, seconds in self.windows:
+            buckets = seconds // self.bucket_seconds
+            total, count, peak = 0.0, 0, 0.0
+            for bucket, bucket_sum, bucket_count, bucket_max in self.slots:
+                if bucket_count > 0 and 0 <= current - bucket < buckets:
+                    total += bucket_sum
+                    count += bucket_count
+                    if bucket_max > peak:
+                        peak = bucket_max
+            result[name] = {
+                "avg": total / count if count > 0 else 0.0,
+                "max": peak,
+            }
+        return result
+
+
+class MetricAggregator:
+    '''
+    Aggregates samples of a single metric between heartbeats, plus rolling windows that survive across heartbeats.
+    Replaces keeping every sample in a list until the next heartbeat.
+    '''
+    def __init__(self):
+        self.interval = StreamingStats()
+        self.windows = RollingWindows()
+
+    def add(self, value, now=None):
+        if now == None:
+            now = time.time()
+        self.interval.add(value)
+        self.windows.add(value, now)
+
+    def take(self, now=None):
+        # Summary of the samples since the last take, then start a new interval.
+        if now == None:
+            now = time.time()
+        summary = {
+            "count": self.interval.count,
+            "avg": self.interval.mean,
+            "min": self.interval.min,
+            "max": self.interval.max,
+            "p95": self.interval.p95.value(),
+            "p99": self.interval.p99.value(),
+            "windows": self.windows.summary(now),
+        }
+        self.interval.reset()
+        return summary
@@ -0,0 +1,294 @@
+import json
+import logging
+import operator
+
+from xnode_admin.config_validation import compiled_types, nix_attr_name, render_value
+
+log = logging.getLogger(__name__)
+
+# Fields that end up in config.nix, everything else (name, desc, logo, tags, specs) is for the Studio UI.
+RENDERED_FIELDS = ["nixName", "options", "type", "value"]
+
+# Rendered attribute names, see attr_name, and dotted names split in their first part, the rest and the rendered
+# path (None if the rest has more parts), see split_name.
+attr_names = {}
+dotted_names = {}
+MAX_ATTR_NAMES = 4096
+NIX_NAME = operator.itemgetter("nixName")
+
+
+
+class AttrNode:
+    '''
+    An attribute set being rendered.
+    Blocks were declared as a module with options and render as "name = { ... };", the rest only exist because of
+    dotted nixNames and render as dotted paths, e.g. "serverProperties.max-players = 100;".
+    '''
+    def __init__(self, block):
+        self.block = block
+        self.children = {}
+
+
+def child_node(node, name, block):
+    child = node.children.get(name)
+    if not isinstance(child, AttrNode):
+        if child != None:
+            log.warning("Replacing value of %s with an attribute set.", name)
+        child = AttrNode(block)
+        node.children[name] = child
+    elif block:
+        child.block = True
+    return child
+
+
+def insert_option(node, option, name=None):
+    # Adds a module ({nixName, options}) or an option ({nixName, type, value}) below node, as name if given.
+    if name == None and "nixName" not in option:
+        log.warning("No nixName found in: %s", option)
+        return
+
+    path = (name if name != None else option["nixName"]).split(".")
+    for name in path[:-1]:
+        node = child_node(node, name, False)
+    name = path[-1]
+
+    if "options" in option:
+        # Repeated modules are merged into a single attribute set.
+        module = child_node(node, name, True)
+        for sub_option in option["options"]:
+            insert_option(module, sub_option)
+    elif "value" in option:
+        if name in node.children:
+            log.warning("Duplicate definition of %s, using the last one.", option["nixName"])
+        node.children[name] = render_value(option.get("type", ""), option["value"])
+
+
+def render_node(node, depth, prefix, out):
+    indent = "  " * depth
+    for name, child in node.children.items():
+        path = prefix + nix_attr_name(name)
+        if not isinstance(child, AttrNode):
+            out.append(indent + path + " = " + child + ";\n")
+        elif child.block:
+            out.append(indent + path + " = {\n")
+            render_node(child, depth + 1, "", out)
+            out.append(indent + "};\n")
+        else:
+            render_node(child, depth, path + ".", out)
+
+
+def attr_name(name):
+    # nix_attr_name, memoized: the same option names come back in every config.
+    text = attr_names.get(name)
+    if text == None:
+        if len(attr_names) >= MAX_ATTR_NAMES:
+            attr_names.clear()
+        text = attr_names[name] = nix_attr_name(name)
+    return text
+
+
+def split_name(name):
+    parts = dotted_names.get(name)
+    if parts == None:
+        if len(dotted_names) >= MAX_ATTR_NAMES:
+            dotted_names.clear()
+        first, rest = name.split(".", 1)
+        path = None if "." in rest else attr_name(first) + "." + attr_name(rest)
+        parts = dotted_names[name] = (first, rest, path)
+    return parts
+
+
+def named_options(options):
+    # (nixName, option) pairs, options without a nixName are left out.
+    try:
+        return list(zip(map(NIX_NAME, options), options))
+    except KeyError:
+        pass
+    named = []
+    for option in options:
+        if "nixName" in option:
+            named.append((option["nixName"], option))
+        else:
+            log.warning("No nixName found in: %s", option)
+    return named
+
+
+class OptionGroup:
+    '''
+    Options sharing the first part of their nixName in one attribute set. While they only set distinct plain names
+    below it, e.g. serverProperties.max-players and serverProperties.motd, their lines are kept as they come and
+    written in that order. Anything else (blocks, deeper or repeated names) is merged through the attribute tree.
+    '''
+    def __init__(self, position):
+        self.position = position # Of the first option with this first part.
+        self.lines = {} # By the rest of the name.
+        self.simple = True
+
+
+def render_level(named, depth, prefix, out):
+    # Renders a list of (name, option) pairs of one attribute set straight to text, in the order the attribute tree
+    # would. Names are grouped by their first part, a single plain name is written as it is, see OptionGroup for the
+    # rest.
+    indent = "  " * depth
+    lead = indent + prefix
+    slots = [] # The text of a plain name, or an OptionGroup.
+    positions = {}
+    groups = {}
+    for name, option in named:
+        if "." in name:
+            name, rest, path = dotted_names.get(name) or split_name(name)
+            group = groups.get(name)
+            if group == None:
+                count = len(slots)
+                position = positions.setdefault(name, count)
+                group = groups[name] = OptionGroup(position)
+                if position == count:
+                    slots.append(group)
+                else:
+                    # A plain name came first.
+                    slots[position] = group
+                    group.simple = False
+            if group.simple:
+                if path == None or "options" in option or "value" not in option or rest in group.lines:
+                    group.simple = False
+                else:
+                    try:
+                        value = compiled_types[option.get("type", "")](option["value"])
+                    except (KeyError, TypeError):
+                        value = render_value(option.get("type", ""), option["value"])
+                    group.lines[rest] = lead + path + " = " + value + ";\n"
+            continue
+
+        if "options" in option:
+            text = lead + (attr_names.get(name) or attr_name(name)) + " = {\n" + render_block(option["options"], depth + 1) + indent + "};\n"
+        elif "value" in option:
+            try:
+                value = compiled_types[option.get("type", "")](option["value"])
+            except (KeyError, TypeError):
+                value = render_value(option.get("type", ""), option["value"])
+            text = lead + (attr_names.get(name) or attr_name(name)) + " = " + value + ";\n"
+        else:
+            continue
+        position = positions.get(name)
+        if position == None:
+            positions[name] = len(slots)
+            slots.append(text)
+        elif name in groups:
+            groups[name].simple = False
+        else:
+            # The same plain name again.
+            group = groups[name] = OptionGroup(position)
+            slots[position] = group
+            group.simple = False
+
+    if len(groups) == 0:
+        out.extend(slots)
+        return
+    start = len(out)
+    out.extend(slots)
+    # Groups are written where their first part first appeared, from the back so the positions stay valid.
+    for name, group in sorted(groups.items(), key=lambda item: item[1].position, reverse=True):
+        if group.simple:
+            lines = list(group.lines.values())
+        else:
+            lines = []
+            pairs = []
+            for full_name, option in named:
+                first, dot, rest = full_name.partition(".")
+                if first == name:
+                    pairs.append((rest if dot else None, option))
+            render_group(name, pairs, depth, prefix, lines)
+        out[start + group.position:start + group.position + 1] = lines
+
+
+def render_group(name, group, depth, prefix, out):
+    # Renders the (rest of the name, option) pairs sharing the first part name.
+    if any(rest == None and "options" not in option for rest, option in group):
+        root = AttrNode(False)
+        for rest, option in group:
+            insert_option(root, option, name if rest == None else name + "." + rest)
+        render_node(root, depth, prefix, out)
+    elif any(rest == None for rest, option in group):
+        # Declared as a module, dotted names below it are merged into its block.
+        below = []
+        for rest, option in group:
+            if rest == None:
+                below.extend(named_options(option["options"]))
+            else:
+                below.append((rest, option))
+        out.append("  " * depth + prefix + attr_name(name) + " = {\n")
+        render_level(below, depth + 1, "", out)
+        out.append("  " * depth + "};\n")
+    else:
+        render_level(group, depth, prefix + attr_name(name) + ".", out)
+
+
+def render_block(options, depth):
+    out = []
+    render_level(named_options(options), depth, "", out)
+    return "".join(out)
+
+
+def render_nix_modules(modules, depth=1):
+    # Renders a list of Studio modules (e.g. the "services" list) to nix attribute definitions.
+    return render_block(modules, depth)
+
+
+def render_studio_config(studio_json_config, render_modules=render_nix_modules):
+    # Renders a full Studio config ({"services": [...], "networking": [...]}) to the contents of config.nix.
+    out = ["{ config, pkgs, ... }:\n{\n  "]
+    for module_config in studio_json_config:
+        # config_type eg. services, users or networking
+        out.append(module_config + " = {\n  ")
+        out.append(render_modules(studio_json_config[module_config]))
+        out.append("};\n")
+    out.append("\n}")
+    return "".join(out)
+
+
+def rendered_fields(json_nix):
+    if isinstance(json_nix, list):
+        return [rendered_fields(item) for item in json_nix]
+    if isinstance(json_nix, dict):
+        return {key: rendered_fields(json_nix[key]) for key in RENDERED_FIELDS if key in json_nix}
+    return json_nix
+
+
+class IncrementalRenderer:
+    '''
+    Renders Studio configs, reusing the text of every top-level block (e.g. one service) that didn't change since
+    the previous render. Blocks are keyed on their rendered fields only, so UI-only edits never cause a re-render.
+    The output is identical to render_studio_config.
+    '''
+    def __init__(self):
+        self.blocks = {}
+        self.rendered = 0
+        self.reused = 0
+
+    def render(self, studio_json_config):
+        previous_blocks = self.blocks
+        self.blocks = {}
+
+        def render_modules(modules):
+            # Modules are grouped by the first part of their nixName, groups never affect each other's output.
+            groups = {}
+            for module in modules:
+                if "nixName" not in module:
+                    log.warning("No nixName found in: %s", module)
+                    continue
+                groups.setdefault(module["nixName"].split(".")[0], []).append(module)
+
+            out = []
+            for group in groups.values():
+                key = json.dumps(rendered_fields(group), sort_keys=True)
+                text = previous_blocks.get(key)
+                if text == None:
+                    text = render_nix_modules(group)
+                    self.rendered += 1
+                else:
+                    self.reused += 1
+                self.blocks[key] = text
+                out.append(text)
+            return "".join(out)
+
+        return render_studio_config(studio_json_config, render_modules)
@@ -0,0 +1,136 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+def merge_heartbeats(older, newer, older_count, newer_count):
+    # Folds two heartbeats (or summaries of older_count and newer_count heartbeats) into one.
+    merged = dict(newer)
+    for key, old_value in older.items():
+        new_value = newer.get(key)
+        if not isinstance(old_value, (int, float)) or not isinstance(new_value, (int, float)) or isinstance(new_value, bool):
+            continue
+        if "Peek" in key or key.endswith("P95") or key.endswith("P99"):
+            merged[key] = max(old_value, new_value)
+        elif key.endswith("Min"):
+            merged[key] = min(old_value, new_value)
+        elif key.startswith("cpuPercent") or (key.startswith("ramMb") and key != "ramMbTotal"):
+            merged[key] = (old_value * older_count + new_value * newer_count) / (older_count + newer_count)
+        # Anything else (totals, storage, counters) is a current value, the newest one wins.
+    return merged
+
+
+class Outbox:
+    '''
+    Heartbeats and status changes that couldn't be delivered, kept in a small sqlite database in the state directory
+    so they survive restarts. Delivery is strictly in order: once something is queued, newer messages queue behind it.
+    While offline, older heartbeats are compacted into a single summary and repeated statuses (e.g. build progress)
+    replace each other, and the outbox never holds more than max_messages, dropping the oldest first.
+    '''
+    def __init__(self, state_directory, max_messages=500, keep_heartbeats=10):
+        self.path = os.path.join(state_directory, "outbox.sqlite")
+        self.max_messages = max_messages
+        self.keep_heartbeats = keep_heartbeats # Newest heartbeats kept as they are, older ones are summarised.
+        self.dropped = 0
+        self.in_flight = 0 # Highest id handed to send_batch and not deleted yet, those rows must not change.
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, created REAL NOT NULL, message TEXT NOT NULL)")
+
+    def pending(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    def put(self, kind, message, now=None):
+        if now == None:
+            now = time.time()
+        message = dict(message)
+        message["queuedAt"] = now
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                last = self.db.execute("SELECT id, kind, message FROM outbox ORDER BY id DESC LIMIT 1").fetchone()
+                if kind == "status" and last != None and last[0] > self.in_flight and last[1] == "status" and json.loads(last[2]).get("status") == message.get("status"):
+                    # Same status with newer progress, only the latest is worth delivering.
+                    self.db.execute("UPDATE outbox SET message = ?, created = ? WHERE id = ?", (json.dumps(message), now, last[0]))
+                else:
+                    self.db.execute("INSERT INTO outbox (kind, created, message) VALUES (?, ?, ?)", (kind, now, json.dumps(message)))
+                if kind == "heartbeat":
+                    self.compact_heartbeats()
+                self.enforce_limit()
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def compact_heartbeats(self):
+        rows = self.db.execute("SELECT id, created, message FROM outbox WHERE kind = 'heartbeat' ORDER BY id").fetchall()
+        if len(rows) <= self.keep_heartbeats + 1:
+            return
+
+        # Everything but the newest keep_heartbeats becomes one summary, in the place of the newest summarised heartbeat.
+        summarised = rows[:len(rows) - self.keep_heartbeats]
+        if summarised[0][0] <= self.in_flight:
+            # Being delivered right now, compact on the next put.
+            return
+        summary, count, first_seen = None, 0, None
+        for row_id, created, message in summarised:
+            heartbeat = json.loads(message)
+            offline = heartbeat.pop("offlineSummary", {"heartbeats": 1, "from": created, "to": created})
+            if summary == None:
+                summary, count, first_seen = heartbeat, offline["heartbeats"], offline["from"]
+            else:
+                summary = merge_heartbeats(summary, heartbeat, count, offline["heartbeats"])
+                count += offline["heartbeats"]
+        last_id, last_created = summarised[-1][0], summarised[-1][1]
+        summary["offlineSummary"] = {"heartbeats": count, "from": first_seen, "to": last_created}
+
+        self.db.execute("DELETE FROM outbox WHERE kind = 'heartbeat' AND id < ?", (last_id,))
+        self.db.execute("UPDATE outbox SET message = ? WHERE id = ?", (json.dumps(summary), last_id))
+
+    def enforce_limit(self):
+        excess = self.db.execute("SELECT COUNT(*) FROM outbox").fetchone()[0] - self.max_messages
+        if excess > 0:
+            self.db.execute("DELETE FROM outbox WHERE id IN (SELECT id FROM outbox ORDER BY id LIMIT ?)", (excess,))
+            self.dropped += excess
+            log.warning("Outbox is full, dropped the %s oldest messages.", excess)
+
+    def flush(self, send_batch, batch_size=50):
+        '''
+        Delivers queued messages oldest first, batch_size at a time. send_batch gets a list of (kind, message) and
+        returns how many of them, from the start, were delivered. Stops at the first batch that isn't delivered in
+        full and returns the number of messages delivered.
+        '''
+        delivered = 0
+        while True:
+            with self.lock:
+                rows = self.db.execute("SELECT id, kind, message FROM outbox ORDER BY id LIMIT ?", (batch_size,)).fetchall()
+                if len(rows) > 0:
+                    self.in_flight = rows[-1][0]
+            if len(rows) == 0:
+                return delivered
+
+            sent = 0
+            try:
+                sent = send_batch([(kind, json.loads(message)) for _, kind, message in rows])
+            finally:
+                with self.lock:
+                    if sent > 0:
+                        self.db.execute("DELETE FROM outbox WHERE id <= ?", (rows[sent - 1][0],))
+                    self.in_flight = 0
+            delivered += sent
+            if sent < len(rows):
+                if delivered > 0:
+                    log.info("Delivered %s queued messages, the rest stays queued.", delivered)
+                return delivered
+
+    def close(self):
+        with self.lock:
+            self.db.close()
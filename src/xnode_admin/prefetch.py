@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import re
+import time
+
+from xnode_admin import exporter
+from xnode_admin.commands import run_command
+from xnode_admin.rebuild_progress import PATH_PLANNED, PATHS_PLANNED, parse_size
+
+log = logging.getLogger(__name__)
+
+# Headers of the lists nix prints for a dry run, the store paths follow one per line, indented.
+FETCH_LIST = re.compile(r"^th(?:ese|is)(?: \d+)? paths? will be fetched")
+BUILD_LIST = re.compile(r"^th(?:ese|is)(?: \d+)? derivations? will be built")
+STORE_PATH = re.compile(r"^\s+(/nix/store/\S+)$")
+
+
+def system_installable(state_directory):
+    # The attribute nixos-rebuild build realises for the xnode flake.
+    return state_directory + "#nixosConfigurations.xnode.config.system.build.toplevel"
+
+
+def parse_dry_run(output):
+    # Returns (paths to fetch, planned download size in bytes, derivations to build) from nix's dry run output.
+    paths, derivations = [], []
+    download_bytes = 0
+    current = None
+    for line in output.splitlines():
+        if FETCH_LIST.match(line):
+            current = paths
+            match = PATHS_PLANNED.match(line)
+            if match and match.group(2):
+                download_bytes += parse_size(match.group(2), match.group(3))
+            match = PATH_PLANNED.match(line)
+            if match and match.group(1):
+                download_bytes += parse_size(match.group(1), match.group(2))
+            continue
+        if BUILD_LIST.match(line):
+            current = derivations
+            continue
+        match = STORE_PATH.match(line)
+        if match and current != None:
+            current.append(match.group(1))
+        else:
+            current = None
+    return paths, download_bytes, derivations
+
+
+class PrefetchProgress:
+    '''
+    Progress of a prefetch, reported like a RebuildProgress. Nix only plans the total download size, so the
+    bytes fetched so far are estimated from the share of paths done.
+    '''
+    def __init__(self, paths=(), download_bytes=0, derivations=()):
+        self.started = time.time()
+        self.paths_total = len(paths)
+        self.paths_fetched = 0
+        self.paths_failed = 0
+        self.download_bytes = download_bytes
+        self.derivations_total = len(derivations)
+
+    def fetched_bytes(self):
+        if self.paths_total == 0:
+            return 0
+        return self.download_bytes * self.paths_fetched // self.paths_total
+
+    def as_dict(self):
+        return {
+            "phase": "prefetch",
+            "pathsFetched": self.paths_fetched,
+            "pathsFailed": self.paths_failed,
+            "pathsTotal": self.paths_total,
+            "downloadBytes": self.download_bytes,
+            "fetchedBytes": self.fetched_bytes(),
+            "derivationsTotal": self.derivations_total,
+            "elapsedSeconds": time.time() - self.started,
+        }
+
+
+class Prefetcher:
+    '''
+    Downloads the missing store paths of the next system before nixos-rebuild builds it. Evaluating the system
+    with a dry run lists what the substituters have to send, parallelism nix-store --realise processes then fetch
+    those in batches of batch_size paths, instead of nixos-rebuild downloading them as part of one build.
+    Prefetching is best effort, anything it misses is still fetched by the build.
+    '''
+    def __init__(self, parallelism=4, batch_size=16):
+        self.parallelism = parallelism
+        self.batch_size = batch_size
+
+    async def plan(self, state_directory):
+        # Evaluates the system and returns (paths, download_bytes, derivations), or None if evaluation failed.
+        returncode, stdout, stderr = await run_command(['/run/current-system/sw/bin/nix', 'build', '--dry-run', '--impure', '--no-link', system_installable(state_directory)])
+        output = stderr.decode('utf-8', errors='replace') + stdout.decode('utf-8', errors='replace')
+        if returncode != 0:
+            log.warning('Couldn\'t evaluate the system to prefetch it: %s', output[-4096:])
+            return None
+        return parse_dry_run(output)
+
+    async def fetch(self, paths, progress, on_progress=None, progress_interval=5):
+        # Realises paths with up to parallelism concurrent nix-store processes, updating progress as batches finish.
+        batches = [paths[i:i + self.batch_size] for i in range(0, len(paths), self.batch_size)]
+        last_report = time.time()
+
+        async def worker():
+            nonlocal last_report
+            while len(batches) > 0:
+                batch = batches.pop(0)
+                returncode, stdout, stderr = await run_command(['/run/current-system/sw/bin/nix-store', '--realise'] + batch)
+                if returncode == 0:
+                    progress.paths_fetched += len(batch)
+                    exporter.prefetched_paths.inc(len(batch), result="ok")
+                else:
+                    progress.paths_failed += len(batch)
+                    exporter.prefetched_paths.inc(len(batch), result="failed")
+                    log.warning('Failed to prefetch %s paths, the build will fetch them: %s', len(batch), stderr.decode('utf-8', errors='replace')[-1024:])
+                if on_progress != None and last_report + progress_interval < time.time():
+                    last_report = time.time()
+                    await on_progress(progress)
+
+        await asyncio.gather(*[worker() for _ in range(min(self.parallelism, len(batches)))])
+
+    async def prefetch(self, state_directory, on_progress=None, progress_interval=5):
+        # Fetches the closure of the system in state_directory, returns its PrefetchProgress or None if it couldn't be planned.
+        started = time.time()
+        plan = await self.plan(state_directory)
+        if plan == None:
+            return None
+        paths, download_bytes, derivations = plan
+        progress = PrefetchProgress(paths, download_bytes, derivations)
+        log.info('Prefetching %s paths (%s bytes) with %s jobs, %s derivations left to build.', len(paths), download_bytes, self.parallelism, len(derivations))
+
+        await self.fetch(paths, progress, on_progress, progress_interval)
+        if on_progress != None:
+            await on_progress(progress)
+        exporter.rebuild_seconds.observe(time.time() - started, phase="prefetch")
+        exporter.prefetched_bytes.inc(progress.fetched_bytes())
+        log.info('Prefetched %s of %s paths in %.1f seconds.', progress.paths_fetched, progress.paths_total, time.time() - started, extra=progress.as_dict())
+        return progress
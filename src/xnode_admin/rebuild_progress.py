@@ -0,0 +1,94 @@
+import re
+import time
+from collections import deque
+
+# Lines printed by nix while realising a system closure.
+DERIVATIONS_PLANNED = re.compile(r"^these (\d+) derivations will be built")
+DERIVATION_PLANNED = re.compile(r"^this derivation will be built")
+PATHS_PLANNED = re.compile(r"^these (\d+) paths will be fetched(?: \(([\d.]+) (\w+) download)?")
+PATH_PLANNED = re.compile(r"^this path will be fetched(?: \(([\d.]+) (\w+) download)?")
+DERIVATION_BUILDING = re.compile(r"^building '(/nix/store/[^']+\.drv)'")
+PATH_COPYING = re.compile(r"^copying path '(/nix/store/[^']+)'")
+
+SIZE_UNITS = {
+    "B": 1,
+    "KiB": 1024,
+    "MiB": 1024 ** 2,
+    "GiB": 1024 ** 3,
+    "TiB": 1024 ** 4,
+}
+
+
+def parse_size(amount, unit):
+    return int(float(amount) * SIZE_UNITS.get(unit, 1))
+
+
+class RebuildProgress:
+    '''
+    Tracks the progress of a nixos-rebuild from its output, one line at a time.
+    Only the last log_lines lines are kept, so memory stays flat no matter how long the build runs.
+    '''
+    def __init__(self, log_lines=200, max_line_length=1000):
+        self.log = deque(maxlen=log_lines)
+        self.max_line_length = max_line_length
+        self.started = time.time()
+
+        self.derivations_total = 0
+        self.derivations_built = 0
+        self.paths_total = 0
+        self.paths_copied = 0
+        self.download_bytes = 0
+        self.current = ""
+
+    def feed(self, line: str) -> bool:
+        # Returns True if the line changed the progress counters.
+        line = line.rstrip()[:self.max_line_length]
+        self.log.append(line)
+
+        match = DERIVATIONS_PLANNED.match(line)
+        if match:
+            self.derivations_total += int(match.group(1))
+            return True
+        if DERIVATION_PLANNED.match(line):
+            self.derivations_total += 1
+            return True
+
+        match = PATHS_PLANNED.match(line)
+        if match:
+            self.paths_total += int(match.group(1))
+            if match.group(2):
+                self.download_bytes += parse_size(match.group(2), match.group(3))
+            return True
+        match = PATH_PLANNED.match(line)
+        if match:
+            self.paths_total += 1
+            if match.group(1):
+                self.download_bytes += parse_size(match.group(1), match.group(2))
+            return True
+
+        match = DERIVATION_BUILDING.match(line)
+        if match:
+            self.derivations_built += 1
+            self.current = match.group(1)
+            return True
+        match = PATH_COPYING.match(line)
+        if match:
+            self.paths_copied += 1
+            self.current = match.group(1)
+            return True
+
+        return False
+
+    def tail(self):
+        return "\n".join(self.log)
+
+    def as_dict(self):
+        return {
+            "derivationsBuilt": self.derivations_built,
+            "derivationsTotal": self.derivations_total,
+            "pathsCopied": self.paths_copied,
+            "pathsTotal": self.paths_total,
+            "downloadBytes": self.download_bytes,
+            "current": self.current,
+            "elapsedSeconds": time.time() - self.started,
+        }
@@ -0,0 +1,129 @@
+import os
+import time
+
+# Studio services whose systemd unit isn't simply "<nixName>.service".
+SERVICE_UNITS = {
+    "openssh": "sshd.service",
+}
+
+
+def service_unit(nix_name):
+    return SERVICE_UNITS.get(nix_name, nix_name + ".service")
+
+
+def config_service_names(studio_json_config):
+    # The nixName of every service in a Studio config.
+    names = []
+    for submodule in studio_json_config.get("services", []):
+        if "nixName" in submodule:
+            names.append(submodule["nixName"])
+    return names
+
+
+def read_key_values(path):
+    # Parses flat "key value" files like cpu.stat.
+    values = {}
+    with open(path, "r") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) == 2:
+                values[parts[0]] = int(parts[1])
+    return values
+
+
+def read_io_bytes(path):
+    # Sums rbytes/wbytes over every device in io.stat.
+    read_bytes, write_bytes = 0, 0
+    with open(path, "r") as f:
+        for line in f:
+            for field in line.split()[1:]:
+                key, _, value = field.partition("=")
+                if key == "rbytes":
+                    read_bytes += int(value)
+                elif key == "wbytes":
+                    write_bytes += int(value)
+    return read_bytes, write_bytes
+
+
+class ServiceCollector:
+    '''
+    Per-service CPU, memory, IO and restart accounting read straight from the systemd cgroup tree.
+    Only the counters of the services in the applied config are read, and only the change since the previous
+    collection is reported, so every heartbeat costs a handful of small sysfs reads.
+    '''
+    def __init__(self, cgroup_root="/sys/fs/cgroup", slice_name="system.slice"):
+        self.slice_path = os.path.join(cgroup_root, slice_name)
+        self.units = {}
+        self.previous = {}
+        self.restarts = {}
+
+    def set_services(self, nix_names):
+        self.units = {nix_name: service_unit(nix_name) for nix_name in nix_names}
+        # Forget counters of services that aren't configured anymore.
+        for unit in list(self.previous.keys()):
+            if unit not in self.units.values():
+                del self.previous[unit]
+                self.restarts.pop(unit, None)
+
+    def read_counters(self, unit):
+        unit_path = os.path.join(self.slice_path, unit)
+        try:
+            cgroup_id = os.stat(unit_path).st_ino
+            cpu_usec = read_key_values(os.path.join(unit_path, "cpu.stat")).get("usage_usec", 0)
+            with open(os.path.join(unit_path, "memory.current"), "r") as f:
+                memory_bytes = int(f.read().strip())
+            read_bytes, write_bytes = 0, 0
+            if os.path.exists(os.path.join(unit_path, "io.stat")):
+                read_bytes, write_bytes = read_io_bytes(os.path.join(unit_path, "io.stat"))
+        except (OSError, ValueError):
+            # Unit is stopped (no cgroup) or the cgroup was removed mid-read.
+            return None
+        return {
+            "cgroupId": cgroup_id,
+            "cpuUsec": cpu_usec,
+            "memoryBytes": memory_bytes,
+            "readBytes": read_bytes,
+            "writeBytes": write_bytes,
+        }
+
+    def collect(self, now=None):
+        if now == None:
+            now = time.monotonic()
+        cpu_count = os.cpu_count() or 1
+
+        services = {}
+        for nix_name, unit in self.units.items():
+            counters = self.read_counters(unit)
+            if counters == None:
+                services[nix_name] = {"unit": unit, "active": False, "restarts": self.restarts.get(unit, 0)}
+                continue
+
+            previous = self.previous.get(unit)
+            # systemd creates a fresh cgroup when a unit (re)starts, so a new cgroup or counters going backwards means a restart.
+            restarted = previous != None and (
+                previous["cgroupId"] != counters["cgroupId"] or counters["cpuUsec"] < previous["cpuUsec"]
+            )
+            if restarted:
+                self.restarts[unit] = self.restarts.get(unit, 0) + 1
+
+            cpu_percent, read_delta, write_delta = 0.0, 0, 0
+            if previous != None and not restarted:
+                elapsed_usec = (now - previous["time"]) * 1000000
+                if elapsed_usec > 0:
+                    cpu_percent = (counters["cpuUsec"] - previous["cpuUsec"]) / elapsed_usec / cpu_count * 100
+                read_delta = counters["readBytes"] - previous["readBytes"]
+                write_delta = counters["writeBytes"] - previous["writeBytes"]
+
+            counters["time"] = now
+            self.previous[unit] = counters
+
+            services[nix_name] = {
+                "unit": unit,
+                "active": True,
+                "cpuPercent": cpu_percent,
+                "ramMbUsed": counters["memoryBytes"] / (1024 * 1024),
+                "ioReadBytes": read_delta,
+                "ioWriteBytes": write_delta,
+                "restarts": self.restarts.get(unit, 0),
+            }
+        return services
@@ -0,0 +1,91 @@
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from xnode_admin import exporter
+
+
+class EndpointStats:
+    # Latency counters for a single Studio endpoint.
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.last_seconds = 0.0
+
+    def record(self, seconds, ok):
+        self.calls += 1
+        if not ok:
+            self.failures += 1
+        self.total_seconds += seconds
+        self.last_seconds = seconds
+        if seconds > self.max_seconds:
+            self.max_seconds = seconds
+
+    def as_dict(self):
+        avg_seconds = 0.0
+        if self.calls > 0:
+            avg_seconds = self.total_seconds / self.calls
+        return {
+            "calls": self.calls,
+            "failures": self.failures,
+            "avgSeconds": avg_seconds,
+            "maxSeconds": self.max_seconds,
+            "lastSeconds": self.last_seconds,
+        }
+
+
+class StudioClient:
+    '''
+    Owns a single keep-alive connection pool to the Studio functions API.
+    Every call goes through the same requests.Session, so the TCP and TLS handshake is only paid
+    when the pool has to open a new connection, and every call is bounded by the connect/read timeouts.
+    '''
+    def __init__(self, studio_url, pool_size=4, connect_timeout=5.0, read_timeout=30.0):
+        self.url = studio_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    def request(self, method, endpoint, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        start = time.monotonic()
+        ok = False
+        try:
+            response = self.session.request(method, self.url + endpoint, **kwargs)
+            ok = response.ok
+            return response
+        finally:
+            self._record(endpoint, time.monotonic() - start, ok)
+
+    def get(self, endpoint, **kwargs):
+        return self.request('GET', endpoint, **kwargs)
+
+    def post(self, endpoint, **kwargs):
+        return self.request('POST', endpoint, **kwargs)
+
+    def _record(self, endpoint, seconds, ok):
+        exporter.studio_request_seconds.observe(seconds, endpoint=endpoint)
+        if not ok:
+            exporter.studio_request_failures.inc(endpoint=endpoint)
+        with self._stats_lock:
+            if endpoint not in self._stats:
+                self._stats[endpoint] = EndpointStats()
+            self._stats[endpoint].record(seconds, ok)
+
+    def latency_stats(self):
+        # Snapshot of the per-endpoint counters, safe to serialize.
+        with self._stats_lock:
+            return {endpoint: stats.as_dict() for endpoint, stats in self._stats.items()}
+
+    def close(self):
+        self.session.close()
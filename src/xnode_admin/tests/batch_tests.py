@@ -0,0 +1,181 @@
+import asyncio
+import shutil
+import tempfile
+from xnode_admin import xnode_builder
+from xnode_admin.generation_poller import GenerationPoller
+from xnode_admin.intervals import IntervalController
+from xnode_admin.signing import MessageSigner
+from xnode_admin.studio_client import StudioClient
+from xnode_admin.xnode_builder import BatchSupport, StudioAgent, exchange_messages
+from xnode_admin.tests import mock_studio_tests as mock_studio
+
+async def fake_update(state_directory, on_progress=None, timings=None, prefetcher=None):
+    return True
+
+def polling_agent(url, state_directory):
+    # Long-polling off, so generation checks ride along with heartbeats.
+    agent = StudioAgent(StudioClient(url), "uuid", mock_studio.xnode_access_token, state_directory, generation_poller=GenerationPoller(long_poll_wait=0))
+    agent.prepare()
+    return agent
+
+def reset():
+    mock_studio.requests_received.clear()
+    mock_studio.heartbeats.clear()
+    mock_studio.statuses.clear()
+    mock_studio.generation.update({"configWant": 0, "configHave": 0, "updateWant": 0, "updateHave": 0})
+
+def test_batched_round_trips():
+    state_directory = tempfile.mkdtemp()
+    mock_studio.batch_endpoint = True
+    server, url = mock_studio.serve_in_background()
+    os_update = xnode_builder.os_update
+    xnode_builder.os_update = fake_update
+    try:
+        async def run():
+            agent = polling_agent(url, state_directory)
+
+            # Heartbeat and generation check are one request.
+            reset()
+            await agent.heartbeat(False)
+            assert mock_studio.requests_received == {"/xnodes/functions/pushXnodeBatch": 1}
+            assert len(mock_studio.heartbeats) == 1
+            assert agent.generation_hint == None
+
+            # A pending update seen with the heartbeat wakes the generation task with the values it needs.
+            mock_studio.bump_generation_values(update=1)
+            await agent.heartbeat(False)
+            assert agent.generation_wakeup.is_set()
+            assert agent.generation_hint["updateWant"] == 1
+
+            # Pushing the update generation, the heartbeat and the status is one request too.
+            reset()
+            mock_studio.generation["updateWant"] = 1
+            agent.wants_update = True
+            await agent.apply_generation(dict(mock_studio.generation))
+            assert mock_studio.requests_received == {"/xnodes/functions/pushXnodeBatch": 2}
+            assert mock_studio.generation["updateHave"] == 1
+            assert mock_studio.statuses == ["updating", "online"]
+            assert "wantUpdate" not in mock_studio.heartbeats[0]
+
+            # Queued messages are flushed in one batch.
+            reset()
+            for i in range(5):
+                agent.outbox.put("status", {"id": "uuid", "status": "status " + str(i)})
+            assert await agent.flush_outbox()
+            assert mock_studio.requests_received == {"/xnodes/functions/pushXnodeBatch": 1}
+            assert mock_studio.statuses == ["status " + str(i) for i in range(5)]
+            agent.outbox.close()
+
+        asyncio.run(run())
+    finally:
+        xnode_builder.os_update = os_update
+        server.shutdown()
+        shutil.rmtree(state_directory)
+
+def test_fallback_without_batch_endpoint():
+    state_directory = tempfile.mkdtemp()
+    mock_studio.batch_endpoint = False
+    server, url = mock_studio.serve_in_background()
+    try:
+        async def run():
+            agent = polling_agent(url, state_directory)
+            reset()
+            await agent.heartbeat(False)
+            await agent.heartbeat(False)
+            # The batch endpoint is only tried once, after that every message is its own call.
+            assert mock_studio.requests_received == {
+                "/xnodes/functions/pushXnodeBatch": 1,
+                "/xnodes/functions/pushXnodeHeartbeat": 2,
+                "/xnodes/functions/getXnodeGeneration": 2,
+            }
+            assert len(mock_studio.heartbeats) == 2
+            assert not agent.batch_support.supported
+            agent.outbox.close()
+
+        asyncio.run(run())
+    finally:
+        mock_studio.batch_endpoint = True
+        server.shutdown()
+        shutil.rmtree(state_directory)
+
+def test_fallback_stops_at_failed_update_push():
+    state_directory = tempfile.mkdtemp()
+    server, url = mock_studio.serve_in_background()
+    calls = []
+    def rejecting_update(studio, signer, endpoint, body):
+        calls.append(endpoint)
+        return {"ok": endpoint != "pushXnodeGenerationUpdate"}
+    call_endpoint = xnode_builder.call_endpoint
+    xnode_builder.call_endpoint = rejecting_update
+    try:
+        async def run():
+            agent = polling_agent(url, state_directory)
+            agent.batch_support.record(False)
+            agent.wants_update = True
+            await agent.apply_generation({"configWant": 0, "configHave": 0, "updateWant": 1, "updateHave": 0})
+            # The heartbeat and the "updating" status aren't sent or queued, only the status going back online.
+            assert calls == ["pushXnodeGenerationUpdate", "pushXnodeStatus"]
+            assert agent.outbox.pending() == 0
+            assert agent.wants_update
+            agent.outbox.close()
+
+        asyncio.run(run())
+    finally:
+        xnode_builder.call_endpoint = call_endpoint
+        server.shutdown()
+        shutil.rmtree(state_directory)
+
+def test_piggyback_replaces_polls():
+    state_directory = tempfile.mkdtemp()
+    server, url = mock_studio.serve_in_background()
+    try:
+        # Heartbeats come more often than generation polls, so after the first poll they carry every check.
+        poller = GenerationPoller(base_interval=0.4, max_interval=0.4, jitter=0, long_poll_wait=0, quiet_period=0)
+        intervals = IntervalController(heartbeat_interval=0.25, max_heartbeat_interval=0.25)
+        agent = StudioAgent(StudioClient(url), "uuid", mock_studio.xnode_access_token, state_directory, generation_poller=poller, intervals=intervals)
+
+        async def run():
+            agent.prepare()
+            tasks = asyncio.gather(agent.heartbeat_task(), agent.generation_task())
+            try:
+                await asyncio.wait_for(tasks, 2)
+            except asyncio.TimeoutError:
+                pass
+        reset()
+        asyncio.run(run())
+        assert mock_studio.requests_received["/xnodes/functions/getXnodeGeneration"] == 1, mock_studio.requests_received
+        assert len(mock_studio.heartbeats) >= 6
+
+        # A check answered without a JSON body doesn't take the heartbeat down with it.
+        exchange = xnode_builder.exchange_messages
+        xnode_builder.exchange_messages = lambda *args, **kwargs: [{"ok": True}, {"ok": True}]
+        try:
+            async def heartbeat():
+                agent.prepare()
+                await agent.heartbeat(False)
+            asyncio.run(heartbeat())
+        finally:
+            xnode_builder.exchange_messages = exchange
+        agent.outbox.close()
+    finally:
+        server.shutdown()
+        shutil.rmtree(state_directory)
+
+def test_wrong_key_is_a_failure():
+    server, url = mock_studio.serve_in_background()
+    try:
+        support = BatchSupport()
+        results = exchange_messages(StudioClient(url), "uuid", MessageSigner(bytes(32)), [("pushXnodeStatus", {"id": "uuid", "status": "online"})], support)
+        assert results == [{"ok": False}]
+        # Rejected, not missing: the batch endpoint is still used.
+        assert support.supported
+    finally:
+        server.shutdown()
+
+if __name__ == "__main__":
+    test_batched_round_trips()
+    test_fallback_without_batch_endpoint()
+    test_fallback_stops_at_failed_update_push()
+    test_piggyback_replaces_polls()
+    test_wrong_key_is_a_failure()
+    print("Batch tests passed.")
@@ -0,0 +1,127 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+from xnode_admin import config_cache
+from xnode_admin import xnode_builder
+from xnode_admin.checkpoint import Checkpoint
+from xnode_admin.studio_client import StudioClient
+from xnode_admin.xnode_builder import StudioAgent
+from xnode_admin.tests import mock_studio_tests as mock_studio
+
+# No nix here: count rebuilds instead of running them, and pretend which system is running.
+rebuilds = []
+running_system = "/nix/store/aaaa-nixos-system-xnode"
+
+async def fake_rebuild(state_directory, on_progress=None, progress_interval=5, timings=None):
+    rebuilds.append(state_directory)
+    return True
+
+def fake_current_system_path():
+    return running_system
+
+def start(url, state_directory):
+    # Runs the agent up to its main loop and returns it with the time that took.
+    agent = StudioAgent(StudioClient(url), "uuid", mock_studio.xnode_access_token, state_directory)
+    agent.generation_poller.wait = 0
+    started = time.time()
+    asyncio.run(agent.startup())
+    return agent, time.time() - started
+
+def reset():
+    rebuilds.clear()
+    mock_studio.heartbeats.clear()
+    mock_studio.statuses.clear()
+    mock_studio.generation.update({"configWant": 0, "configHave": 0, "updateWant": 0, "updateHave": 0})
+
+def test_checkpoint_file():
+    state_directory = tempfile.mkdtemp()
+    try:
+        checkpoint = Checkpoint(state_directory)
+        assert checkpoint.get("wantsUpdate") == False and checkpoint.get("systemPath") == None
+        # Without a recorded update check the first one is a full interval away.
+        assert time.time() - checkpoint.get("lastUpdateCheck") < 5
+        checkpoint.update(wantsUpdate=True, lastUpdateCheck=100)
+        saved_at = os.path.getmtime(checkpoint.path)
+
+        # Unchanged values don't touch the file.
+        time.sleep(0.01)
+        checkpoint.update(wantsUpdate=True)
+        assert os.path.getmtime(checkpoint.path) == saved_at
+
+        checkpoint = Checkpoint(state_directory)
+        assert checkpoint.get("wantsUpdate") == True and checkpoint.get("lastUpdateCheck") == 100
+
+        # A damaged file starts from the defaults.
+        with open(checkpoint.path, "w") as f:
+            f.write("{not json")
+        assert Checkpoint(state_directory).get("wantsUpdate") == False
+    finally:
+        shutil.rmtree(state_directory)
+
+def test_fast_restart():
+    global running_system
+    state_directory = tempfile.mkdtemp()
+    mock_studio.mock_msg_path = "mock_studio_message_v2.json"
+    server, url = mock_studio.serve_in_background()
+    os_rebuild, current_system_path = xnode_builder.os_rebuild, config_cache.current_system_path
+    xnode_builder.os_rebuild = fake_rebuild
+    xnode_builder.current_system_path = config_cache.current_system_path = fake_current_system_path
+    try:
+        # First start ever: nothing is known about the running system, so it's rebuilt.
+        reset()
+        agent, _ = start(url, state_directory)
+        assert len(rebuilds) == 1
+        assert agent.checkpoint.get("systemPath") == running_system
+        agent.set_wants_update(True)
+
+        # Restart with the same system: no rebuild, wants_update survives, the first heartbeat goes out at once.
+        reset()
+        agent, elapsed = start(url, state_directory)
+        assert rebuilds == []
+        assert elapsed < 1, elapsed
+        assert len(mock_studio.heartbeats) == 1 and mock_studio.heartbeats[0]["wantUpdate"] == True
+        assert mock_studio.statuses == ["online"]
+
+        # Restarted by the switch to config generation 3: acknowledged on startup, without rebuilding.
+        reset()
+        mock_studio.generation.update({"configWant": 3, "configHave": 2})
+        with open(os.path.join(state_directory, "config.nix"), "w") as f:
+            f.write("{ services.nginx.enable = true; }")
+        running_system = "/nix/store/bbbb-nixos-system-xnode"
+        agent.system_cache.record(xnode_builder.config_hash(state_directory), running_system)
+        agent.checkpoint.update(pendingGeneration=3, status="configuring")
+        agent, _ = start(url, state_directory)
+        assert rebuilds == []
+        assert mock_studio.generation["configHave"] == 3
+        assert agent.checkpoint.get("pendingGeneration") == None
+        assert agent.checkpoint.get("systemPath") == running_system
+
+        # Restarted by the switch of an update, which changed the lock file and the running system.
+        reset()
+        with open(os.path.join(state_directory, "flake.lock"), "w") as f:
+            f.write(json.dumps({"nodes": {}, "version": 7}))
+        agent.checkpoint.update(status="updating")
+        running_system = "/nix/store/cccc-nixos-system-xnode"
+        agent, _ = start(url, state_directory)
+        assert rebuilds == []
+        assert agent.checkpoint.get("systemPath") == running_system
+        assert agent.checkpoint.get("status") == "online"
+
+        # Something else changed the system behind the agent's back: rebuild.
+        reset()
+        running_system = "/nix/store/dddd-nixos-system-xnode"
+        start(url, state_directory)
+        assert len(rebuilds) == 1
+    finally:
+        xnode_builder.os_rebuild = os_rebuild
+        xnode_builder.current_system_path = config_cache.current_system_path = current_system_path
+        server.shutdown()
+        shutil.rmtree(state_directory)
+
+if __name__ == "__main__":
+    test_checkpoint_file()
+    test_fast_restart()
+    print("Checkpoint tests passed.")
@@ -0,0 +1,104 @@
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+from xnode_admin import commands
+from xnode_admin import config_cache
+from xnode_admin import exporter
+from xnode_admin import xnode_builder
+from xnode_admin.commands import ScriptedCommand, ScriptedRunner, command_name, run_command, stream_command
+from xnode_admin.studio_client import StudioClient
+from xnode_admin.xnode_builder import StudioAgent
+from xnode_admin.tests import mock_studio_tests as mock_studio
+from xnode_admin.tests.fake_nix import FakeNix
+
+def test_command_names():
+    assert command_name(['/run/current-system/sw/bin/nixos-rebuild', '--verbose', 'build', '--flake', 'xnode#xnode', '--impure']) == "nixos-rebuild build"
+    assert command_name(['/run/current-system/sw/bin/nixos-rebuild', '--flake', '/var/lib/xnode#xnode', 'build', '--impure']) == "nixos-rebuild build"
+    assert command_name(['/run/current-system/sw/bin/nix', 'flake', 'update', '/var/lib/xnode']) == "nix flake"
+    assert command_name(['/run/current-system/sw/bin/nice', '-n', '19', '/run/current-system/sw/bin/ionice', '-c', '3', '/run/current-system/sw/bin/nix-store', '--gc']) == "nix-store"
+    assert command_name(['/nix/store/aaaa-nixos-system-xnode/bin/switch-to-configuration', 'switch']) == "switch-to-configuration switch"
+    assert command_name(['/run/current-system/sw/bin/nix-env', '--profile', '/nix/var/nix/profiles/system', '--set', '/nix/store/aaaa']) == "nix-env"
+
+def test_runners():
+    before = {key: count for key, (_, _, count) in exporter.command_seconds.snapshot().items()}
+    async def run():
+        # The real runner, with a python child standing in for nix.
+        returncode, stdout, stderr = await run_command([sys.executable, "-c", "import sys; print('out'); print('err', file=sys.stderr); sys.exit(3)"])
+        assert returncode == 3 and stdout == b"out\n" and stderr == b"err\n"
+        lines = []
+        async def on_line(line):
+            lines.append(line)
+        assert await stream_command([sys.executable, "-c", "print('a'); print('b')"], on_line) == 0
+        assert lines == ["a\n", "b\n"]
+
+        # A scripted one answers from its list, in order, and records what was asked.
+        scripted = ScriptedRunner([ScriptedCommand(r"^tool fail", returncode=2, stderr="broken\n"), ScriptedCommand(r"^tool", output=["one", "two"], delay=0.01)])
+        previous = commands.set_runner(scripted)
+        try:
+            assert await run_command(["tool", "go"]) == (0, b"one\ntwo\n", b"")
+            assert await run_command(["tool", "fail"]) == (2, b"", b"broken\n")
+            assert await run_command(["other"]) == (127, b"", b"command not found\n")
+            lines.clear()
+            assert await stream_command(["tool", "fail"], on_line) == 2
+            assert lines == ["broken\n"]
+            assert [args for args, _ in scripted.calls] == [["tool", "go"], ["tool", "fail"], ["other"], ["tool", "fail"]]
+        finally:
+            commands.set_runner(previous)
+    asyncio.run(run())
+
+    # Every command is timed, by name and result.
+    timings = exporter.command_seconds.snapshot()
+    counts = {key: count - before.get(key, 0) for key, (_, _, count) in timings.items()}
+    assert counts[("tool go", "ok")] == 1 and counts[("tool fail", "failed")] == 2
+    assert timings[("tool go", "ok")][1] >= 0.01
+
+def test_fake_nix_cycles():
+    # A reconfigure, an update check and an update, end to end against the mock Studio, without nix.
+    state_directory = tempfile.mkdtemp()
+    fake = FakeNix(build_seconds=0.05)
+    previous = commands.set_runner(fake)
+    current_system_path = config_cache.current_system_path
+    xnode_builder.current_system_path = config_cache.current_system_path = fake.current_system_path
+    mock_studio.mock_msg_path = "mock_studio_message_v2.json"
+    server, url = mock_studio.serve_in_background()
+    try:
+        fake.write_lock(state_directory)
+        agent = StudioAgent(StudioClient(url), "uuid", mock_studio.xnode_access_token, state_directory)
+
+        async def run():
+            agent.prepare()
+            mock_studio.generation.update({"configWant": 1, "configHave": 0, "updateWant": 0, "updateHave": 0})
+            await agent.apply_generation(dict(mock_studio.generation))
+            assert mock_studio.generation["configHave"] == 1
+            configured = fake.current_system
+            assert configured != None and agent.checkpoint.get("systemPath") == configured
+
+            # Nothing new upstream, the check doesn't even build.
+            fake.calls.clear()
+            assert not await xnode_builder.flake_update_check(state_directory)
+            assert [command_name(args) for args, _ in fake.calls] == ["nix flake"]
+
+            fake.release()
+            assert await xnode_builder.flake_update_check(state_directory)
+            assert fake.current_system == configured
+
+            mock_studio.generation.update({"updateWant": 1})
+            await agent.apply_generation(dict(mock_studio.generation))
+            assert mock_studio.generation["updateHave"] == 1
+            assert fake.current_system != configured
+            assert agent.checkpoint.get("systemPath") == fake.current_system
+        asyncio.run(run())
+    finally:
+        server.shutdown()
+        commands.set_runner(previous)
+        xnode_builder.current_system_path = config_cache.current_system_path = current_system_path
+        shutil.rmtree(state_directory)
+        shutil.rmtree(fake.store_directory)
+
+if __name__ == "__main__":
+    test_command_names()
+    test_runners()
+    test_fake_nix_cycles()
+    print("Commands tests passed.")
@@ -0,0 +1,58 @@
+import os
+import shutil
+import tempfile
+from xnode_admin.config_cache import SystemCache, config_hash, write_file_if_changed
+
+def test_write_file_if_changed():
+    state_directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(state_directory, "config.nix")
+        assert write_file_if_changed(path, "{ }")
+        modified = os.stat(path).st_mtime_ns
+        assert not write_file_if_changed(path, "{ }")
+        assert os.stat(path).st_mtime_ns == modified
+        assert write_file_if_changed(path, "{ a = 1; }")
+        with open(path) as f:
+            assert f.read() == "{ a = 1; }"
+        # No temporary files left behind.
+        assert os.listdir(state_directory) == ["config.nix"]
+    finally:
+        shutil.rmtree(state_directory)
+
+def test_hash_ignores_whitespace():
+    state_directory = tempfile.mkdtemp()
+    try:
+        write_file_if_changed(os.path.join(state_directory, "config.nix"), "{\n  a = 1;\n}\n")
+        first = config_hash(state_directory)
+        write_file_if_changed(os.path.join(state_directory, "config.nix"), "{\n  a = 1;   \n\n}")
+        assert config_hash(state_directory) == first
+        write_file_if_changed(os.path.join(state_directory, "config.nix"), "{\n  a = 2;\n}\n")
+        assert config_hash(state_directory) != first
+        # New locked inputs mean a different system, even with the same config.
+        write_file_if_changed(os.path.join(state_directory, "config.nix"), "{\n  a = 1;\n}\n")
+        write_file_if_changed(os.path.join(state_directory, "flake.lock"), "{}")
+        assert config_hash(state_directory) != first
+    finally:
+        shutil.rmtree(state_directory)
+
+def test_system_cache_is_bounded_and_persistent():
+    state_directory = tempfile.mkdtemp()
+    try:
+        cache = SystemCache(state_directory, max_entries=2)
+        cache.record("a", "/nix/store/a-system")
+        cache.record("b", "/nix/store/b-system")
+        cache.record("a", "/nix/store/a-system")
+        cache.record("c", "/nix/store/c-system")
+
+        reloaded = SystemCache(state_directory, max_entries=2)
+        assert reloaded.lookup("b") == None
+        assert reloaded.lookup("a") == "/nix/store/a-system"
+        assert reloaded.lookup("c") == "/nix/store/c-system"
+    finally:
+        shutil.rmtree(state_directory)
+
+if __name__ == "__main__":
+    test_write_file_if_changed()
+    test_hash_ignores_whitespace()
+    test_system_cache_is_bounded_and_persistent()
+    print("Config cache tests passed.")
@@ -0,0 +1,93 @@
+import base64
+import copy
+import json
+import os
+import shutil
+import tempfile
+from xnode_admin.config_delta import ConfigStore, apply_patch, diff_config
+from xnode_admin.nix_renderer import IncrementalRenderer, render_studio_config
+from xnode_admin.signing import MessageSigner
+from xnode_admin.studio_client import StudioClient
+from xnode_admin.xnode_builder import config_get
+from xnode_admin.tests import mock_studio_tests as mock_studio
+
+with open("mock_studio_message_v2.json", "r") as f:
+    base_config = json.load(f)
+
+def edited_config():
+    # Change one option of one service and a UI-only field of another.
+    config = copy.deepcopy(base_config)
+    config["services"][0]["options"][3]["value"] = "50"
+    config["services"][1]["desc"] = "A new description"
+    return config
+
+def test_apply_patch():
+    document = {"services": [{"nixName": "a"}, {"nixName": "b"}], "x/y": 1}
+    patched = apply_patch(document, [
+        {"op": "add", "path": "/services/-", "value": {"nixName": "c"}},
+        {"op": "remove", "path": "/services/0"},
+        {"op": "replace", "path": "/x~1y", "value": 2},
+        {"op": "copy", "from": "/services/0", "path": "/first"},
+        {"op": "move", "from": "/first", "path": "/services/0"},
+        {"op": "test", "path": "/services/0/nixName", "value": "b"},
+    ])
+    assert patched == {"services": [{"nixName": "b"}, {"nixName": "b"}, {"nixName": "c"}], "x/y": 2}
+    # The original is untouched, and failing patches raise.
+    assert document["services"][0] == {"nixName": "a"}
+    for bad in [{"op": "remove", "path": "/services/5"}, {"op": "test", "path": "/x~1y", "value": 3}, {"op": "replace", "path": "/missing", "value": 1}]:
+        try:
+            apply_patch(document, [bad])
+            assert False, bad
+        except (ValueError, KeyError, IndexError):
+            pass
+
+def test_diff_round_trip():
+    new = edited_config()
+    new["services"].append({"nixName": "extra", "options": []})
+    new["users"] = []
+    assert apply_patch(base_config, diff_config(base_config, new)) == new
+    assert apply_patch(new, diff_config(new, base_config)) == base_config
+
+def test_delta_download_against_mock():
+    state_directory = tempfile.mkdtemp()
+    server, url = mock_studio.serve_in_background()
+    try:
+        mock_studio.mock_msg_path = os.path.join(state_directory, "served.json")
+        with open(mock_studio.mock_msg_path, "w") as f:
+            json.dump(base_config, f)
+
+        studio = StudioClient(url)
+        signer = MessageSigner(base64.b64decode(mock_studio.xnode_access_token))
+        store = ConfigStore(state_directory)
+        config = config_get(studio, "uuid", signer, stored_config=store)
+        assert config == base_config and mock_studio.served_kinds[-1] == "full"
+        store.save(1, config)
+
+        with open(mock_studio.mock_msg_path, "w") as f:
+            json.dump(edited_config(), f)
+        config = config_get(studio, "uuid", signer, stored_config=ConfigStore(state_directory))
+        assert config == edited_config() and mock_studio.served_kinds[-1] == "patch"
+
+        # A stored config that doesn't match the patch's base falls back to the full config.
+        store.config["services"].pop()
+        config = config_get(studio, "uuid", signer, stored_config=store)
+        assert config == edited_config() and mock_studio.served_kinds[-2:] == ["patch", "full"]
+    finally:
+        server.shutdown()
+        shutil.rmtree(state_directory)
+
+def test_incremental_renderer():
+    renderer = IncrementalRenderer()
+    assert renderer.render(base_config) == render_studio_config(base_config)
+    assert renderer.rendered == 5 and renderer.reused == 0
+
+    # Only the service with a changed option is rendered again, the UI-only edit is free.
+    assert renderer.render(edited_config()) == render_studio_config(edited_config())
+    assert renderer.rendered == 6 and renderer.reused == 4
+
+if __name__ == "__main__":
+    test_apply_patch()
+    test_diff_round_trip()
+    test_delta_download_against_mock()
+    test_incremental_renderer()
+    print("Config delta tests passed.")
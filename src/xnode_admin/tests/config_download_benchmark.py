@@ -0,0 +1,95 @@
+# Peak RSS of downloading and decoding 1MB, 10MB and 50MB configs, original config_get against the streaming one.
+# Each download runs in a fresh interpreter so the peak (VmHWM) only covers that download.
+import base64
+import hmac
+import http.server
+import json
+import sys
+import subprocess
+import tempfile
+import threading
+import time
+
+access_token = "Tah6WlMnal0mpka6ki8jHmoD9hhK9KXc81xyNjvSt1hm1nj74dlM4W8jPEdPdmSJD1JVba+eDHEceUysRZnplw=="
+
+def legacy_config_get(studio, xnode_uuid, signer):
+    get_config_message = {"id": str(xnode_uuid)}
+    config_response = studio.get('/getXnodeServices', headers=signer.headers(get_config_message), json=get_config_message)
+    config = config_response.json()
+    message = config["message"]
+    if signer.verify(message, config["hmac"]):
+        parsed_message = json.loads(message)
+        if parsed_message["expiry"] > time.time()*1000:
+            base64_config = parsed_message["xnode_config"]
+            return json.loads(base64.decodebytes(base64_config.encode('utf-8')))
+    return None
+
+def generate_response(size):
+    services = []
+    option = {"name": "Option", "desc": "A generated option with a description.", "nixName": "option", "type": "string", "value": "value"}
+    config_size = 0
+    while config_size < size * 3 // 4:
+        service = {"nixName": "service" + str(len(services)), "options": [dict(option, nixName="option" + str(i)) for i in range(100)]}
+        config_size += len(json.dumps(service))
+        services.append(service)
+    message = json.dumps({
+        "expiry": int((time.time() + 3600) * 1000),
+        "xnode_config": base64.encodebytes(json.dumps({"services": services}).encode()).decode(),
+    })
+    message_hmac = hmac.new(base64.b64decode(access_token), msg=message.encode(), digestmod='sha256').hexdigest()
+    return json.dumps({"message": message, "hmac": message_hmac}).encode()
+
+def peak_rss_kb():
+    # VmHWM belongs to the address space, unlike ru_maxrss it isn't inherited from the parent across exec.
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1])
+
+def child(mode, url):
+    from xnode_admin.signing import MessageSigner
+    from xnode_admin.studio_client import StudioClient
+    from xnode_admin.xnode_builder import config_get
+    import contextlib, os
+    studio = StudioClient(url)
+    signer = MessageSigner(base64.b64decode(access_token))
+    baseline = peak_rss_kb()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        config = legacy_config_get(studio, "uuid", signer) if mode == "legacy" else config_get(studio, "uuid", signer)
+    assert config != None
+    print(peak_rss_kb() - baseline)
+
+def serve(body_path):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            with open(body_path, "rb") as f:
+                body = f.read()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--child":
+        child(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+
+    for size_mb in [1, 10, 50]:
+        with tempfile.NamedTemporaryFile() as body:
+            body.write(generate_response(size_mb * 1024 * 1024))
+            body.flush()
+            server = serve(body.name)
+            url = "http://127.0.0.1:" + str(server.server_port) + "/xnodes/functions"
+            results = {}
+            for mode in ["legacy", "streaming"]:
+                output = subprocess.run([sys.executable, __file__, "--child", mode, url], capture_output=True, text=True, check=True)
+                results[mode] = int(output.stdout.strip()) / 1024
+            server.shutdown()
+        print("%3d MB config: legacy peak +%.0f MB RSS, streaming peak +%.0f MB RSS" % (size_mb, results["legacy"], results["streaming"]))
@@ -0,0 +1,74 @@
+import base64
+import json
+from xnode_admin.config_stream import Base64Decoder, JsonFieldReader
+from xnode_admin.signing import MessageSigner
+from xnode_admin.studio_client import StudioClient
+from xnode_admin.xnode_builder import config_get
+from xnode_admin.tests import mock_studio_tests as mock_studio
+
+def read_all(document, chunk_size):
+    values = {}
+    def on_value(key, fragment):
+        values[key] = values.get(key, b"") + fragment
+    reader = JsonFieldReader(on_value)
+    for i in range(0, len(document), chunk_size):
+        reader.feed(document[i:i + chunk_size])
+    reader.close()
+    return values
+
+def test_unescaping_across_chunks():
+    inner = json.dumps({"expiry": 123, "xnode_config": "e30=\n", "text": "quote \" slash / tab \t é \U0001F600"})
+    document = json.dumps({"message": inner, "hmac": "abc", "count": 12, "flag": True}).encode()
+    # Every possible split point, including inside escape sequences.
+    for chunk_size in [1, 2, 3, 5, 7, 64, len(document)]:
+        values = read_all(document, chunk_size)
+        assert values["message"] == inner.encode('utf-8')
+        assert values["hmac"] == b"abc"
+        assert values["count"] == b"12"
+        assert values["flag"] == b"true"
+
+def test_rejects_nested_and_truncated():
+    for document in [b'{"message": {"a": 1}}', b'["message"]']:
+        try:
+            read_all(document, 4)
+            assert False, document
+        except ValueError:
+            pass
+    try:
+        read_all(b'{"message": "abc', 4)
+        assert False
+    except ValueError:
+        pass
+
+def test_base64_fragments():
+    payload = bytes(range(256)) * 50
+    encoded = base64.encodebytes(payload)
+    decoder = Base64Decoder()
+    for i in range(0, len(encoded), 13):
+        decoder.write(encoded[i:i + 13])
+    assert decoder.close() == payload
+
+def test_config_get_against_mock():
+    mock_studio.mock_msg_path = "mock_studio_message_v2.json"
+    server, url = mock_studio.serve_in_background()
+    try:
+        studio = StudioClient(url)
+        signer = MessageSigner(base64.b64decode(mock_studio.xnode_access_token))
+        with open("mock_studio_message_v2.json") as f:
+            assert config_get(studio, "uuid", signer) == json.load(f)
+
+        # Oversized, wrongly signed and expired configs are all refused.
+        assert config_get(studio, "uuid", signer, max_size=1024) == None
+        assert config_get(studio, "uuid", MessageSigner(bytes(64))) == None
+        mock_studio.config_expiry = -1
+        assert config_get(studio, "uuid", signer) == None
+    finally:
+        mock_studio.config_expiry = 5 * 60
+        server.shutdown()
+
+if __name__ == "__main__":
+    test_unescaping_across_chunks()
+    test_rejects_nested_and_truncated()
+    test_base64_fragments()
+    test_config_get_against_mock()
+    print("Config stream tests passed.")
@@ -0,0 +1,180 @@
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+from xnode_admin import xnode_builder
+from xnode_admin.config_validation import ConfigError, OptionIndex, compile_type, nix_literal, render_value, validate_config
+from xnode_admin.studio_client import StudioClient
+from xnode_admin.utils import parse_nix_primitive
+from xnode_admin.xnode_builder import StudioAgent
+from xnode_admin.tests import mock_studio_tests as mock_studio
+
+def rejects(type_name, value):
+    try:
+        render_value(type_name, value)
+    except ConfigError:
+        return True
+    return False
+
+def test_primitives():
+    # The types the Studio sends today render as before.
+    assert parse_nix_primitive("boolean", "true") == "true"
+    assert parse_nix_primitive("int", "100") == "100"
+    assert parse_nix_primitive("string", "cuda") == '"cuda"'
+    assert parse_nix_primitive("path", "/var/www") == "/var/www"
+
+    # Floats are strings like everything else, in a form nix parses.
+    assert parse_nix_primitive("float", "0.5") == "0.5"
+    assert parse_nix_primitive("float", 1e-05) == "1.0e-05"
+    assert rejects("float", "nan") and rejects("float", "1_000") and rejects("float", "")
+
+    # Strings are escaped, nothing in them is interpolated.
+    assert parse_nix_primitive("string", 'say "hi" to ${user}\n\\') == '"say \\"hi\\" to \\${user}\\n\\\\"'
+
+    assert rejects("int", "1.5") and rejects("int", "") and rejects("int", True)
+    assert rejects("boolean", "yes")
+    assert rejects("unsigned integer, meaning >=0", "-1")
+    assert render_value("16 bit unsigned integer; between 0 and 65535 (both inclusive)", "443") == "443"
+    assert rejects("16 bit unsigned integer; between 0 and 65535 (both inclusive)", "70000")
+    assert render_value("integer or floating point number between 0 and 1 (both inclusive)", "0.25") == "0.25"
+    assert rejects("integer or floating point number between 0 and 1 (both inclusive)", "2")
+    assert rejects("absolute path", "relative/path") and rejects("path", "")
+    assert render_value("path", "/srv/my files") == '"/srv/my files"'
+    assert render_value("package", "pkgs.python3Packages.requests") == "pkgs.python3Packages.requests"
+    assert rejects("package", "pkgs.hello; rm -rf /")
+    assert rejects("raw", "{ a = [ 1 2 ; }") and render_value("raw", '{ a = "}"; }') == '{ a = "}"; }'
+    # Types that aren't supported are written raw instead of rejecting the config, only broken syntax is rejected.
+    assert render_value("made up type", "value") == "value"
+    assert render_value("unsigned integer, meaning >=0, or string", "x") == "x"
+    assert render_value(None, 5) == "5"
+    assert rejects("made up type", "{ a = 1;")
+
+def test_compound_types():
+    assert render_value("one of \"cuda\", \"rocm\"", "rocm") == '"rocm"'
+    assert rejects("one of \"cuda\", \"rocm\"", "metal")
+    assert render_value("null or string", None) == "null"
+    assert render_value("null or string", "x") == '"x"'
+    assert render_value("string or signed integer", 5) == "5"
+
+    # Lists come as JSON, as a JSON string, or as the nix list older Studios send.
+    assert render_value("list of string", ["a", "b c"]) == '[ "a" "b c" ]'
+    assert render_value("list of string", '["a", "b"]') == '[ "a" "b" ]'
+    assert render_value("list of string", '[ "a" "say \\"b\\"" ]') == '[ "a" "say \\"b\\"" ]'
+    assert render_value("list of (string or signed integer)", ["a", 1]) == '[ "a" 1 ]'
+    assert render_value("list of 16 bit unsigned integer; between 0 and 65535 (both inclusive)", "[ 80 443 ]") == "[ 80 443 ]"
+    assert rejects("list of signed integer", ["1", "x"]) and rejects("list of string", "a b")
+    assert render_value("attribute set of string", {"max-players": "10", "a b": "c"}) == '{ max-players = "10"; "a b" = "c"; }'
+    assert render_value("attribute set of (list of string)", '{"a": ["b"]}') == '{ a = [ "b" ]; }'
+    assert rejects("attribute set of string", ["a"])
+
+    # Every description is only parsed once.
+    assert compile_type("list of (string or signed integer)") is compile_type("list of (string or signed integer)")
+
+def test_validate_config():
+    with open("mock_studio_message_v2.json", "r") as f:
+        assert validate_config(json.load(f)) == []
+
+    config = {"services": [
+        {"nixName": "minecraft-server", "options": [
+            {"nixName": "eula", "type": "boolean", "value": "maybe"},
+            {"nixName": "serverProperties.max-players", "type": "int", "value": "100"},
+            {"type": "int", "value": "1"},
+        ]},
+        {"nixName": "nginx", "options": "not a list"},
+    ], "bad section": []}
+    errors = validate_config(config)
+    assert len(errors) == 4, errors
+    assert errors[0].startswith("services.minecraft-server.eula: expected true or false")
+    assert "missing or invalid nixName" in errors[1] and "options isn't a list" in errors[2] and "invalid section name" in errors[3]
+    assert len(validate_config({"services": [{"nixName": "s" + str(i), "type": "int", "value": "x"} for i in range(30)]})) == 21
+    assert validate_config({"services": [{"nixName": "s", "options": [{"nixName": "port", "type": "unsigned integer, meaning >=0, or string", "value": "x"}]}]}) == []
+
+    # The option index knows better than the declared type.
+    index = OptionIndex({"services.minecraft-server.serverProperties.max-players": "signed integer", "services.ollama.acceleration": "null or one of \"cuda\", \"rocm\""})
+    config = {"services": [
+        {"nixName": "minecraft-server", "options": [{"nixName": "serverProperties.max-players", "type": "string", "value": "100"}]},
+        {"nixName": "ollama", "options": [{"nixName": "acceleration", "type": "string", "value": "metal"}]},
+    ]}
+    errors = validate_config(config, index)
+    assert len(errors) == 2
+    assert "declared as \"string\", but the option is a signed integer" in errors[0]
+    assert "metal" in errors[1]
+
+    # Raw values are checked for what they are as nix, not for how they're written.
+    index = OptionIndex({"services.x.name": "string", "services.x.hosts": "list of string", "services.x.port": "16 bit unsigned integer; between 0 and 65535 (both inclusive)", "services.x.package": "package"})
+    def module(*options):
+        return {"services": [{"nixName": "x", "options": list(options)}]}
+    assert validate_config(module({"nixName": "name", "type": "raw", "value": "\"web\""}), index) == []
+    assert validate_config(module({"nixName": "hosts", "type": "raw", "value": "[\"a\"]"}), index) == []
+    assert validate_config(module({"nixName": "hosts", "type": "raw", "value": "[ \"a\" \"b\" ]"}, {"nixName": "port", "type": "int", "value": "80"}), index) == []
+    assert validate_config(module({"nixName": "hosts", "type": "raw", "value": "with pkgs; [ hello ]"}), index) == []
+    assert len(validate_config(module({"nixName": "name", "type": "raw", "value": "42"}), index)) == 1
+    assert len(validate_config(module({"nixName": "hosts", "type": "raw", "value": "[ 1 ]"}), index)) == 1
+    assert len(validate_config(module({"nixName": "port", "type": "int", "value": "70000"}), index)) == 1
+    assert len(validate_config(module({"nixName": "package", "type": "string", "value": "pkgs.hello"}), index)) == 1
+    assert nix_literal('{ a.b = [ 1 2.5 true null "x\\"y" /etc ]; "c d" = { }; }') == {"a": {"b": [1, 2.5, True, None, 'x"y', "/etc"]}, "c d": {}}
+    for text in ["pkgs.hello", '"${x}"', "[ 1", "{ a = 1 }", "1 2", ""]:
+        try:
+            nix_literal(text)
+            assert False, text
+        except ConfigError:
+            pass
+
+    state_directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(state_directory, "options.json")
+        with open(path, "w") as f:
+            json.dump([{"name": "services.nginx.enable", "type": "boolean"}, {"name": "services.x.y", "type": "some future type"}], f)
+        index = OptionIndex.load(path)
+        assert index.types == {"services.nginx.enable": "boolean"}
+        index.save(path)
+        assert OptionIndex.load(path).types == index.types
+    finally:
+        shutil.rmtree(state_directory)
+
+def test_agent_rejects_invalid_config():
+    builds = []
+    async def fake_build(state_directory, on_progress=None, progress_interval=5):
+        builds.append(state_directory)
+        return None
+    os_build = xnode_builder.os_build
+    xnode_builder.os_build = fake_build
+
+    state_directory = tempfile.mkdtemp()
+    with open("mock_studio_message_v2.json", "r") as f:
+        config = json.load(f)
+    config["services"][0]["options"][0]["value"] = "yes please"
+    mock_studio.mock_msg_path = os.path.join(state_directory, "invalid.json")
+    with open(mock_studio.mock_msg_path, "w") as f:
+        json.dump(config, f)
+    server, url = mock_studio.serve_in_background()
+    try:
+        agent = StudioAgent(StudioClient(url), "uuid", mock_studio.xnode_access_token, state_directory)
+        async def run():
+            agent.prepare()
+            for _ in range(2):
+                mock_studio.generation.update({"configWant": 1, "configHave": 0, "updateWant": 0, "updateHave": 0})
+                await agent.apply_generation(dict(mock_studio.generation))
+        mock_studio.statuses.clear()
+        fetches = mock_studio.requests_received.get("/xnodes/functions/getXnodeServices", 0)
+        asyncio.run(run())
+
+        # Fetched and reported once, nothing written or built, and the generation isn't acknowledged.
+        assert mock_studio.requests_received["/xnodes/functions/getXnodeServices"] == fetches + 1
+        assert builds == [] and not os.path.exists(os.path.join(state_directory, "config.nix"))
+        assert agent.config_store.config == None and not os.path.exists(agent.config_store.path)
+        assert mock_studio.statuses == ["online"]
+        assert mock_studio.generation["configHave"] == 0
+        assert "yes please" in agent.rebuild_report["configErrors"][0]
+    finally:
+        server.shutdown()
+        xnode_builder.os_build = os_build
+        shutil.rmtree(state_directory)
+
+if __name__ == "__main__":
+    test_primitives()
+    test_compound_types()
+    test_validate_config()
+    test_agent_rejects_invalid_config()
+    print("Config validation tests passed.")
@@ -0,0 +1,82 @@
+import json
+import os
+import socket
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from xnode_admin import exporter
+from xnode_admin.exporter import MetricsExporter, Registry
+
+def test_text_format():
+    registry = Registry()
+    calls = registry.counter("test_calls", "Calls.", ["endpoint"])
+    latency = registry.histogram("test_seconds", "Latency.", ["endpoint"], buckets=(0.1, 1))
+    generation = registry.gauge("test_generation", "Generation.", ["field"])
+
+    calls.inc(endpoint="/pushXnodeHeartbeat")
+    calls.inc(2, endpoint="/pushXnodeHeartbeat")
+    for seconds in [0.05, 0.5, 0.5, 3]:
+        latency.observe(seconds, endpoint='/a"b')
+    generation.set(4, field="configWant")
+
+    lines = registry.render().splitlines()
+    assert "# TYPE test_calls counter" in lines
+    assert 'test_calls_total{endpoint="/pushXnodeHeartbeat"} 3.0' in lines
+    assert 'test_seconds_bucket{endpoint="/a\\"b",le="0.1"} 1.0' in lines
+    assert 'test_seconds_bucket{endpoint="/a\\"b",le="1.0"} 3.0' in lines
+    assert 'test_seconds_bucket{endpoint="/a\\"b",le="+Inf"} 4.0' in lines
+    assert 'test_seconds_count{endpoint="/a\\"b"} 4.0' in lines
+    assert 'test_seconds_sum{endpoint="/a\\"b"} 4.05' in lines
+    assert 'test_generation{field="configWant"} 4.0' in lines
+
+def test_tcp_endpoint():
+    # The sampler hasn't ticked yet, whatever ran before in this process.
+    with exporter.loop_last_tick.lock:
+        exporter.loop_last_tick.values.clear()
+    metrics = MetricsExporter("127.0.0.1:0", max_loop_stall=5)
+    metrics.start()
+    try:
+        exporter.heartbeats.inc(result="ok")
+        body = urllib.request.urlopen(metrics.url() + "/metrics").read().decode()
+        assert 'xnode_admin_heartbeats_total{result="ok"}' in body
+
+        # Healthy while starting up and while the loop keeps ticking, unhealthy once it stalls.
+        assert json.loads(urllib.request.urlopen(metrics.url() + "/health").read())["starting"]
+        exporter.loop_last_tick.set(time.time())
+        assert json.loads(urllib.request.urlopen(metrics.url() + "/health").read())["healthy"]
+        exporter.loop_last_tick.set(time.time() - 10)
+        try:
+            urllib.request.urlopen(metrics.url() + "/health")
+            assert False
+        except urllib.error.HTTPError as e:
+            assert e.code == 503
+    finally:
+        metrics.stop()
+
+def test_unix_socket():
+    path = os.path.join(tempfile.mkdtemp(), "metrics.sock")
+    metrics = MetricsExporter(path)
+    metrics.start()
+    try:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(path)
+        client.sendall(b"GET /metrics HTTP/1.0\r\n\r\n")
+        response = b""
+        while True:
+            data = client.recv(65536)
+            if not data:
+                break
+            response += data
+        client.close()
+        assert response.startswith(b"HTTP/1.0 200")
+        assert b"# TYPE xnode_admin_studio_request_seconds histogram" in response
+    finally:
+        metrics.stop()
+    assert not os.path.exists(path)
+
+if __name__ == "__main__":
+    test_text_format()
+    test_tcp_endpoint()
+    test_unix_socket()
+    print("Exporter tests passed.")
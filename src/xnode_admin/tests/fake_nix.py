@@ -0,0 +1,124 @@
+# Emulates the nix commands the agent runs, for ScriptedRunner. Builds print nix-like output at a configurable pace and
+# produce a store path derived from the config, so the same config always "builds" the same system.
+import json
+import os
+import tempfile
+from xnode_admin.commands import ScriptedCommand, ScriptedRunner
+from xnode_admin.config_cache import config_hash
+
+
+def unit_derivations(derivations):
+    return ["/nix/store/%032d-unit-%d.drv" % (i, i) for i in range(derivations)]
+
+
+def dependency_paths(paths, rev):
+    # Every nixpkgs revision brings its own dependencies.
+    return ["/nix/store/%032d-dependency-%d" % (rev, i) for i in range(paths)]
+
+
+def plan_output(derivations, paths):
+    # What nix prints before building: the derivations to build and the paths to fetch, 1.5 MiB download each.
+    lines = ["these %d derivations will be built:" % len(derivations)]
+    lines += ["  " + derivation for derivation in derivations]
+    if len(paths) > 0:
+        lines.append("these %d paths will be fetched (%.1f MiB download, %.1f MiB unpacked):" % (len(paths), len(paths) * 1.5, len(paths) * 6.0))
+        lines += ["  " + path for path in paths]
+    return lines
+
+
+def build_output(derivations, paths):
+    lines = ["building the system configuration..."] + plan_output(derivations, paths)
+    lines += ["copying path '%s' from 'https://cache.nixos.org'..." % path for path in paths]
+    lines += ["building '%s'..." % derivation for derivation in derivations]
+    return lines
+
+
+def flake_directory(args):
+    # The state directory of "--flake <dir>#xnode" or "flake update <dir>".
+    for i, arg in enumerate(args):
+        if arg.endswith("#xnode"):
+            return arg[:-len("#xnode")]
+        if arg == "update" and i + 1 < len(args):
+            return args[i + 1]
+    return None
+
+
+class FakeNix(ScriptedRunner):
+    '''
+    A ScriptedRunner answering nix flake update, nixos-rebuild build, nix build --dry-run, nix-store --realise, nix-env,
+    switch-to-configuration, nix store diff-closures and nix-store --gc. Change the timings, output and exit codes
+    through the named commands, e.g. fake.build.returncode = 1, and call release() to publish a new nixpkgs revision
+    for flake update to lock. Every dependency that wasn't prefetched adds a copying line and fetch_seconds to a build,
+    realising takes fetch_seconds per path as well.
+    '''
+    def __init__(self, build_seconds=0, derivations=5, paths=20, switch_seconds=0, flake_update_seconds=0, store_directory=None, fetch_seconds=0):
+        self.store_directory = store_directory if store_directory != None else tempfile.mkdtemp()
+        self.upstream_rev = 1
+        self.current_system = None
+        self.last_build = None
+        self.derivations = unit_derivations(derivations)
+        self.paths = paths
+        self.build_seconds = build_seconds
+        self.fetch_seconds = fetch_seconds
+        self.fetched = set() # Dependencies realised by nix-store --realise.
+
+        lines = build_output(self.derivations, dependency_paths(paths, self.upstream_rev))
+        self.flake_update = ScriptedCommand(r"nix flake update", delay=flake_update_seconds, action=self.lock_inputs)
+        self.build = ScriptedCommand(r"nixos-rebuild .*build", output=lines, line_delay=build_seconds / max(len(lines), 1), action=self.build_system)
+        self.dry_run = ScriptedCommand(r"nix build --dry-run", action=self.plan_build)
+        self.realise = ScriptedCommand(r"nix-store --realise", action=self.realise_paths)
+        self.set_profile = ScriptedCommand(r"nix-env --profile \S+ --set")
+        self.switch = ScriptedCommand(r"switch-to-configuration switch", output=["activating the configuration...", "setting up /etc..."], delay=switch_seconds, action=self.switch_system)
+        self.diff = ScriptedCommand(r"nix store diff-closures", action=self.diff_systems)
+        self.delete_generations = ScriptedCommand(r"nix-env --profile \S+ --delete-generations")
+        self.gc = ScriptedCommand(r"nix-store --gc", stderr="12 store paths deleted, 340.50 MiB freed\n")
+        super().__init__([self.flake_update, self.build, self.dry_run, self.realise, self.set_profile, self.switch, self.diff, self.delete_generations, self.gc])
+
+    def release(self):
+        self.upstream_rev += 1
+
+    def write_lock(self, state_directory):
+        with open(os.path.join(state_directory, "flake.lock"), "w") as f:
+            json.dump({"nodes": {"nixpkgs": {"locked": {"rev": "%040d" % self.upstream_rev, "narHash": "sha256-" + str(self.upstream_rev)}}, "root": {"inputs": {"nixpkgs": "nixpkgs"}}}, "version": 7}, f)
+
+    def lock_inputs(self, args, cwd):
+        self.write_lock(flake_directory(args))
+
+    def missing_paths(self):
+        return [path for path in dependency_paths(self.paths, self.upstream_rev) if path not in self.fetched]
+
+    def plan_build(self, args, cwd):
+        self.dry_run.stderr = "".join(line + "\n" for line in plan_output(self.derivations, self.missing_paths()))
+
+    def realise_paths(self, args, cwd):
+        paths = args[2:]
+        self.realise.delay = self.fetch_seconds * len(paths)
+        if self.realise.returncode == 0:
+            self.fetched.update(paths)
+
+    def build_system(self, args, cwd):
+        # The build downloads what wasn't prefetched one path after the other.
+        self.build.output = build_output(self.derivations, self.missing_paths())
+        self.build.delay = self.fetch_seconds * len(self.missing_paths())
+        self.build.line_delay = self.build_seconds / len(self.build.output)
+        state_directory = flake_directory(args)
+        system_path = os.path.join(self.store_directory, config_hash(state_directory)[:32] + "-nixos-system-xnode")
+        os.makedirs(system_path, exist_ok=True)
+        self.last_build = system_path
+        if cwd != None and self.build.returncode == 0:
+            result = os.path.join(cwd, "result")
+            if os.path.islink(result):
+                os.unlink(result)
+            os.symlink(system_path, result)
+
+    def switch_system(self, args, cwd):
+        if self.switch.returncode == 0:
+            self.current_system = os.path.dirname(os.path.dirname(args[0]))
+
+    def diff_systems(self, args, cwd):
+        changed = self.last_build != self.current_system
+        self.diff.output = ["nixpkgs: rev %d, 1.2 MiB" % self.upstream_rev] if changed else []
+
+    def current_system_path(self):
+        # Stand-in for config_cache.current_system_path.
+        return self.current_system if self.current_system != None else os.path.realpath("/run/current-system")
@@ -0,0 +1,192 @@
+# A simulated fleet against the mock Studio: N real StudioAgents in one process, each with its own state directory and
+# connection pool, with nix stubbed out. Reports the requests every Studio endpoint gets, their latencies as seen by the
+# agents, the traffic per node and hour, and what the agents cost in CPU and memory, so protocol changes can be sized
+# before they're rolled out.
+# The mock Studio runs in its own process so its CPU isn't counted as the agents'. --speedup divides every interval,
+# rates are per simulated second (what a real fleet of N nodes would send), but the mock sees speedup times the load.
+# Run from the repository root, e.g. PYTHONPATH=src python src/xnode_admin/tests/fleet_benchmark.py --agents 500
+import argparse
+import asyncio
+import concurrent.futures
+import logging
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import psutil
+import requests
+from xnode_admin import xnode_builder
+from xnode_admin.generation_poller import GenerationPoller
+from xnode_admin.intervals import IntervalController
+from xnode_admin.logs import setup_logging
+from xnode_admin.studio_client import StudioClient
+from xnode_admin.xnode_builder import StudioAgent
+from xnode_admin.tests import mock_studio_tests as mock_studio
+
+# No nix here, builds and switches succeed straight away.
+async def fake_build(state_directory, on_progress=None, progress_interval=5):
+    return "/nix/store/aaaa-nixos-system-xnode"
+
+async def fake_switch(system_path):
+    return True
+
+async def fake_rebuild(state_directory, on_progress=None, progress_interval=5, timings=None):
+    return True
+
+xnode_builder.os_build = fake_build
+xnode_builder.os_switch = fake_switch
+xnode_builder.os_rebuild = fake_rebuild
+
+# (seconds, ok) of every call by endpoint, from all agents. Long-polls count with the time the Studio held them.
+calls = {}
+
+class RecordingClient(StudioClient):
+    # The agent's own client, also keeping every call for the percentiles.
+    def _record(self, endpoint, seconds, ok):
+        super()._record(endpoint, seconds, ok)
+        calls.setdefault(endpoint, []).append((seconds, ok))
+
+def percentile(values, fraction):
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def start_studio(args):
+    port = free_port()
+    command = [sys.executable, "-m", "xnode_admin.tests.mock_studio_tests", "mock_studio_message_v2.json", "--port", str(port), "--quiet", "--per-node-generations"]
+    if args.no_long_poll:
+        command.append("--no-long-poll")
+    if args.no_batch:
+        command.append("--no-batch")
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = "http://127.0.0.1:" + str(port) + "/xnodes"
+    for _ in range(100):
+        try:
+            requests.get(base_url + "/stats", timeout=1)
+            return process, base_url
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Mock Studio didn't start.")
+
+def make_agent(i, studio_url, state_root, speedup, max_heartbeat_interval):
+    state_directory = os.path.join(state_root, str(i))
+    os.mkdir(state_directory)
+    poller = GenerationPoller(base_interval=10 / speedup, max_interval=60 / speedup, max_error_interval=300 / speedup, long_poll_wait=60 / speedup, quiet_period=5 / speedup, max_settle=60 / speedup)
+    intervals = IntervalController(heartbeat_interval=30 / speedup, max_heartbeat_interval=max_heartbeat_interval / speedup, sample_interval=1 / speedup, rebuild_sample_interval=0.25 / speedup, min_heartbeat_spacing=5 / speedup)
+    agent = StudioAgent(RecordingClient(studio_url, pool_size=2), "fleet-" + str(i), mock_studio.xnode_access_token, state_directory, generation_poller=poller, intervals=intervals)
+    return agent
+
+async def run_agent(agent, start_delay):
+    # Nodes don't all start at the same moment, spread them over a heartbeat interval.
+    await asyncio.sleep(start_delay)
+    await agent.startup()
+    await asyncio.gather(agent.sample_metrics_task(), agent.heartbeat_task(), agent.generation_task())
+
+async def change_configs(base_url, agents, changes_per_hour, speedup):
+    # Users saving configs in the Studio, changes_per_hour for every node on average.
+    if changes_per_hour <= 0:
+        return
+    while True:
+        await asyncio.sleep(random.expovariate(changes_per_hour * len(agents) * speedup / 3600))
+        agent = random.choice(agents)
+        await asyncio.to_thread(requests.post, base_url + "/bump", json={"id": str(agent.xnode_uuid), "config": 1}, timeout=10)
+
+def snapshot(base_url):
+    stats = requests.get(base_url + "/stats", timeout=10).json()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {"time": time.time(), "cpu": usage.ru_utime + usage.ru_stime, "stats": stats, "calls": {endpoint: list(values) for endpoint, values in list(calls.items())}}
+
+def difference(after, before, key):
+    return {path: value - before["stats"][key].get(path, 0) for path, value in after["stats"][key].items()}
+
+async def run_fleet(args, base_url, studio):
+    loop = asyncio.get_running_loop()
+    # Every agent holds a worker thread during a long-poll, and one more for its heartbeat.
+    loop.set_default_executor(concurrent.futures.ThreadPoolExecutor(max_workers=args.agents * 2 + 8))
+
+    baseline_rss = psutil.Process().memory_info().rss
+    state_root = tempfile.mkdtemp()
+    try:
+        agents = [make_agent(i, base_url + "/functions", state_root, args.speedup, args.max_heartbeat_interval) for i in range(args.agents)]
+        spread = agents[0].intervals.heartbeat_interval
+        tasks = [asyncio.ensure_future(run_agent(agent, random.uniform(0, spread))) for agent in agents]
+        tasks.append(asyncio.ensure_future(change_configs(base_url, agents, args.config_changes, args.speedup)))
+
+        # Measure the steady state, after every agent started.
+        await asyncio.sleep(spread + 1)
+        calls.clear()
+        before = await asyncio.to_thread(snapshot, base_url)
+        await asyncio.sleep(args.seconds)
+        after = await asyncio.to_thread(snapshot, base_url)
+        rss = psutil.Process().memory_info().rss
+
+        # Stopping the Studio ends the long-polls still waiting, the agents are cancelled after.
+        logging.getLogger("xnode_admin").setLevel(logging.CRITICAL)
+        studio.terminate()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for agent in agents:
+            agent.outbox.close()
+    finally:
+        shutil.rmtree(state_root)
+    return before, after, rss - baseline_rss
+
+def report(args, before, after, agents_rss):
+    wall = after["time"] - before["time"]
+    simulated = wall * args.speedup
+    node_hours = args.agents * simulated / 3600
+    requests_received = difference(after, before, "requests")
+    traffic = difference(after, before, "bytesReceived")
+    for path, sent in difference(after, before, "bytesSent").items():
+        traffic[path] = traffic.get(path, 0) + sent
+
+    print("%d agents for %.0fs at %gx speed (%.1f simulated node hours), long-poll %s, batch %s, %g config changes per node per hour" % (
+        args.agents, wall, args.speedup, node_hours, "off" if args.no_long_poll else "on", "off" if args.no_batch else "on", args.config_changes))
+    print("%-44s %10s %9s %9s %9s %14s" % ("endpoint", "req/s", "p50 ms", "p99 ms", "failed", "B/node/hour"))
+    total_requests, total_bytes = 0, 0
+    for path in sorted(requests_received):
+        if not path.startswith("/xnodes/functions/") or requests_received[path] == 0:
+            continue
+        endpoint_calls = after["calls"].get(path[len("/xnodes/functions"):], [])
+        latencies = [seconds for seconds, _ in endpoint_calls]
+        failed = sum(1 for _, ok in endpoint_calls if not ok)
+        total_requests += requests_received[path]
+        total_bytes += traffic.get(path, 0)
+        print("%-44s %10.2f %9.1f %9.1f %9d %14.0f" % (path, requests_received[path] / simulated, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, failed, traffic.get(path, 0) / node_hours))
+    print("%-44s %10.2f %9s %9s %9s %14.0f" % ("total", total_requests / simulated, "", "", "", total_bytes / node_hours))
+
+    cpu = after["cpu"] - before["cpu"]
+    print("agents: %.1f%% of a core, %.2f CPU seconds per node per hour, RSS %.1f MB (%.0f kB per agent)" % (
+        cpu / wall * 100, cpu / node_hours, agents_rss / 1024 / 1024, agents_rss / 1024 / args.agents))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the Studio protocol with a simulated fleet of agents.")
+    parser.add_argument("--agents", type=int, default=100, help="Number of simulated xnodes.")
+    parser.add_argument("--seconds", type=float, default=60, help="Length of the measurement, after every agent started.")
+    parser.add_argument("--speedup", type=float, default=10, help="Divides every agent interval, to simulate more time.")
+    parser.add_argument("--config-changes", type=float, default=1, help="Config changes per node per simulated hour.")
+    parser.add_argument("--no-long-poll", action="store_true", help="Simulate a Studio without long-polling.")
+    parser.add_argument("--max-heartbeat-interval", type=float, default=300, help="Longest heartbeat interval while usage is stable, 30 for fixed heartbeats.")
+    parser.add_argument("--no-batch", action="store_true", help="Simulate a Studio without the batch endpoint.")
+    args = parser.parse_args()
+
+    setup_logging("WARNING", json_lines=False)
+    studio, base_url = start_studio(args)
+    try:
+        before, after, agents_rss = asyncio.run(run_fleet(args, base_url, studio))
+    finally:
+        studio.kill()
+    report(args, before, after, agents_rss)
@@ -0,0 +1,80 @@
+import threading
+import time
+from xnode_admin.generation_poller import GenerationPoller
+from xnode_admin.signing import MessageSigner
+from xnode_admin.studio_client import StudioClient
+from xnode_admin.xnode_builder import check_generation
+from xnode_admin.tests import mock_studio_tests as mock_studio
+
+signer = MessageSigner(bytes(32))
+
+def test_long_poll_against_mock():
+    mock_studio.long_poll = True
+    server, url = mock_studio.serve_in_background()
+    try:
+        studio = StudioClient(url)
+        poller = GenerationPoller(base_interval=10, long_poll_wait=5)
+
+        # First call returns straight away, nothing is known yet.
+        wait = poller.long_poll_wait()
+        generation = check_generation(studio, "uuid", signer, wait, poller.known_generation())
+        poller.record(generation, wait)
+        assert poller.long_poll_supported
+        assert poller.next_delay() == 0
+        config_want = generation["configWant"]
+
+        # The next call is held until the Studio bumps the generation.
+        threading.Timer(0.5, mock_studio.bump_generation_values, kwargs={"config": 1}).start()
+        start = time.time()
+        generation = check_generation(studio, "uuid", signer, poller.long_poll_wait(), poller.known_generation())
+        elapsed = time.time() - start
+        assert poller.record(generation, 5)
+        assert generation["configWant"] == config_want + 1
+        assert 0.4 < elapsed < 4, elapsed
+    finally:
+        server.shutdown()
+
+def test_polling_fallback_against_mock():
+    mock_studio.long_poll = False
+    server, url = mock_studio.serve_in_background()
+    try:
+        studio = StudioClient(url)
+        poller = GenerationPoller(base_interval=10, max_interval=60, long_poll_wait=5, jitter=0.2)
+        wait = poller.long_poll_wait()
+        generation = check_generation(studio, "uuid", signer, wait, poller.known_generation())
+        poller.record(generation, wait)
+        assert poller.long_poll_supported == False
+        assert poller.long_poll_wait() == 0
+        assert 8 <= poller.next_delay() <= 12
+    finally:
+        mock_studio.long_poll = True
+        server.shutdown()
+
+def test_backoff():
+    poller = GenerationPoller(base_interval=10, max_interval=60, max_error_interval=300, long_poll_wait=0, jitter=0.2)
+    generation = {"configWant": 1, "configHave": 1, "updateWant": 0, "updateHave": 0}
+    poller.record(generation, 0)
+
+    # Unchanged generations back off up to max_interval.
+    delays = []
+    for _ in range(6):
+        poller.record(generation, 0)
+        delays.append(poller.next_delay())
+    assert 8 <= delays[0] <= 12
+    assert 16 <= delays[1] <= 24
+    assert 48 <= delays[-1] <= 72
+
+    # A change resets to the base interval.
+    poller.record(dict(generation, configWant=2), 0)
+    assert 8 <= poller.next_delay() <= 12
+
+    # Errors back off up to max_error_interval.
+    for _ in range(10):
+        poller.record(None, 0)
+    assert 240 <= poller.next_delay() <= 360
+
+if __name__ == "__main__":
+    test_long_poll_against_mock()
+    test_polling_fallback_against_mock()
+    test_backoff()
+    print("Generation poller tests passed.")
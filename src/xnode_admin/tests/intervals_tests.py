@@ -0,0 +1,135 @@
+import asyncio
+import shutil
+import tempfile
+from xnode_admin.generation_poller import GenerationPoller
+from xnode_admin.intervals import IntervalController
+from xnode_admin.studio_client import StudioClient
+from xnode_admin.xnode_builder import StudioAgent
+from xnode_admin.tests import mock_studio_tests as mock_studio
+
+def levels(cpu, memory=40.0, disk=50.0):
+    return {"cpu": cpu, "memory": memory, "disk": disk}
+
+def test_heartbeat_backoff():
+    intervals = IntervalController(heartbeat_interval=30, max_heartbeat_interval=300, change_threshold=5)
+    now = 1000.0
+    intervals.record_heartbeat(levels(10), now)
+    assert intervals.current_heartbeat_interval() == 30
+    assert intervals.heartbeat_delay(now + 10) == 20
+
+    # Stable usage stretches the interval up to the maximum.
+    seen = []
+    for _ in range(6):
+        now += intervals.current_heartbeat_interval()
+        intervals.record_heartbeat(levels(12), now)
+        seen.append(intervals.current_heartbeat_interval())
+    assert seen == [60, 120, 240, 300, 300, 300]
+
+    # A change goes back to the configured interval.
+    intervals.record_heartbeat(levels(30), now + 300)
+    assert intervals.current_heartbeat_interval() == 30
+    assert intervals.report() == {"heartbeatIntervalSeconds": 30}
+
+def test_thresholds():
+    intervals = IntervalController(heartbeat_interval=30, cpu_threshold=90, disk_threshold=95, min_heartbeat_spacing=5)
+    now = 1000.0
+    intervals.record_heartbeat(levels(10), now)
+    intervals.record_heartbeat(levels(10), now + 30)
+    assert intervals.stable == 1
+
+    # Crossing sends a heartbeat, staying above doesn't send another.
+    assert intervals.record_sample(levels(95), now + 40)
+    assert intervals.stable == 0
+    intervals.record_heartbeat(levels(95), now + 40)
+    assert not intervals.record_sample(levels(97), now + 41)
+    assert not intervals.record_sample(levels(50), now + 42)
+
+    # Crossing again right after a heartbeat only shortens the interval.
+    intervals.record_heartbeat(levels(50), now + 43)
+    intervals.record_heartbeat(levels(50), now + 73)
+    assert not intervals.record_sample(levels(50, disk=96), now + 75)
+    assert intervals.stable == 0 and intervals.breached == {"disk"}
+
+def test_sampling_and_hints():
+    intervals = IntervalController(sample_interval=1, rebuild_sample_interval=0.25, update_check_interval=3600, max_update_check_interval=7200)
+    assert intervals.current_sample_interval() == 1
+    with intervals.rebuilding():
+        with intervals.rebuilding():
+            assert intervals.current_sample_interval() == 0.25
+        assert intervals.current_sample_interval() == 0.25
+    assert intervals.current_sample_interval() == 1
+
+    # Hints can only stretch intervals, up to their maximum.
+    intervals.apply_hints({"heartbeat": 120, "updateCheck": 10})
+    assert intervals.current_heartbeat_interval() == 120 and intervals.current_update_check_interval() == 3600
+    intervals.apply_hints({"heartbeat": 1000, "updateCheck": 5000})
+    assert intervals.current_heartbeat_interval() == 300 and intervals.current_update_check_interval() == 5000
+    intervals.apply_hints({"heartbeat": "soon"})
+    assert intervals.current_heartbeat_interval() == 30 and intervals.current_update_check_interval() == 5000
+    intervals.apply_hints({"updateCheck": 0})
+    assert intervals.current_update_check_interval() == 3600
+
+    poller = GenerationPoller(base_interval=10, max_interval=60, jitter=0, long_poll_wait=0)
+    poller.hint(40)
+    assert poller.next_delay() == 40
+    poller.hint(600)
+    assert poller.next_delay() == 60
+    poller.hint(None)
+    assert poller.next_delay() == 10
+
+def test_agent_follows_hints():
+    state_directory = tempfile.mkdtemp()
+    mock_studio.long_poll = False
+    mock_studio.interval_hints = {"heartbeat": 90, "generation": 20, "updateCheck": 60 * 60 * 12}
+    server, url = mock_studio.serve_in_background()
+    try:
+        poller = GenerationPoller(base_interval=10, max_interval=60, jitter=0, long_poll_wait=0)
+        agent = StudioAgent(StudioClient(url), "uuid", mock_studio.xnode_access_token, state_directory, generation_poller=poller)
+
+        async def run():
+            agent.prepare()
+            agent.sample_metrics()
+            mock_studio.heartbeats.clear()
+            await agent.heartbeat(False)
+        asyncio.run(run())
+
+        # The heartbeat went out with the interval in use, and the answer stretched all three.
+        assert mock_studio.heartbeats[-1]["heartbeatIntervalSeconds"] == 30
+        assert agent.intervals.current_heartbeat_interval() == 90
+        assert agent.intervals.current_update_check_interval() == 60 * 60 * 12
+        assert poller.next_delay() == 20
+    finally:
+        server.shutdown()
+        mock_studio.interval_hints = None
+        mock_studio.long_poll = True
+        shutil.rmtree(state_directory)
+
+def test_breach_sends_heartbeat():
+    state_directory = tempfile.mkdtemp()
+    server, url = mock_studio.serve_in_background()
+    try:
+        # Disk usage is always above 0%, the first sample crosses the threshold.
+        intervals = IntervalController(heartbeat_interval=60, disk_threshold=0, sample_interval=0.05, min_heartbeat_spacing=0)
+        agent = StudioAgent(StudioClient(url), "uuid", mock_studio.xnode_access_token, state_directory, intervals=intervals)
+
+        async def run():
+            agent.prepare()
+            tasks = asyncio.gather(agent.sample_metrics_task(), agent.heartbeat_task())
+            try:
+                await asyncio.wait_for(tasks, 1)
+            except asyncio.TimeoutError:
+                pass
+        mock_studio.heartbeats.clear()
+        asyncio.run(run())
+        assert len(mock_studio.heartbeats) == 1
+    finally:
+        server.shutdown()
+        shutil.rmtree(state_directory)
+
+if __name__ == "__main__":
+    test_heartbeat_backoff()
+    test_thresholds()
+    test_sampling_and_hints()
+    test_agent_follows_hints()
+    test_breach_sends_heartbeat()
+    print("Interval tests passed.")
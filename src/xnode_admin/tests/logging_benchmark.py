@@ -0,0 +1,69 @@
+# Log volume of the main loop against the mock Studio, with everything logged versus the defaults.
+# Heartbeats, generation checks and config changes run a lot faster than in production to compress a busy hour.
+import asyncio
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import threading
+from xnode_admin import xnode_builder
+from xnode_admin.generation_poller import GenerationPoller
+from xnode_admin.intervals import IntervalController
+from xnode_admin.logs import flush_logging, setup_logging
+from xnode_admin.studio_client import StudioClient
+from xnode_admin.xnode_builder import StudioAgent
+from xnode_admin.tests import mock_studio_tests as mock_studio
+
+seconds = 20
+
+# No nix here, builds and switches succeed straight away.
+async def fake_build(state_directory, on_progress=None, progress_interval=5):
+    return "/nix/store/aaaa-nixos-system-xnode"
+
+async def fake_switch(system_path):
+    return True
+
+xnode_builder.os_build = fake_build
+xnode_builder.os_switch = fake_switch
+
+def run_loop(level, json_lines, burst):
+    out = io.StringIO()
+    queue_handler = setup_logging(level, json_lines, burst, 60, stream=out)
+    state_directory = tempfile.mkdtemp()
+    mock_studio.mock_msg_path = "mock_studio_message_v2.json"
+    mock_studio.long_poll = False
+    server, url = mock_studio.serve_in_background()
+    try:
+        poller = GenerationPoller(base_interval=0.1, max_interval=0.1, long_poll_wait=0, quiet_period=0)
+        intervals = IntervalController(heartbeat_interval=0.2, max_heartbeat_interval=0.2, sample_interval=0.05)
+        agent = StudioAgent(StudioClient(url), "uuid", mock_studio.xnode_access_token, state_directory, generation_poller=poller, intervals=intervals)
+
+        async def bump_config():
+            while True:
+                await asyncio.sleep(1)
+                mock_studio.bump_generation_values(config=1)
+
+        async def run():
+            agent.prepare()
+            tasks = asyncio.gather(agent.sample_metrics_task(), agent.heartbeat_task(), agent.generation_task(), bump_config())
+            try:
+                await asyncio.wait_for(tasks, seconds)
+            except asyncio.TimeoutError:
+                pass
+
+        # The mock Studio prints request headers, keep those out of the numbers.
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            asyncio.run(run())
+        flush_logging()
+    finally:
+        server.shutdown()
+        shutil.rmtree(state_directory)
+
+    text = out.getvalue()
+    suppressed = queue_handler.filters[0].suppressed_total
+    return len(text.splitlines()), len(text.encode('utf-8')), suppressed, queue_handler.dropped
+
+for name, level, json_lines, burst in [("everything (DEBUG, text, no rate limit)", "DEBUG", False, 0), ("defaults (INFO, json, 10/min per site)", "INFO", True, 10)]:
+    lines, size, suppressed, dropped = run_loop(level, json_lines, burst)
+    print("%s: %d lines, %.1f kB in %ds, %d suppressed, %d dropped" % (name, lines, size / 1024, seconds, suppressed, dropped))
@@ -0,0 +1,63 @@
+import io
+import json
+import logging
+import queue
+from xnode_admin.logs import DroppingQueueHandler, JsonFormatter, RateLimitFilter, flush_logging, setup_logging
+
+def make_record(msg, args=(), created=None, **extra):
+    record = logging.LogRecord("xnode_admin.test", logging.INFO, __file__, 1, msg, args, None)
+    if created != None:
+        record.created = created
+    record.__dict__.update(extra)
+    return record
+
+def test_json_lines():
+    line = JsonFormatter().format(make_record("Built %s", ("/nix/store/aaaa",), buildSeconds=12.5))
+    assert "\n" not in line
+    parsed = json.loads(line)
+    assert parsed["msg"] == "Built /nix/store/aaaa"
+    assert parsed["level"] == "INFO" and parsed["logger"] == "xnode_admin.test"
+    assert parsed["buildSeconds"] == 12.5
+
+def test_rate_limit():
+    rate_limit = RateLimitFilter(burst=3, interval=60)
+    passed = [rate_limit.filter(make_record("Failed to send heartbeat: %s", (i,), created=1000 + i)) for i in range(10)]
+    assert passed == [True] * 3 + [False] * 7
+    assert rate_limit.suppressed_total == 7
+
+    # Other call sites have their own budget.
+    assert rate_limit.filter(make_record("Sending heartbeat.", created=1005))
+
+    # After the interval the next record goes out and reports what was dropped.
+    record = make_record("Failed to send heartbeat: %s", (10,), created=1061)
+    assert rate_limit.filter(record)
+    assert record.suppressed == 7
+
+def test_queue_never_blocks():
+    handler = DroppingQueueHandler(queue.Queue(5))
+    for i in range(100):
+        handler.handle(make_record("line %s", (i,)))
+    assert handler.queue.qsize() == 5
+    assert handler.dropped == 95
+
+def test_setup_logging():
+    out = io.StringIO()
+    queue_handler = setup_logging("INFO", True, burst=2, interval=60, stream=out)
+    log = logging.getLogger("xnode_admin.xnode_builder")
+    for i in range(5):
+        log.info("Sending heartbeat.")
+    log.debug("Not logged at INFO.")
+    log.warning("Config response failed: %s", "boom")
+    flush_logging()
+
+    lines = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert [line["msg"] for line in lines] == ["Sending heartbeat.", "Sending heartbeat.", "Config response failed: boom"]
+    assert lines[-1]["level"] == "WARNING"
+    assert queue_handler.filters[0].suppressed_total == 3
+
+if __name__ == "__main__":
+    test_json_lines()
+    test_rate_limit()
+    test_queue_never_blocks()
+    test_setup_logging()
+    print("Logs tests passed.")
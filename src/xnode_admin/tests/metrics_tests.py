@@ -0,0 +1,66 @@
+import random
+import sys
+from xnode_admin.metrics import MetricAggregator, P2Quantile, RollingWindows
+
+def exact_quantile(values, p):
+    ordered = sorted(values)
+    return ordered[int(p * (len(ordered) - 1))]
+
+def test_p2_quantile_accuracy():
+    rng = random.Random(42)
+    values = [rng.gauss(50, 15) for _ in range(20000)]
+    for p in (0.95, 0.99):
+        estimator = P2Quantile(p)
+        for value in values:
+            estimator.add(value)
+        exact = exact_quantile(values, p)
+        assert abs(estimator.value() - exact) < 1.0, (p, estimator.value(), exact)
+
+def test_interval_summary():
+    aggregator = MetricAggregator()
+    for i, value in enumerate([10, 20, 30, 40]):
+        aggregator.add(value, now=1000 + i)
+
+    summary = aggregator.take(now=1004)
+    assert summary["count"] == 4
+    assert summary["avg"] == 25
+    assert summary["min"] == 10
+    assert summary["max"] == 40
+    assert summary["p99"] == 40
+
+    # Interval stats reset, rolling windows don't.
+    summary = aggregator.take(now=1005)
+    assert summary["count"] == 0
+    assert summary["avg"] == 0
+    assert summary["windows"]["1m"]["avg"] == 25
+
+def test_rolling_windows():
+    windows = RollingWindows()
+    # Ten minutes of samples at 1Hz: 100 for the first five minutes, 0 afterwards.
+    for second in range(600):
+        windows.add(100 if second < 300 else 0, 10000 + second)
+
+    summary = windows.summary(10000 + 599)
+    assert summary["1m"]["avg"] == 0
+    assert summary["1m"]["max"] == 0
+    assert 0 < summary["15m"]["avg"] < 100
+    assert summary["15m"]["max"] == 100
+
+    # Old buckets fall out of the window once the ring wraps around.
+    summary = windows.summary(10000 + 600 + 900)
+    assert summary["15m"]["avg"] == 0
+
+def test_constant_memory():
+    aggregator = MetricAggregator()
+    slots = len(aggregator.windows.slots)
+    for i in range(100000):
+        aggregator.add(i % 100, now=i)
+    assert len(aggregator.windows.slots) == slots
+    assert sys.getsizeof(aggregator.interval.p99.heights) < 200
+
+if __name__ == "__main__":
+    test_p2_quantile_accuracy()
+    test_interval_summary()
+    test_rolling_windows()
+    test_constant_memory()
+    print("Metrics tests passed.")
@@ -1,8 +1,13 @@
 # Emulates connection to the studio
 from flask import Flask, request, jsonify
+import argparse
+import base64
 import json
 import sys
 import hmac
+import threading
+import time
+from xnode_admin.config_delta import diff_config, studio_config_hash
 app = Flask(__name__)
 
 avg_cpu_usage = float(0)
@@ -11,31 +16,199 @@ highest_cpu_usage = float(0)
 highest_mem_usage = float(0)
 messages = []
 access_token = "Tah6WlMnal0mpka6ki8jHmoD9hhK9KXc81xyNjvSt1hm1nj74dlM4W8jPEdPdmSJD1JVba"
+# Same token as run-studio.sh, used to sign the services like the dpl does.
+xnode_access_token = "Tah6WlMnal0mpka6ki8jHmoD9hhK9KXc81xyNjvSt1hm1nj74dlM4W8jPEdPdmSJD1JVba+eDHEceUysRZnplw=="
+config_expiry = 5 * 60 # Seconds a served config stays valid.
 
-if len(sys.argv) > 1:
-    mock_msg_path = sys.argv[1]
-else: 
-    mock_msg_path = "mock_studio_message.json"
+# Configs served before, by hash, so agents that send the hash of their stored config get a patch instead.
+delta_updates = True
+served_configs = {}
+served_kinds = []
+
+mock_msg_path = "mock_studio_message.json"
+
+# Generation state, getXnodeGeneration can be served as a plain poll or as a long-poll.
+long_poll = True
+generation = {"configWant": 0, "configHave": 0, "updateWant": 0, "updateHave": 0}
+generation_changed = threading.Condition()
+# Gives every xnode id its own copy of the generation values (for the fleet benchmark), otherwise they all share one.
+per_node_generations = False
+node_generations = {}
+statuses = []
+heartbeats = []
+# Sent with heartbeat and generation responses when set, e.g. {"heartbeat": 120, "generation": 30}.
+interval_hints = None
+
+# Whether the batch endpoint exists, and how many requests each endpoint got (batched messages count separately).
+batch_endpoint = True
+requests_received = {}
+# Request and response bytes per endpoint, headers included.
+bytes_received = {}
+bytes_sent = {}
+traffic_lock = threading.Lock()
+# Prints requests as they come in, --quiet turns it off for load tests.
+verbose = True
+
+def show(*values):
+    if verbose:
+        print(*values)
 
 def read_mock():
     with open(mock_msg_path, "r") as f:
         return f.read()
 
+def sign_config(config_text, have_hash=None):
+    # Wraps a services JSON document in a signed message, the format served by the dpl.
+    message = {"expiry": int((time.time() + config_expiry) * 1000)}
+    config = json.loads(config_text)
+    config_hash = studio_config_hash(config)
+    served_configs[config_hash] = config
+    if delta_updates and have_hash in served_configs and have_hash != config_hash:
+        patch = diff_config(served_configs[have_hash], config)
+        message["xnode_config_patch"] = base64.b64encode(json.dumps(patch).encode('utf-8')).decode('ascii')
+        message["base_hash"] = have_hash
+        message["config_hash"] = config_hash
+        served_kinds.append("patch")
+    else:
+        message["xnode_config"] = base64.b64encode(config_text.encode('utf-8')).decode('ascii')
+        served_kinds.append("full")
+    message = json.dumps(message)
+    message_hmac = hmac.new(base64.b64decode(xnode_access_token), msg = message.encode('utf-8'), digestmod='sha256').hexdigest()
+    return json.dumps({"message": message, "hmac": message_hmac})
+
+def node_generation(xnode_id):
+    # Generation values of one xnode, only call with generation_changed held.
+    if not per_node_generations:
+        return generation
+    if xnode_id not in node_generations:
+        node_generations[xnode_id] = dict(generation)
+    return node_generations[xnode_id]
+
+def header_bytes(headers):
+    return sum(len(key) + len(value) + 4 for key, value in headers.items())
+
+@app.before_request
+def count_request():
+    with traffic_lock:
+        requests_received[request.path] = requests_received.get(request.path, 0) + 1
+
+@app.after_request
+def count_bytes(response):
+    received = len(request.method) + len(request.full_path) + 12 + header_bytes(request.headers) + len(request.get_data())
+    sent = 17 + header_bytes(response.headers) + (response.calculate_content_length() or 0)
+    with traffic_lock:
+        bytes_received[request.path] = bytes_received.get(request.path, 0) + received
+        bytes_sent[request.path] = bytes_sent.get(request.path, 0) + sent
+    return response
+
 @app.route('/xnodes/functions/getXnodeServices', methods=['GET'])
 def serve_config():
-    print(request.headers)
+    show(request.headers)
     mockdata =read_mock()
-    print(mockdata)
-    return(mockdata)
+    request_message = request.get_json(silent=True, force=True) or {}
+    return app.response_class(sign_config(mockdata, request_message.get("haveHash")), mimetype='application/json')
 
 @app.route('/xnodes/functions/pushXnodeHeartbeat', methods=['POST'])
 def post_metrics():
-    print(request.headers)
+    show(request.headers)
     metric_data = json.loads(request.data)
-    print(metric_data)
+    show(metric_data)
+    heartbeats.append(metric_data)
     messages = metric_data # store in memory to return to read_metrics
+    if interval_hints != None:
+        return jsonify(dict(messages, intervals=interval_hints))
     return jsonify(messages)
 
+@app.route('/xnodes/functions/pushXnodeStatus', methods=['POST'])
+def post_status():
+    statuses.append(request.json["status"])
+    return jsonify(True)
+
+@app.route('/xnodes/functions/getXnodeGeneration', methods=['POST'])
+def serve_generation():
+    wait = request.json.get("wait", 0)
+    known = request.json.get("known")
+    xnode_id = request.json.get("id")
+    if not long_poll:
+        with generation_changed:
+            return jsonify(with_hints(node_generation(xnode_id)))
+
+    # Hold the request until the generation differs from what the agent already knows, or the wait runs out.
+    with generation_changed:
+        generation_changed.wait_for(lambda: known != node_generation(xnode_id), timeout=min(wait, 120))
+        response = with_hints(node_generation(xnode_id))
+    response["longPoll"] = True
+    return jsonify(response)
+
+def with_hints(body):
+    body = dict(body)
+    if interval_hints != None:
+        body["intervals"] = interval_hints
+    return body
+
+def push_generation(field):
+    with generation_changed:
+        node_generation(request.json.get("id"))[field] = int(request.json["generation"])
+        generation_changed.notify_all()
+    return jsonify(True)
+
+@app.route('/xnodes/functions/pushXnodeGenerationConfig', methods=['POST'])
+def push_generation_config():
+    return push_generation("configHave")
+
+@app.route('/xnodes/functions/pushXnodeGenerationUpdate', methods=['POST'])
+def push_generation_update():
+    return push_generation("updateHave")
+
+@app.route('/xnodes/functions/pushXnodeBatch', methods=['POST'])
+def serve_batch():
+    # Several messages under one hmac, answered with a result per message.
+    if not batch_endpoint:
+        return "Not found", 404
+    message_hmac = hmac.new(base64.b64decode(xnode_access_token), msg=json.dumps(request.json, separators=(',', ':')).encode('utf-8'), digestmod='sha256').hexdigest()
+    if not hmac.compare_digest(message_hmac, request.headers.get('X-Parse-Session-Token', '')):
+        return "Invalid hmac", 401
+
+    results = []
+    for message in request.json["messages"]:
+        body = message["body"]
+        if message["type"] == "pushXnodeHeartbeat":
+            heartbeats.append(body)
+            results.append({"ok": True, "body": with_hints({})})
+        elif message["type"] == "pushXnodeStatus":
+            statuses.append(body["status"])
+            results.append({"ok": True})
+        elif message["type"] == "getXnodeGeneration":
+            with generation_changed:
+                results.append({"ok": True, "body": with_hints(node_generation(body.get("id")))})
+        elif message["type"] in ["pushXnodeGenerationConfig", "pushXnodeGenerationUpdate"]:
+            with generation_changed:
+                node_generation(body.get("id"))["configHave" if message["type"] == "pushXnodeGenerationConfig" else "updateHave"] = int(body["generation"])
+                generation_changed.notify_all()
+            results.append({"ok": True})
+        else:
+            results.append({"ok": False, "error": "Unknown message type"})
+    return jsonify({"results": results})
+
+@app.route('/xnodes/bump', methods=['POST'])
+def bump_generation():
+    # Test helper, behaves like a user saving a config (or requesting an update) in the Studio.
+    bump_generation_values(request.json.get("config", 0), request.json.get("update", 0), request.json.get("id"))
+    with generation_changed:
+        return jsonify(node_generation(request.json.get("id")))
+
+def bump_generation_values(config=0, update=0, xnode_id=None):
+    with generation_changed:
+        values = node_generation(xnode_id)
+        values["configWant"] += int(config)
+        values["updateWant"] += int(update)
+        generation_changed.notify_all()
+
+@app.route('/xnodes/stats', methods=['GET'])
+def serve_stats():
+    # Test helper, what the mock received so far.
+    with traffic_lock:
+        return jsonify({"requests": requests_received, "bytesReceived": bytes_received, "bytesSent": bytes_sent})
 
 @app.route('/xnodes/functions', methods=['GET']) # Purely for testing, these metrics should be stored by the endpoint.
 def read_metrics():
@@ -44,15 +217,39 @@ def read_metrics():
 
 @app.route('/xnodes/validate_hmac', methods=['POST'])
 def validate_hmac():
-    print("With access token:",access_token)
+    show("With access token:",access_token)
     verified = None
     if access_token != "":
         msg_hmac = hmac.new(bytes(access_token, 'utf-8'), msg = bytes(json.dumps(request.json), 'utf-8'), digestmod='sha256').hexdigest()
         verified = hmac.compare_digest(msg_hmac, request.headers['X-Parse-Session-Token'])
-        print("HMAC", msg_hmac, "verification success:", verified)
+        show("HMAC", msg_hmac, "verification success:", verified)
     else:
-        print("Did not find a stored access token")
+        show("Did not find a stored access token")
         verified = request.headers['x-parse-session-token']
     return jsonify(verified)
 
-app.run(port=5000)
\ No newline at end of file
+def serve_in_background(port=0):
+    # Starts the mock on a background thread (port 0 picks a free one), returns the server and the functions url.
+    from werkzeug.serving import make_server
+    server = make_server("127.0.0.1", port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:" + str(server.server_port) + "/xnodes/functions"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock Xnode Studio functions API.")
+    parser.add_argument("mock_message", nargs="?", default=mock_msg_path, help="JSON file served as the xnode's services.")
+    parser.add_argument("--no-long-poll", action="store_true", help="Answer generation checks immediately, like a Studio without long-polling.")
+    parser.add_argument("--no-batch", action="store_true", help="Answer the batch endpoint with 404, like a Studio without it.")
+    parser.add_argument("--per-node-generations", action="store_true", help="Keep separate generation values for every xnode id.")
+    parser.add_argument("--quiet", action="store_true", help="Don't print requests.")
+    parser.add_argument("--port", type=int, default=5000)
+    args = parser.parse_args()
+    mock_msg_path = args.mock_message
+    long_poll = not args.no_long_poll
+    batch_endpoint = not args.no_batch
+    per_node_generations = args.per_node_generations
+    if args.quiet:
+        import logging
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        verbose = False
+    app.run(port=args.port, threaded=True)
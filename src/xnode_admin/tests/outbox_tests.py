@@ -0,0 +1,111 @@
+import asyncio
+import os
+import shutil
+import socket
+import tempfile
+from xnode_admin.outbox import Outbox, merge_heartbeats
+from xnode_admin.studio_client import StudioClient
+from xnode_admin.xnode_builder import StudioAgent
+from xnode_admin.tests import mock_studio_tests as mock_studio
+
+def heartbeat(cpu, peak):
+    return {"id": "uuid", "cpuPercent": cpu, "cpuPercentPeek": peak, "cpuPercentMin": cpu / 2, "ramMbTotal": 4096, "wantUpdate": True}
+
+def test_merge():
+    merged = merge_heartbeats(heartbeat(10, 50), heartbeat(40, 45), 3, 1)
+    assert merged["cpuPercent"] == 17.5
+    assert merged["cpuPercentPeek"] == 50
+    assert merged["cpuPercentMin"] == 5
+    assert merged["ramMbTotal"] == 4096 and merged["wantUpdate"] == True
+
+def test_compaction_and_bounds():
+    state_directory = tempfile.mkdtemp()
+    try:
+        outbox = Outbox(state_directory, max_messages=20, keep_heartbeats=3)
+        outbox.put("status", {"id": "uuid", "status": "building", "progress": {"pathsCopied": 1}}, now=1)
+        outbox.put("status", {"id": "uuid", "status": "building", "progress": {"pathsCopied": 5}}, now=2)
+        for i in range(10):
+            outbox.put("heartbeat", heartbeat(i * 10, i * 10 + 5), now=10 + i)
+        outbox.put("status", {"id": "uuid", "status": "online"}, now=30)
+
+        # Survives a restart.
+        outbox.close()
+        outbox = Outbox(state_directory, max_messages=20, keep_heartbeats=3)
+        batches = []
+        def send_batch(batch):
+            batches.append(batch)
+            return len(batch)
+        assert outbox.flush(send_batch, batch_size=4) == 6
+        messages = [message for batch in batches for message in batch]
+
+        # The two building statuses collapsed into the latest, the first seven heartbeats into one summary.
+        assert [kind for kind, _ in messages] == ["status"] + ["heartbeat"] * 4 + ["status"]
+        assert messages[0][1]["progress"] == {"pathsCopied": 5}
+        summary = messages[1][1]
+        assert summary["offlineSummary"] == {"heartbeats": 7, "from": 10, "to": 16}
+        assert summary["cpuPercent"] == 30 and summary["cpuPercentPeek"] == 65
+        assert messages[-1][1]["queuedAt"] == 30
+        assert outbox.pending() == 0
+
+        # Never more than max_messages, the oldest go first.
+        for i in range(30):
+            outbox.put("status", {"id": "uuid", "status": "status " + str(i)})
+        assert outbox.pending() == 20 and outbox.dropped == 10
+
+        # A partly delivered batch keeps the rest queued, in order.
+        assert outbox.flush(lambda batch: 2, batch_size=5) == 2
+        assert outbox.pending() == 18
+        outbox.close()
+    finally:
+        shutil.rmtree(state_directory)
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def test_studio_down_and_back():
+    state_directory = tempfile.mkdtemp()
+    port = free_port()
+    server, url = mock_studio.serve_in_background(port)
+    try:
+        agent = StudioAgent(StudioClient(url, connect_timeout=1, read_timeout=2), "uuid", mock_studio.xnode_access_token, state_directory)
+        mock_studio.heartbeats.clear()
+        mock_studio.statuses.clear()
+
+        async def run(steps):
+            for step in steps:
+                await step()
+
+        asyncio.run(run([lambda: agent.heartbeat(False), lambda: agent.status("online")]))
+        assert len(mock_studio.heartbeats) == 1 and mock_studio.statuses == ["online"]
+
+        # The Studio goes away: everything is queued, heartbeats beyond the newest ten are summarised.
+        server.shutdown()
+        server.server_close()
+        asyncio.run(run([lambda: agent.status("building")] + [lambda: agent.heartbeat(False)] * 15 + [lambda: agent.status("online")]))
+        assert agent.outbox.pending() == 1 + 11 + 1
+
+        # It comes back on the same address, the next status flushes the queue first, in order, without waiting for a
+        # heartbeat.
+        server, url = mock_studio.serve_in_background(port)
+        asyncio.run(agent.status("configuring"))
+        assert agent.outbox.pending() == 0
+        assert mock_studio.statuses == ["online", "building", "online", "configuring"]
+        assert len(mock_studio.heartbeats) == 1 + 1 + 10
+        asyncio.run(agent.heartbeat(True))
+        delivered = mock_studio.heartbeats[1:]
+        assert len(delivered) == 1 + 10 + 1
+        assert delivered[0]["offlineSummary"]["heartbeats"] == 5
+        assert all("queuedAt" in message for message in delivered[:-1])
+        assert "queuedAt" not in delivered[-1] and delivered[-1]["wantUpdate"] == True
+    finally:
+        server.shutdown()
+        agent.outbox.close()
+        shutil.rmtree(state_directory)
+
+if __name__ == "__main__":
+    test_merge()
+    test_compaction_and_bounds()
+    test_studio_down_and_back()
+    print("Outbox tests passed.")
@@ -0,0 +1,36 @@
+# Rebuild time with and without prefetching, against FakeNix. The fake build downloads the paths it's missing one after
+# the other (fetch_seconds each, like a slow link), the prefetcher spreads them over parallel nix-store processes.
+import asyncio
+import shutil
+import tempfile
+import time
+from xnode_admin import commands
+from xnode_admin import config_cache
+from xnode_admin import xnode_builder
+from xnode_admin.prefetch import Prefetcher
+from xnode_admin.tests.fake_nix import FakeNix
+
+paths = 200
+fetch_seconds = 0.01
+build_seconds = 0.2
+
+def rebuild_seconds(prefetcher):
+    state_directory = tempfile.mkdtemp()
+    fake = FakeNix(build_seconds=build_seconds, paths=paths, fetch_seconds=fetch_seconds)
+    previous = commands.set_runner(fake)
+    xnode_builder.current_system_path = config_cache.current_system_path = fake.current_system_path
+    try:
+        fake.write_lock(state_directory)
+        timings = {}
+        started = time.time()
+        assert asyncio.run(xnode_builder.os_rebuild(state_directory, timings=timings, prefetcher=prefetcher))
+        return time.time() - started, timings
+    finally:
+        commands.set_runner(previous)
+        shutil.rmtree(state_directory)
+        shutil.rmtree(fake.store_directory)
+
+print("%d paths to fetch, %.3fs each, %.2fs of building" % (paths, fetch_seconds, build_seconds))
+for name, prefetcher in [("no prefetch", None), ("1 job", Prefetcher(1)), ("4 jobs", Prefetcher(4)), ("16 jobs", Prefetcher(16))]:
+    seconds, timings = rebuild_seconds(prefetcher)
+    print("%-12s %.2fs (prefetch %.2fs, build %.2fs, switch %.2fs)" % (name, seconds, timings.get("prefetchSeconds", 0), timings["buildSeconds"], timings["switchSeconds"]))
@@ -0,0 +1,111 @@
+import asyncio
+import shutil
+import tempfile
+import time
+from xnode_admin import commands
+from xnode_admin import config_cache
+from xnode_admin import xnode_builder
+from xnode_admin.commands import ScriptedCommand, ScriptedRunner, command_name
+from xnode_admin.prefetch import Prefetcher, PrefetchProgress, parse_dry_run
+from xnode_admin.studio_client import StudioClient
+from xnode_admin.xnode_builder import StudioAgent
+from xnode_admin.tests import mock_studio_tests as mock_studio
+from xnode_admin.tests.fake_nix import FakeNix
+
+def test_parse_dry_run():
+    output = "\n".join([
+        "these 2 derivations will be built:",
+        "  /nix/store/aaaa-system.drv",
+        "  /nix/store/bbbb-etc.drv",
+        "these 3 paths will be fetched (1.50 MiB download, 6.00 MiB unpacked):",
+        "  /nix/store/cccc-glibc",
+        "  /nix/store/dddd-bash",
+        "  /nix/store/eeee-nginx",
+        "warning: Git tree '/var/lib/xnode' is dirty",
+        "  /nix/store/ffff-not-in-a-list",
+    ])
+    paths, download_bytes, derivations = parse_dry_run(output)
+    assert paths == ["/nix/store/cccc-glibc", "/nix/store/dddd-bash", "/nix/store/eeee-nginx"]
+    assert derivations == ["/nix/store/aaaa-system.drv", "/nix/store/bbbb-etc.drv"]
+    assert download_bytes == int(1.5 * 1024 * 1024)
+
+    # Older nix versions print a single path without a count.
+    assert parse_dry_run("this path will be fetched (0.03 MiB download, 0.10 MiB unpacked):\n  /nix/store/cccc-glibc\n") == (["/nix/store/cccc-glibc"], int(0.03 * 1024 * 1024), [])
+    assert parse_dry_run("") == ([], 0, [])
+
+def test_fetch():
+    paths = ["/nix/store/%032d-dependency" % i for i in range(16)]
+    realise = ScriptedCommand(r"nix-store --realise", delay=0.05)
+    runner = ScriptedRunner([realise])
+    previous = commands.set_runner(runner)
+    try:
+        # 4 batches of 4 paths with 4 jobs take about as long as one batch.
+        progress = PrefetchProgress(paths, 16 * 1024)
+        reports = []
+        async def on_progress(progress):
+            reports.append(progress.as_dict())
+        started = time.time()
+        asyncio.run(Prefetcher(parallelism=4, batch_size=4).fetch(paths, progress, on_progress, progress_interval=0))
+        assert time.time() - started < 0.15
+        assert sorted(path for args, _ in runner.calls for path in args[2:]) == paths
+        assert progress.paths_fetched == 16 and progress.fetched_bytes() == 16 * 1024
+        assert len(reports) == 4 and reports[-1]["pathsFetched"] == 16
+
+        # Failed batches are left to the build.
+        runner.calls.clear()
+        realise.returncode = 1
+        progress = PrefetchProgress(paths[:5], 5000)
+        asyncio.run(Prefetcher(parallelism=2, batch_size=2).fetch(paths[:5], progress))
+        assert len(runner.calls) == 3
+        assert progress.paths_failed == 5 and progress.fetched_bytes() == 0
+    finally:
+        commands.set_runner(previous)
+
+def test_agent_prefetches():
+    state_directory = tempfile.mkdtemp()
+    fake = FakeNix(paths=20, fetch_seconds=0.005)
+    previous = commands.set_runner(fake)
+    current_system_path = config_cache.current_system_path
+    xnode_builder.current_system_path = config_cache.current_system_path = fake.current_system_path
+    mock_studio.mock_msg_path = "mock_studio_message_v2.json"
+    server, url = mock_studio.serve_in_background()
+    try:
+        fake.write_lock(state_directory)
+        agent = StudioAgent(StudioClient(url), "uuid", mock_studio.xnode_access_token, state_directory, prefetcher=Prefetcher(parallelism=4, batch_size=5))
+
+        async def run():
+            agent.prepare()
+            mock_studio.generation.update({"configWant": 1, "configHave": 0, "updateWant": 0, "updateHave": 0})
+            await agent.apply_generation(dict(mock_studio.generation))
+            assert mock_studio.generation["configHave"] == 1
+
+            # Everything was downloaded before the build, which had nothing left to fetch.
+            names = [command_name(args) for args, _ in fake.calls]
+            assert names.index("nix build") < names.index("nix-store") < names.index("nixos-rebuild build")
+            assert names.count("nix-store") == 4
+            assert fake.missing_paths() == [] and fake.build.delay == 0
+            assert "prefetchSeconds" in agent.rebuild_report
+
+            # The update check prefetches the new revision's paths, so the update downloads nothing.
+            fake.release()
+            assert len(fake.missing_paths()) == 20
+            assert await xnode_builder.flake_update_check(state_directory, None, agent.prefetcher)
+            assert fake.missing_paths() == []
+            fake.calls.clear()
+            mock_studio.generation.update({"updateWant": 1})
+            await agent.apply_generation(dict(mock_studio.generation))
+            assert mock_studio.generation["updateHave"] == 1
+            assert "nix-store" not in [command_name(args) for args, _ in fake.calls]
+        asyncio.run(run())
+    finally:
+        server.shutdown()
+        commands.set_runner(previous)
+        xnode_builder.current_system_path = config_cache.current_system_path = current_system_path
+        shutil.rmtree(state_directory)
+        shutil.rmtree(fake.store_directory)
+
+if __name__ == "__main__":
+    test_parse_dry_run()
+    test_fetch()
+    test_agent_prefetches()
+    print("Prefetch tests passed.")
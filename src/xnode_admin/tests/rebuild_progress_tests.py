@@ -0,0 +1,40 @@
+from xnode_admin.rebuild_progress import RebuildProgress
+
+sample_output = """building the system configuration...
+these 2 derivations will be built:
+  /nix/store/aaaa-etc.drv
+  /nix/store/bbbb-nixos-system-xnode.drv
+these 3 paths will be fetched (12.50 MiB download, 40.00 MiB unpacked):
+  /nix/store/cccc-minecraft-server-1.20
+copying path '/nix/store/cccc-minecraft-server-1.20' from 'https://cache.nixos.org'...
+copying path '/nix/store/dddd-jre-headless' from 'https://cache.nixos.org'...
+building '/nix/store/aaaa-etc.drv'...
+building '/nix/store/bbbb-nixos-system-xnode.drv'...
+activating the configuration...
+"""
+
+def test_progress_counters():
+    progress = RebuildProgress()
+    for line in sample_output.splitlines():
+        progress.feed(line)
+
+    summary = progress.as_dict()
+    assert summary["derivationsTotal"] == 2
+    assert summary["derivationsBuilt"] == 2
+    assert summary["pathsTotal"] == 3
+    assert summary["pathsCopied"] == 2
+    assert summary["downloadBytes"] == int(12.5 * 1024 * 1024)
+    assert summary["current"] == "/nix/store/bbbb-nixos-system-xnode.drv"
+
+def test_log_is_bounded():
+    progress = RebuildProgress(log_lines=10, max_line_length=20)
+    for i in range(10000):
+        progress.feed("line " + str(i) + " " + "x" * 100)
+
+    assert len(progress.log) == 10
+    assert progress.log[-1] == ("line 9999 " + "x" * 100)[:20]
+
+if __name__ == "__main__":
+    test_progress_counters()
+    test_log_is_bounded()
+    print("Rebuild progress tests passed.")
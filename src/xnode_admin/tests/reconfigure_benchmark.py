@@ -0,0 +1,79 @@
+# End to end reconfigure and update cycles against the mock Studio, with FakeNix in place of nix, so the pipeline can be
+# timed on any Linux machine. The fake build takes build_seconds, what's left of a cycle is the agent's own overhead.
+import asyncio
+import contextlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from xnode_admin import commands
+from xnode_admin import config_cache
+from xnode_admin import exporter
+from xnode_admin import xnode_builder
+from xnode_admin.studio_client import StudioClient
+from xnode_admin.xnode_builder import StudioAgent
+from xnode_admin.tests import mock_studio_tests as mock_studio
+from xnode_admin.tests.fake_nix import FakeNix
+
+cycles = 20
+build_seconds = 0.2
+switch_seconds = 0.05
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+def run_cycles():
+    state_directory = tempfile.mkdtemp()
+    fake = FakeNix(build_seconds=build_seconds, switch_seconds=switch_seconds)
+    commands.set_runner(fake)
+    xnode_builder.current_system_path = config_cache.current_system_path = fake.current_system_path
+
+    # Every reconfigure serves a different config, alternating an option.
+    with open("mock_studio_message_v2.json", "r") as f:
+        config = json.load(f)
+    config_path = os.path.join(state_directory, "studio-config.json")
+    mock_studio.mock_msg_path = config_path
+    server, url = mock_studio.serve_in_background()
+    try:
+        fake.write_lock(state_directory)
+        agent = StudioAgent(StudioClient(url), "uuid", mock_studio.xnode_access_token, state_directory)
+        reconfigure, update = [], []
+
+        async def run():
+            agent.prepare()
+            for i in range(cycles):
+                config["services"][0]["options"][0]["value"] = "true" if i % 2 == 0 else "false"
+                with open(config_path, "w") as f:
+                    json.dump(config, f)
+                mock_studio.generation["configWant"] += 1
+                started = time.time()
+                await agent.apply_generation(dict(mock_studio.generation))
+                reconfigure.append(time.time() - started)
+
+                fake.release()
+                started = time.time()
+                found = await xnode_builder.flake_update_check(state_directory)
+                mock_studio.generation["updateWant"] += 1
+                await agent.apply_generation(dict(mock_studio.generation))
+                update.append(time.time() - started)
+                assert found
+
+        # The mock Studio prints request headers, keep those out of the results.
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            asyncio.run(run())
+        assert mock_studio.generation["configHave"] == cycles and mock_studio.generation["updateHave"] == cycles
+        return reconfigure, update
+    finally:
+        server.shutdown()
+        shutil.rmtree(state_directory)
+        shutil.rmtree(fake.store_directory)
+
+mock_studio.generation.update({"configWant": 0, "configHave": 0, "updateWant": 0, "updateHave": 0})
+reconfigure, update = run_cycles()
+print("%d cycles, fake build %.2fs, fake switch %.2fs" % (cycles, build_seconds, switch_seconds))
+for name, times in [("reconfigure", reconfigure), ("update check + update", update)]:
+    print("%s: p50 %.3fs, p99 %.3fs" % (name, percentile(times, 0.5), percentile(times, 0.99)))
+for (command, result), (_, total, count) in sorted(exporter.command_seconds.snapshot().items()):
+    print("  %-32s %-6s %4d runs, %.3fs on average" % (command, result, count, total / count))
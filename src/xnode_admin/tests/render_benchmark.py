@@ -0,0 +1,46 @@
+# Compares the original recursive string-concatenation renderer with nix_renderer on a 10k option config.
+import time
+from xnode_admin.utils import parse_nix_json
+from xnode_admin.nix_renderer import render_studio_config
+
+def generate_config(service_count=100, options_per_service=100):
+    services = []
+    for s in range(service_count):
+        options = []
+        for o in range(options_per_service):
+            if o % 4 == 0:
+                options.append({"nixName": "serverProperties.option-" + str(o), "type": "int", "value": str(o)})
+            else:
+                options.append({"nixName": "option" + str(o), "type": "string", "value": "value " + str(o)})
+        services.append({"name": "Service " + str(s), "desc": "Generated", "nixName": "service" + str(s), "options": options})
+    return {"services": services}
+
+def legacy_render(studio_json_config):
+    new_sys_config = "{ config, pkgs, ... }:\n{\n  "
+    for module_config in studio_json_config:
+        new_sys_config += module_config + " = {\n  "
+        for submodule in studio_json_config[module_config]:
+            new_sys_config += parse_nix_json(submodule)
+        new_sys_config += "};\n"
+    new_sys_config += "\n}"
+    return new_sys_config
+
+def best_of(functions, config, runs=50):
+    # Runs the functions in turns so a slower moment of the machine affects them alike, returns the best time of each.
+    best = [None] * len(functions)
+    for _ in range(runs):
+        for i, function in enumerate(functions):
+            start = time.perf_counter()
+            function(config)
+            elapsed = time.perf_counter() - start
+            if best[i] == None or elapsed < best[i]:
+                best[i] = elapsed
+    return best
+
+config = generate_config()
+legacy_seconds, renderer_seconds = best_of([legacy_render, render_studio_config], config)
+
+print("Options rendered:", sum(len(service["options"]) for service in config["services"]))
+print("Legacy renderer:   %.2f ms" % (legacy_seconds * 1000))
+print("List-join renderer: %.2f ms" % (renderer_seconds * 1000))
+print("Speed-up: %.2fx" % (legacy_seconds / renderer_seconds))
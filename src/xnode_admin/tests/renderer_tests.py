@@ -0,0 +1,48 @@
+import json
+from xnode_admin.nix_renderer import render_nix_modules, render_studio_config
+
+# Output of the original string-concatenation renderer for the mock Studio messages.
+expected_v1 = '  minecraft-server = {\n    enable = true;\n    eula = true;\n    declarative = true;\n    openFirewall = true;\n    serverProperties.max-players = 100;\n  };\n'
+
+expected_v2 = '{ config, pkgs, ... }:\n{\n  services = {\n    minecraft-server = {\n    eula = true;\n    declarative = true;\n    openFirewall = true;\n    serverProperties.max-players = 100;\n  };\n  openssh = {\n    settings.PasswordAuthentication = false;\n    settings.KbdInteractiveAuthentication = false;\n  };\n  ollama = {\n    acceleration = "cuda";\n  };\n  headscale = {\n    address = "0.0.0.0";\n    port = 10101;\n    log.level = "json";\n  };\n};\nnetworking = {\n    firewall = {\n    enable = true;\n  };\n};\n\n}'
+
+def test_mock_fixtures():
+    with open("mock_studio_message.json", "r") as f:
+        assert render_nix_modules(json.load(f)) == expected_v1
+    with open("mock_studio_message_v2.json", "r") as f:
+        assert render_studio_config(json.load(f)) == expected_v2
+
+def test_dotted_paths_and_merging():
+    modules = [
+        {"nixName": "minecraft-server", "options": [
+            {"nixName": "eula", "type": "boolean", "value": "true"},
+            {"nixName": "serverProperties.max-players", "type": "int", "value": "10"},
+            {"nixName": "serverProperties.motd", "type": "string", "value": "hi"},
+        ]},
+        {"nixName": "minecraft-server", "options": [
+            {"nixName": "serverProperties", "options": [
+                {"nixName": "difficulty", "type": "int", "value": "2"},
+            ]},
+        ]},
+        {"nixName": "nginx", "options": [
+            {"nixName": "virtualHosts.default.root", "type": "path", "value": "/var/www"},
+        ]},
+    ]
+    assert render_nix_modules(modules) == (
+        "  minecraft-server = {\n"
+        "    eula = true;\n"
+        "    serverProperties = {\n"
+        "      max-players = 10;\n"
+        "      motd = \"hi\";\n"
+        "      difficulty = 2;\n"
+        "    };\n"
+        "  };\n"
+        "  nginx = {\n"
+        "    virtualHosts.default.root = /var/www;\n"
+        "  };\n"
+    )
+
+if __name__ == "__main__":
+    test_mock_fixtures()
+    test_dotted_paths_and_merging()
+    print("Renderer tests passed.")
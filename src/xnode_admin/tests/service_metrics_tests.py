@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+from xnode_admin.service_metrics import ServiceCollector, config_service_names
+
+# Fake cgroup trees live on tmpfs when available, like the real /sys/fs/cgroup.
+fixture_parent = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+def write_unit(cgroup_root, unit, cpu_usec, memory_bytes, rbytes, wbytes):
+    unit_path = os.path.join(cgroup_root, "system.slice", unit)
+    os.makedirs(unit_path, exist_ok=True)
+    with open(os.path.join(unit_path, "cpu.stat"), "w") as f:
+        f.write("usage_usec " + str(cpu_usec) + "\nuser_usec 0\nsystem_usec 0\n")
+    with open(os.path.join(unit_path, "memory.current"), "w") as f:
+        f.write(str(memory_bytes) + "\n")
+    with open(os.path.join(unit_path, "io.stat"), "w") as f:
+        f.write("8:0 rbytes=" + str(rbytes) + " wbytes=" + str(wbytes) + " rios=1 wios=1 dbytes=0 dios=0\n")
+        f.write("259:0 rbytes=" + str(rbytes) + " wbytes=0 rios=1 wios=0 dbytes=0 dios=0\n")
+
+def test_deltas_and_restarts():
+    cgroup_root = tempfile.mkdtemp(dir=fixture_parent)
+    try:
+        collector = ServiceCollector(cgroup_root)
+        collector.set_services(config_service_names({"services": [{"nixName": "minecraft-server"}, {"nixName": "openssh"}]}))
+
+        write_unit(cgroup_root, "minecraft-server.service", 1000000, 512 * 1024 * 1024, 100, 200)
+        services = collector.collect(now=100.0)
+        assert services["minecraft-server"]["active"]
+        assert services["minecraft-server"]["cpuPercent"] == 0.0
+        assert services["minecraft-server"]["ramMbUsed"] == 512
+        assert services["openssh"] == {"unit": "sshd.service", "active": False, "restarts": 0}
+
+        # One second of CPU over ten seconds of wall time, plus some IO.
+        write_unit(cgroup_root, "minecraft-server.service", 2000000, 256 * 1024 * 1024, 1100, 700)
+        services = collector.collect(now=110.0)
+        expected_percent = 10.0 / (os.cpu_count() or 1)
+        assert abs(services["minecraft-server"]["cpuPercent"] - expected_percent) < 1e-9
+        assert services["minecraft-server"]["ioReadBytes"] == 2000
+        assert services["minecraft-server"]["ioWriteBytes"] == 500
+        assert services["minecraft-server"]["restarts"] == 0
+
+        # A restarted unit gets a new cgroup with counters starting from zero.
+        shutil.rmtree(os.path.join(cgroup_root, "system.slice", "minecraft-server.service"))
+        write_unit(cgroup_root, "minecraft-server.service", 5000, 1024 * 1024, 0, 0)
+        services = collector.collect(now=120.0)
+        assert services["minecraft-server"]["restarts"] == 1
+        assert services["minecraft-server"]["cpuPercent"] == 0.0
+
+        # Removing a service from the config drops its state.
+        collector.set_services(["openssh"])
+        assert "minecraft-server.service" not in collector.previous
+    finally:
+        shutil.rmtree(cgroup_root)
+
+if __name__ == "__main__":
+    test_deltas_and_restarts()
+    print("Service metrics tests passed.")
@@ -0,0 +1,48 @@
+# Compares the original generate_hmac with MessageSigner for heartbeat-sized and config-sized messages.
+import base64
+import contextlib
+import hmac
+import json
+import tempfile
+import time
+from xnode_admin.signing import MessageSigner
+
+access_token = "Tah6WlMnal0mpka6ki8jHmoD9hhK9KXc81xyNjvSt1hm1nj74dlM4W8jPEdPdmSJD1JVba+eDHEceUysRZnplw=="
+preshared_key = base64.b64decode(access_token).hex()
+
+def legacy_generate_hmac(access_token, message):
+    msg_hmac_hex = ""
+
+    if isinstance(message, dict):
+        print("generating hmac for dict")
+        json_str = json.dumps(message).replace(", ", ",").replace(": ", ":")
+    else:
+        json_str = message
+    msg_hmac_hex = hmac.new(bytes.fromhex(access_token), msg = bytes(json_str, 'utf-8'), digestmod='sha256').hexdigest()
+    print("Generated HMAC", msg_hmac_hex, "for message:", json_str)
+    return msg_hmac_hex
+
+heartbeat = {
+    "id": "I5KMFECV11H-VX5K78G4P7I",
+    "cpuPercent": 12.5, "cpuPercentPeek": 80.0, "ramMbUsed": 2048.0, "ramMbPeek": 3000.0, "ramMbTotal": 16000.0,
+    "storageMbUsed": 20000.0, "storageMbTotal": 100000.0,
+}
+config_payload = base64.b64encode(json.dumps({"services": [{"nixName": "service" + str(i), "options": []} for i in range(100000)]}).encode()).decode()
+config_message = json.dumps({"expiry": 0, "xnode_config": config_payload})
+
+def per_call(function, message, runs):
+    start = time.perf_counter()
+    for _ in range(runs):
+        function(message)
+    return (time.perf_counter() - start) / runs
+
+signer = MessageSigner(preshared_key)
+# The legacy version prints the key-derived HMAC and the message, send it to a file like journald would receive it.
+with tempfile.TemporaryFile("w") as log, contextlib.redirect_stdout(log):
+    legacy_heartbeat = per_call(lambda message: legacy_generate_hmac(preshared_key, message), heartbeat, 20000)
+    legacy_config = per_call(lambda message: legacy_generate_hmac(preshared_key, message), config_message, 20)
+signer_heartbeat = per_call(signer.sign, heartbeat, 20000)
+signer_config = per_call(signer.sign, config_message, 20)
+
+print("Heartbeat (%d bytes): legacy %.1f us, signer %.1f us" % (len(json.dumps(heartbeat)), legacy_heartbeat * 1e6, signer_heartbeat * 1e6))
+print("Config (%.1f MB): legacy %.2f ms, signer %.2f ms" % (len(config_message) / 1e6, legacy_config * 1e3, signer_config * 1e3))
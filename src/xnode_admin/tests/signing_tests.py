@@ -0,0 +1,47 @@
+import hashlib
+import hmac
+import json
+from xnode_admin.signing import MessageSigner, canonical_json
+
+key = bytes(range(64))
+
+def test_matches_studio_scheme():
+    message = {"id": "I5KMFECV11H-VX5K78G4P7I", "status": "online"}
+    expected = hmac.new(key, msg=b'{"id":"I5KMFECV11H-VX5K78G4P7I","status":"online"}', digestmod='sha256').hexdigest()
+    signer = MessageSigner(key)
+    assert signer.sign(message) == expected
+    # Hex keys, the form the agent used to pass around, give the same result.
+    assert MessageSigner(key.hex()).sign(message) == expected
+    # Signing is repeatable, the precomputed key state isn't consumed.
+    assert signer.sign(message) == expected
+
+def test_string_values_are_not_rewritten():
+    # The old .replace(", ", ",") approach changed values like this one.
+    message = {"desc": "Hello, world: again"}
+    assert canonical_json(message) == b'{"desc":"Hello, world: again"}'
+    expected = hmac.new(key, msg=canonical_json(message), digestmod='sha256').hexdigest()
+    assert MessageSigner(key).sign(message) == expected
+
+def test_verify():
+    signer = MessageSigner(key)
+    message = json.dumps({"expiry": 1, "xnode_config": "e30="})
+    claimed = signer.sign(message)
+    assert signer.verify(message, claimed)
+    assert not signer.verify(message, claimed[:-1] + ("0" if claimed[-1] != "0" else "1"))
+    assert not signer.verify(message, None)
+    assert not signer.verify(message, "ünicode")
+
+def test_incremental():
+    signer = MessageSigner(key)
+    message = b"x" * 100000
+    incremental = signer.incremental()
+    for i in range(0, len(message), 4096):
+        incremental.update(message[i:i + 4096])
+    assert incremental.hexdigest() == signer.sign(message)
+
+if __name__ == "__main__":
+    test_matches_studio_scheme()
+    test_string_values_are_not_rewritten()
+    test_verify()
+    test_incremental()
+    print("Signing tests passed.")
@@ -0,0 +1,153 @@
+import asyncio
+import shutil
+import tempfile
+import threading
+from xnode_admin.generation_poller import GenerationPoller
+from xnode_admin import xnode_builder
+from xnode_admin.studio_client import StudioClient
+from xnode_admin.xnode_builder import StudioAgent
+from xnode_admin.tests import mock_studio_tests as mock_studio
+
+# Stand-ins for the two rebuild phases, so the pipeline can run without nix.
+phases = []
+build_result = "/nix/store/aaaa-nixos-system-xnode"
+switch_result = True
+
+async def fake_build(state_directory, on_progress=None, progress_interval=5):
+    phases.append("build")
+    return build_result
+
+async def fake_switch(system_path):
+    phases.append("switch " + system_path)
+    return switch_result
+
+def stub_rebuild():
+    # Swaps the stand-ins in for the duration of a test, returns the real phases to put back.
+    previous = xnode_builder.os_build, xnode_builder.os_switch
+    xnode_builder.os_build, xnode_builder.os_switch = fake_build, fake_switch
+    return previous
+
+def apply_generation(agent):
+    async def run():
+        agent.prepare()
+        await agent.apply_generation(dict(mock_studio.generation))
+    asyncio.run(run())
+
+def reset(config_want, config_have):
+    phases.clear()
+    mock_studio.statuses.clear()
+    mock_studio.generation.update({"configWant": config_want, "configHave": config_have})
+
+def test_staged_pipeline():
+    global build_result, switch_result
+    state_directory = tempfile.mkdtemp()
+    mock_studio.mock_msg_path = "mock_studio_message_v2.json"
+    server, url = mock_studio.serve_in_background()
+    previous = stub_rebuild()
+    try:
+        agent = StudioAgent(StudioClient(url), "uuid", mock_studio.xnode_access_token, state_directory)
+
+        # A failed build never switches, and the generation isn't acknowledged.
+        build_result = None
+        reset(1, 0)
+        apply_generation(agent)
+        assert phases == ["build"]
+        assert mock_studio.statuses == ["building", "online"]
+        assert mock_studio.generation["configHave"] == 0
+        assert "buildSeconds" in agent.rebuild_report and "switchSeconds" not in agent.rebuild_report
+        assert agent.config_store.config == None
+
+        # The failed generation isn't fetched again, and the same config isn't built again either when it comes with the
+        # next generation, until the Studio sends a different one.
+        fetches = mock_studio.requests_received.get("/xnodes/functions/getXnodeServices", 0)
+        reset(1, 0)
+        apply_generation(agent)
+        assert phases == [] and mock_studio.requests_received.get("/xnodes/functions/getXnodeServices", 0) == fetches
+        reset(2, 0)
+        apply_generation(agent)
+        assert phases == [] and mock_studio.requests_received.get("/xnodes/functions/getXnodeServices", 0) == fetches + 1
+
+        # A failed switch leaves the generation alone too.
+        build_result = "/nix/store/aaaa-nixos-system-xnode"
+        switch_result = False
+        agent.failed_config_hash = None
+        reset(3, 0)
+        apply_generation(agent)
+        assert phases == ["build", "switch /nix/store/aaaa-nixos-system-xnode"]
+        assert mock_studio.generation["configHave"] == 0
+        assert agent.config_store.config == None
+
+        # Build, switch, and only then push the generation.
+        switch_result = True
+        agent.failed_config_hash = None
+        reset(4, 0)
+        apply_generation(agent)
+        assert phases == ["build", "switch /nix/store/aaaa-nixos-system-xnode"]
+        assert mock_studio.statuses == ["building", "configuring", "online"]
+        assert mock_studio.generation["configHave"] == 4
+        assert agent.rebuild_report["buildSeconds"] >= 0 and agent.rebuild_report["switchSeconds"] >= 0
+        assert agent.system_cache.lookup(xnode_builder.config_hash(state_directory)) == build_result
+        assert agent.config_store.generation == 4 and agent.config_store.config != None
+    finally:
+        xnode_builder.os_build, xnode_builder.os_switch = previous
+        server.shutdown()
+        shutil.rmtree(state_directory)
+
+def check_coalesced_burst(long_poll):
+    global build_result, switch_result
+    build_result = "/nix/store/bbbb-nixos-system-xnode"
+    switch_result = True
+    state_directory = tempfile.mkdtemp()
+    mock_studio.mock_msg_path = "mock_studio_message_v2.json"
+    mock_studio.long_poll = long_poll
+    server, url = mock_studio.serve_in_background()
+    previous = stub_rebuild()
+    try:
+        poller = GenerationPoller(base_interval=0.2, long_poll_wait=5, quiet_period=1, max_settle=10)
+        agent = StudioAgent(StudioClient(url), "uuid", mock_studio.xnode_access_token, state_directory, generation_poller=poller)
+        reset(0, 0)
+
+        async def run():
+            agent.prepare()
+            # A user saving four times within a second, the quiet period only ends after the last one.
+            mock_studio.bump_generation_values(config=1)
+            for delay in [0.3, 0.6, 0.9]:
+                threading.Timer(delay, mock_studio.bump_generation_values, kwargs={"config": 1}).start()
+            generation_data = await asyncio.to_thread(xnode_builder.check_generation, agent.studio, "uuid", agent.signer)
+            poller.record(generation_data, 0)
+            generation_data = await agent.settle_generation(generation_data)
+            await agent.apply_generation(generation_data)
+
+        asyncio.run(run())
+        assert phases == ["build", "switch /nix/store/bbbb-nixos-system-xnode"], phases
+        assert mock_studio.generation["configWant"] == 4, mock_studio.generation
+        assert mock_studio.generation["configHave"] == 4
+    finally:
+        xnode_builder.os_build, xnode_builder.os_switch = previous
+        mock_studio.long_poll = True
+        server.shutdown()
+        shutil.rmtree(state_directory)
+
+def test_coalesced_burst_long_poll():
+    check_coalesced_burst(long_poll=True)
+
+def test_coalesced_burst_polling():
+    check_coalesced_burst(long_poll=False)
+
+def test_quiet_period_disabled():
+    poller = GenerationPoller(quiet_period=0)
+    agent = StudioAgent(None, "uuid", mock_studio.xnode_access_token, tempfile.gettempdir(), generation_poller=poller)
+    generation_data = {"configWant": 3, "configHave": 1, "updateWant": 0, "updateHave": 0}
+    assert asyncio.run(agent.settle_generation(generation_data)) == generation_data
+
+    # A generation that already failed isn't settled again either.
+    agent = StudioAgent(None, "uuid", mock_studio.xnode_access_token, tempfile.gettempdir(), generation_poller=GenerationPoller(quiet_period=60))
+    agent.failed_generation = 3
+    assert asyncio.run(agent.settle_generation(generation_data)) == generation_data
+
+if __name__ == "__main__":
+    test_staged_pipeline()
+    test_coalesced_burst_long_poll()
+    test_coalesced_burst_polling()
+    test_quiet_period_disabled()
+    print("Staged rebuild tests passed.")
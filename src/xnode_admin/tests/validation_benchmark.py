@@ -0,0 +1,61 @@
+# Cost of validating a 10k option config, on its own and against an option index covering a 20k option catalog.
+import json
+import os
+import shutil
+import tempfile
+import time
+from xnode_admin.config_validation import OptionIndex, validate_config
+
+TYPES = [
+    ("boolean", "true"),
+    ("signed integer", "25565"),
+    ("16 bit unsigned integer; between 0 and 65535 (both inclusive)", "8080"),
+    ("string", 'motd with "quotes" and ${braces}'),
+    ("list of string", '["a", "b", "c"]'),
+    ("null or one of \"debug\", \"info\", \"warn\"", "info"),
+    ("attribute set of (list of string)", '{"a": ["b"]}'),
+    ("absolute path", "/var/lib/service"),
+]
+
+def generate_config(service_count=100, options_per_service=100):
+    services, index = [], {}
+    for s in range(service_count):
+        options = []
+        for o in range(options_per_service):
+            type_name, value = TYPES[o % len(TYPES)]
+            options.append({"nixName": "option" + str(o), "type": type_name, "value": value})
+            index["services.service" + str(s) + ".option" + str(o)] = type_name
+            # Options the config doesn't set, as a real catalog has.
+            index["services.service" + str(s) + ".unset" + str(o)] = type_name
+        services.append({"nixName": "service" + str(s), "options": options})
+    return {"services": services}, index
+
+def best_of(function, runs=5):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        if best == None or elapsed < best:
+            best = elapsed
+    return best
+
+config, option_types = generate_config()
+options = sum(len(service["options"]) for service in config["services"])
+
+directory = tempfile.mkdtemp()
+try:
+    path = os.path.join(directory, "options.json")
+    with open(path, "w") as f:
+        json.dump(option_types, f)
+    start = time.perf_counter()
+    index = OptionIndex.load(path)
+    load_seconds = time.perf_counter() - start
+finally:
+    shutil.rmtree(directory)
+
+assert validate_config(config, index) == []
+plain = best_of(lambda: validate_config(config))
+indexed = best_of(lambda: validate_config(config, index))
+print("%d options: %.1f ms (%.2f us per option), with the option index %.1f ms (%.2f us per option)" % (options, plain * 1000, plain / options * 1e6, indexed * 1000, indexed / options * 1e6))
+print("Loading an index of %d options: %.1f ms" % (len(option_types), load_seconds * 1000))
@@ -1,9 +1,13 @@
+import logging
 import sys
 import git
-import hmac
-import json
 import argparse
 
+from xnode_admin.config_validation import render_value
+from xnode_admin.signing import MessageSigner
+
+log = logging.getLogger(__name__)
+
 def parse_cmd_args():
     parser = argparse.ArgumentParser(description="Xnode Admin service daemon that manages XnodeOS from the Xnode Studio.", formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument("state_directory", help="Directory to store the xnode's configuration in", type=str, default="/var/lib/openmesh-xnode-admin")
@@ -16,6 +20,37 @@ def parse_cmd_args():
     parser.add_argument("--git-mode", help="Use git-based configuration instead of the Xnode functions API.", action="store_true")
     parser.add_argument("--git-key", help="Optional git key used to verify commit signatures.", type=str)
     parser.add_argument("--key-type", help="Type of key (ssh or gpg) used for git commit verification", type=str, default="ssh-ed25519")
+    parser.add_argument("--pool-size", help="Maximum number of keep-alive connections to the Xnode functions API.", type=int, default=4)
+    parser.add_argument("--connect-timeout", help="Timeout in seconds for connecting to the Xnode functions API.", type=float, default=5.0)
+    parser.add_argument("--read-timeout", help="Timeout in seconds for reading a response from the Xnode functions API.", type=float, default=30.0)
+    parser.add_argument("--max-config-size", help="Largest configuration download accepted from the Studio, in MB.", type=int, default=64)
+    parser.add_argument("--option-index", help="JSON file with the type of every NixOS option (e.g. from NixScraper), configs are checked against it before rebuilding.", type=str)
+    parser.add_argument("--prefetch-jobs", help="Download the store paths of a new system with this many parallel nix-store processes before building it, 0 leaves downloading to nixos-rebuild.", type=int, default=0)
+    parser.add_argument("--prefetch-batch", help="Store paths fetched by each prefetch process at a time.", type=int, default=16)
+    parser.add_argument("--generation-interval", help="Seconds between generation checks when the Studio can't long-poll.", type=float, default=10)
+    parser.add_argument("--generation-max-interval", help="Upper bound in seconds for backing off generation checks while nothing changes.", type=float, default=60)
+    parser.add_argument("--config-quiet-period", help="Seconds the config generation has to stay unchanged before rebuilding, 0 rebuilds straight away.", type=float, default=5)
+    parser.add_argument("--config-max-settle", help="Longest time in seconds a config change is held back waiting for a quiet period.", type=float, default=60)
+    parser.add_argument("--long-poll-wait", help="Seconds the Studio may hold a generation check open, 0 disables long-polling.", type=int, default=60)
+    parser.add_argument("--heartbeat-interval", help="Seconds between heartbeats while usage changes, the shortest interval the Studio can ask for.", type=float, default=30)
+    parser.add_argument("--max-heartbeat-interval", help="Upper bound in seconds for backing off heartbeats while usage is stable.", type=float, default=300)
+    parser.add_argument("--heartbeat-change-threshold", help="Percentage points CPU, memory or disk usage has to move between heartbeats to count as a change.", type=float, default=5)
+    parser.add_argument("--cpu-threshold", help="CPU usage percentage that sends a heartbeat straight away when crossed.", type=float, default=90)
+    parser.add_argument("--memory-threshold", help="Memory usage percentage that sends a heartbeat straight away when crossed.", type=float, default=90)
+    parser.add_argument("--disk-threshold", help="Disk usage percentage that sends a heartbeat straight away when crossed.", type=float, default=90)
+    parser.add_argument("--sample-interval", help="Seconds between metric samples.", type=float, default=1)
+    parser.add_argument("--rebuild-sample-interval", help="Seconds between metric samples while a rebuild or update runs.", type=float, default=0.25)
+    parser.add_argument("--update-check-interval", help="Seconds between update checks, the shortest interval the Studio can ask for.", type=float, default=60 * 60 * 8)
+    parser.add_argument("--max-update-check-interval", help="Longest interval in seconds between update checks the Studio can ask for.", type=float, default=60 * 60 * 24)
+    parser.add_argument("--gc-watermark", help="Disk usage percentage above which the nix store is garbage collected.", type=float, default=80.0)
+    parser.add_argument("--gc-min-free", help="Garbage collect the nix store when less than this many MB are free.", type=int, default=2048)
+    parser.add_argument("--gc-max-freed", help="Maximum MB to free in a single garbage collection, 0 for no limit.", type=int, default=0)
+    parser.add_argument("--gc-keep-generations", help="Number of system generations kept when garbage collecting, 0 keeps all.", type=int, default=3)
+    parser.add_argument("--metrics-listen", help="Serve Prometheus metrics and /health on a localhost port, host:port, or unix socket path. Off by default.", type=str)
+    parser.add_argument("--log-level", help="Lowest level logged: DEBUG, INFO, WARNING or ERROR.", type=str.upper, default="INFO")
+    parser.add_argument("--log-format", help="json for one JSON object per line (journald), text for reading by hand.", choices=["json", "text"], default="json")
+    parser.add_argument("--log-burst", help="Messages logged per call site every --log-interval seconds before repeats are suppressed, 0 disables.", type=int, default=10)
+    parser.add_argument("--log-interval", help="Window in seconds for --log-burst.", type=float, default=60)
 
     return parser.parse_args()
 
@@ -27,7 +62,7 @@ def parse_all_args():
         return args
     else:
         # Read extra arguments from /proc/cmdline
-        print("Reading extra arguments from", args.proc)
+        log.info("Reading extra arguments from %s", args.proc)
         with open(args.proc, 'r') as cmdline:
             kernel_parameters = cmdline.read().split(" ")
 
@@ -76,7 +111,6 @@ def parse_nix_json(json_nix):
         };
     """
     # If we are in a list (eg. services or options) parse each item recursively
-    print(type(json_nix))
     if isinstance(json_nix, list):
         nix_in_progress = ""
         for item in json_nix:
@@ -93,67 +127,14 @@ def parse_nix_json(json_nix):
             return "    " + json_nix["nixName"] + " = " + parse_nix_primitive(json_nix["type"], json_nix["value"]) + ";\n"
 
     else:
-        print("Invalid input:", json_nix)
-        print("Cannot be type: ", type(json_nix))
+        log.warning("Invalid input of type %s: %s", type(json_nix), json_nix)
         return ""
 
-def parse_nix_primitive(type, value): # Update for all optionTypes.txt  https://github.com/Openmesh-Network/NixScraper/blob/main/optionTypes.txt
-    value = str(value)
-    if type == "int":
-        return value
-    elif type == "float":
-        return float(value)
-    elif type.startswith("/") or type.startswith("./"):
-        return value
-    elif "string" == type:
-        return '"' + value + '"'
-    elif "raw" in type:
-        return value
-    elif "list of string" == type:
-        # Assume strings inside of the list of already quoted
-        return value
-    else:
-        return value
-
-def calculate_metrics(cpu_usage_list, mem_usage_list):
-    total = 0
-    highest_cpu_usage = 0
-    for i in cpu_usage_list:
-        if i > highest_cpu_usage:
-            highest_cpu_usage = i
-        total += i
-
-    avg_cpu_usage = 0
-    if (len(cpu_usage_list) > 0):
-        avg_cpu_usage = total / len(cpu_usage_list)
-
-    total = 0
-    highest_mem_usage = 0
-    for i in mem_usage_list:
-        if i > highest_mem_usage:
-            highest_mem_usage = i
-        total += i
-
-    avg_mem_usage = 0
-    if len(mem_usage_list) > 0:
-        avg_mem_usage = total / len(mem_usage_list)
-
-    return avg_cpu_usage, avg_mem_usage, highest_cpu_usage, highest_mem_usage
+def parse_nix_primitive(type, value):
+    # Renders a Studio option value as nix for its type (NixOS option type descriptions, e.g. "list of string").
+    # Raises ConfigError if the value doesn't fit the type, see config_validation.
+    return render_value(type, value)
 
 def generate_hmac(access_token, message):
-    msg_hmac_hex = ""
-
-    if isinstance(message, dict):
-        print("generating hmac for dict")
-        json_str = json.dumps(message).replace(", ", ",").replace(": ", ":")
-    else:
-        json_str = message
-    if isinstance(access_token, str): # Assumes hex if string
-        msg_hmac_hex = hmac.new(bytes.fromhex(access_token), msg = bytes(json_str, 'utf-8'), digestmod='sha256').hexdigest()
-    elif isinstance(access_token, bytes):
-        msg_hmac_hex = hmac.new(access_token, msg = bytes(json_str, 'utf-8'), digestmod='sha256').hexdigest()
-    else:
-        print("Failed to generate HMAC:", access_token)
-    print("Generated HMAC", msg_hmac_hex, "for message:", json_str)
-    return msg_hmac_hex
-
+    # One-off signing, long running code should keep a MessageSigner instead.
+    return MessageSigner(access_token).sign(message)
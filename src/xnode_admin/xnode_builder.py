@@ -1,163 +1,246 @@
+import asyncio
 import base64
+import hmac
 import json
+import logging
 import psutil
 import requests
 import time
 import os
 import shutil
-import subprocess
 import tempfile
 from contextlib import contextmanager
 
-from xnode_admin.utils import calculate_metrics, parse_nix_json, generate_hmac
+from xnode_admin import exporter
+from xnode_admin.signing import MessageSigner
+from xnode_admin.config_stream import Base64Decoder, JsonFieldReader, read_fields
+from xnode_admin.config_delta import ConfigStore, apply_patch, studio_config_hash
+from xnode_admin.nix_renderer import IncrementalRenderer, render_studio_config
+from xnode_admin.config_cache import SystemCache, config_hash, current_system_path, write_file_if_changed
+from xnode_admin.metrics import MetricAggregator
+from xnode_admin.service_metrics import ServiceCollector, config_service_names
+from xnode_admin.rebuild_progress import RebuildProgress
+from xnode_admin.commands import run_command, stream_command
+from xnode_admin.gc_policy import GarbageCollector
+from xnode_admin.generation_poller import GenerationPoller
+from xnode_admin.intervals import IntervalController, heartbeat_levels, percentage
+from xnode_admin.outbox import Outbox
+from xnode_admin.checkpoint import Checkpoint
+from xnode_admin.config_validation import validate_config
+
+log = logging.getLogger(__name__)
+
+
+# Studio endpoint for each kind of message the agent pushes.
+MESSAGE_ENDPOINTS = {
+    "status": "/pushXnodeStatus",
+    "heartbeat": "/pushXnodeHeartbeat",
+}
 
 
-def status_send(studio_url, xnode_uuid, preshared_key, status: str):
-    # Send configuring status to DPL.
+def status_message(xnode_uuid, status: str, progress=None):
+    # Status for the DPL, optionally with the progress of the running rebuild.
     status_message = {
         "id": str(xnode_uuid),
         "status": str(status),
     }
-    status_hmac = generate_hmac(preshared_key, status_message)
-    status_headers = {
-        'x-parse-session-token': status_hmac
-    }
+    if progress != None:
+        status_message["progress"] = progress
+    return status_message
 
-    # Try to send a status to the studio, then pull the config.
-    try:
-        status_response = requests.post(studio_url + '/pushXnodeStatus', headers=status_headers, json=status_message)
-        if not status_response.ok:
-            print('Error sending status to dpl')
-            print(status_response.content)
-        else:
-            print('Succesfully sent status to the dpl.')
-    except requests.exceptions.RequestException as e:
-        print(e)
-
-def heartbeat_send(studio_url, xnode_uuid, preshared_key, cpu_usage_list, mem_usage_list, wants_update: bool):
-    # Calculate metrics (average and maximum).
-    avg_cpu_usage, avg_mem_usage, highest_cpu_usage, highest_mem_usage = calculate_metrics(cpu_usage_list, mem_usage_list)
 
+def heartbeat_message(xnode_uuid, cpu_summary, mem_summary, wants_update: bool, services=None, extra=None):
+    # Summaries come from MetricAggregator.take (average, extremes, percentiles and rolling windows).
     disk = psutil.disk_usage('/') # Only gets disk usage from root.
     heartbeat_message = {
         "id": str(xnode_uuid),
-        "cpuPercent": (avg_cpu_usage),
-        "cpuPercentPeek": (highest_cpu_usage),
-        "ramMbUsed": (avg_mem_usage),
-        "ramMbPeek": (highest_mem_usage),
+        "cpuPercent": (cpu_summary["avg"]),
+        "cpuPercentPeek": (cpu_summary["max"]),
+        "ramMbUsed": (mem_summary["avg"]),
+        "ramMbPeek": (mem_summary["max"]),
         "ramMbTotal": (psutil.virtual_memory().total / (1024 * 1024)),
 
         "storageMbUsed":  (disk.used / (1024 * 1024)),
         "storageMbTotal": (disk.total / (1024 * 1024)),
     }
+    add_metric_summary(heartbeat_message, "cpuPercent", cpu_summary)
+    add_metric_summary(heartbeat_message, "ramMb", mem_summary)
 
     if wants_update:
         heartbeat_message["wantUpdate"] = True
 
-    heartbeat_hmac = generate_hmac(preshared_key, heartbeat_message)
-    heartbeat_headers = {
-        'x-parse-session-token': heartbeat_hmac
-    }
+    if services:
+        # Per-service accounting from ServiceCollector.collect.
+        heartbeat_message["services"] = services
 
-    # Try to send a heartbeat to the studio, then pull the config.
-    try:
-        heartbeat_response = requests.post(studio_url + '/pushXnodeHeartbeat', headers=heartbeat_headers, json=heartbeat_message)
-        if not heartbeat_response.ok:
-            print('Failed to send heartbeat, response code not OK: ')
-            print(heartbeat_response.content)
-        else:
-            print("Succesfully sent heartbeat.")
-    except requests.exceptions.RequestException as e:
-        print('Failed to send heartbeat, some kind of request exception occured: ')
-        print(e)
+    if extra:
+        # Reports from other subsystems, e.g. garbage collection.
+        heartbeat_message.update(extra)
+    return heartbeat_message
+
+
+def add_metric_summary(heartbeat_message, prefix, summary):
+    heartbeat_message[prefix + "Min"] = summary["min"]
+    heartbeat_message[prefix + "P95"] = summary["p95"]
+    heartbeat_message[prefix + "P99"] = summary["p99"]
+    for window, values in summary["windows"].items():
+        heartbeat_message[prefix + "Avg" + window] = values["avg"]
+        heartbeat_message[prefix + "Peek" + window] = values["max"]
 
 
 # Gets the configuration from the dpl, also checks hmac for integrity.
-def config_get(studio_url, xnode_uuid, preshared_key):
+# The response is streamed: the signed message is unescaped, hashed and stored as it arrives, and downloads
+# larger than max_size bytes are abandoned.
+# With a ConfigStore holding the last verified config, the Studio may answer with a signed JSON patch against it
+# instead of the full config; if the patch doesn't apply cleanly the full config is fetched instead.
+def config_get(studio, xnode_uuid, signer, max_size=64 * 1024 * 1024, stored_config=None):
     get_config_message = {
         "id": str(xnode_uuid),
     }
-    get_config_hmac = generate_hmac(preshared_key, get_config_message)
-    get_config_headers = {
-        'x-parse-session-token': get_config_hmac
-    }
+    if stored_config != None and stored_config.config != None:
+        get_config_message["haveGeneration"] = stored_config.generation
+        get_config_message["haveHash"] = stored_config.hash
+    get_config_headers = signer.headers(get_config_message)
 
-    print('Fetching update message at', time.time())
+    log.info('Fetching update message.')
 
     try:
-        config_response = requests.get(studio_url + '/getXnodeServices', headers=get_config_headers, json=get_config_message)
-
-        if config_response.ok:
-
-            config = config_response.json()
+        with studio.get('/getXnodeServices', headers=get_config_headers, json=get_config_message, stream=True) as config_response:
+            if not config_response.ok:
+                log.warning('Config response failed: %s', config_response.content[:1024])
+                return None
 
-            if "message" in config.keys() and "hmac" in config.keys():
-                message = config["message"]
-                message_computed_hmac = generate_hmac(preshared_key, message)
-                if message_computed_hmac == config["hmac"]:
-                    print("HMAC of configuration verified")
-                    parsed_message = json.loads(message)
+            content_length = int(config_response.headers.get('Content-Length', 0))
+            if content_length > max_size:
+                log.warning('Config response of %s bytes is larger than the maximum of %s', content_length, max_size)
+                return None
 
-                    if parsed_message["expiry"] > time.time()*1000:
-                        base64_config = parsed_message["xnode_config"]
-                        parsed_config = json.loads(base64.decodebytes(base64_config.encode('utf-8')))
+            message = bytearray()
+            message_hmac = signer.incremental()
+            fields = {}
 
-                        return parsed_config
-                    else:
-                        print("Configuration expiry has passed.")
-                        return None
+            def on_value(key, fragment):
+                if key == "message":
+                    message_hmac.update(fragment)
+                    message.extend(fragment)
                 else:
-                    print("HMAC of configuration not verified:", message_computed_hmac, "against claimed:", config["hmac"])
+                    fields[key] = fields.get(key, b"") + fragment
+
+            reader = JsonFieldReader(on_value)
+            received = 0
+            for chunk in config_response.iter_content(chunk_size=64 * 1024):
+                received += len(chunk)
+                if received > max_size:
+                    log.warning('Config response exceeded the maximum of %s bytes, aborting download.', max_size)
                     return None
-        else:
-            print('Config response failed!')
-            print(config_response.content)
+                reader.feed(chunk)
+            reader.close()
+
+        if "hmac" not in fields or len(message) == 0:
+            log.warning('Config response is missing the message or its hmac.')
+            return None
+        if not hmac.compare_digest(message_hmac.hexdigest().encode('ascii'), fields["hmac"]):
+            log.warning("HMAC of configuration not verified.")
             return None
+        log.info("HMAC of configuration verified")
+
+        decoded = decode_config_message(message)
+        del message
+        if decoded == None:
+            return None
+        if decoded["kind"] == "xnode_config":
+            return json.loads(decoded["payload"])
     except Exception as e:
-        print('Couldn\'t get config response, reason: ')
-        print(e)
+        log.warning('Couldn\'t get config response, reason: %s', e)
         return None
 
+    # The Studio sent a patch against the stored config.
+    try:
+        if stored_config == None or decoded.get("base_hash") != stored_config.hash:
+            raise ValueError("patch is not based on the stored config")
+        config = apply_patch(stored_config.config, json.loads(decoded["payload"]))
+        if "config_hash" in decoded and decoded["config_hash"] != studio_config_hash(config):
+            raise ValueError("patched config doesn't match the Studio's hash")
+        log.info('Applied config patch against generation %s', stored_config.generation)
+        return config
+    except Exception as e:
+        log.warning('Couldn\'t apply config patch, fetching the full config. Reason: %s', e)
+        return config_get(studio, xnode_uuid, signer, max_size)
+
+def decode_config_message(message):
+    # Checks the expiry of a verified config message, then decodes its base64 xnode_config (or xnode_config_patch).
+    # Returns {"kind", "payload", ...} with the decoded JSON bytes, or None if the message has expired.
+    small_fields = {}
+    payload_kind = []
+
+    def on_small_field(key, fragment):
+        if key in ["expiry", "base_hash", "config_hash"]:
+            small_fields[key] = small_fields.get(key, b"") + fragment
+        elif key in ["xnode_config", "xnode_config_patch"] and payload_kind[-1:] != [key]:
+            payload_kind.append(key)
+
+    # First pass only looks at the small fields, the payload isn't decoded for expired messages.
+    read_fields(message, on_small_field)
+    if "expiry" not in small_fields or float(small_fields["expiry"]) <= time.time()*1000:
+        log.warning("Configuration expiry has passed.")
+        return None
+    if len(payload_kind) != 1:
+        log.warning("Configuration message should have exactly one of xnode_config or xnode_config_patch.")
+        return None
+
+    decoder = Base64Decoder()
+
+    def on_payload(key, fragment):
+        if key == payload_kind[0]:
+            decoder.write(fragment)
+
+    read_fields(message, on_payload)
+    decoded = {key: value.decode('utf-8') for key, value in small_fields.items() if key != "expiry"}
+    decoded["kind"] = payload_kind[0]
+    decoded["payload"] = decoder.close()
+    return decoded
+
 # Returns true on the first case and the current generation on the other.
 # Returns map with "configWant", "configHave", "updateWant", "updateHave":
-def check_generation(studio_url, xnode_uuid, preshared_key):
+# With wait > 0 the Studio may hold the request for up to wait seconds until the generation differs from known (long-poll),
+# Studios that support this answer with "longPoll": true.
+def check_generation(studio, xnode_uuid, signer, wait=0, known=None):
     check_generation_message = {
         "id": str(xnode_uuid),
     }
-    check_update_hmac = generate_hmac(preshared_key, check_generation_message)
-    check_generation_headers = {
-        'x-parse-session-token': check_update_hmac
-    }
+    timeout = studio.timeout
+    if wait > 0:
+        wait = max(int(wait), 1) # Whole seconds.
+        check_generation_message["wait"] = wait
+        if known != None:
+            check_generation_message["known"] = known
+        timeout = (studio.timeout[0], studio.timeout[1] + wait)
+    check_generation_headers = signer.headers(check_generation_message)
 
     try:
-        check_update_response = requests.post(studio_url + '/getXnodeGeneration', headers=check_generation_headers, json=check_generation_message)
+        check_update_response = studio.post('/getXnodeGeneration', headers=check_generation_headers, json=check_generation_message, timeout=timeout)
         if check_update_response.ok:
             content = check_update_response.json()
 
             if "configWant" in content and "configHave" in content and "updateWant" in content and "updateHave" in content:
-                print("Got the generation values.")
+                log.debug("Got the generation values.")
                 return content
             else:
-                print("Generation not in expected format! Is the admin service out of date?")
+                log.warning("Generation not in expected format! Is the admin service out of date?")
                 return None
         else:
-            print('Error in check update request')
-            print(check_update_response)
+            log.warning('Error in check update request: %s', check_update_response)
             return None
     except Exception as e:
-        print('Failed to check update.')
-        print(e)
+        log.warning('Failed to check update: %s', e)
         return None
 
-def push_generation(studio_url, xnode_uuid, preshared_key, generation: int, is_config: bool):
+def push_generation(studio, xnode_uuid, signer, generation: int, is_config: bool):
     push_message = {
         "id": str(xnode_uuid),
         "generation": int(generation)
     }
-    push_hmac = generate_hmac(preshared_key, push_message)
-    push_headers = {
-        'x-parse-session-token': push_hmac
-    }
+    push_headers = signer.headers(push_message)
 
     try:
         endpoint = ""
@@ -166,158 +249,651 @@ def push_generation(studio_url, xnode_uuid, preshared_key, generation: int, is_c
         else:
             endpoint = "/pushXnodeGenerationUpdate"
 
-        push_response = requests.post(studio_url + endpoint, headers=push_headers, json=push_message)
+        push_response = studio.post(endpoint, headers=push_headers, json=push_message)
         if not push_response.ok:
-            print('Failed to push generation request to dpl.')
-            print(push_response.content)
+            log.warning('Failed to push generation request to dpl: %s', push_response.content[:1024])
             return False
         else:
             return True
     except Exception as e:
-        print('Failed to push generation.')
-        print(e)
+        log.warning('Failed to push generation: %s', e)
         return False
 
-def fetch_config_studio(studio_url, xnode_uuid, access_token, state_directory):
+# Endpoints the Studio accepts inside a batch, and the outbox kind of those that are queued when undelivered.
+BATCH_ENDPOINT = '/pushXnodeBatch'
+QUEUED_KINDS = {endpoint[1:]: kind for kind, endpoint in MESSAGE_ENDPOINTS.items()}
 
-    # Push a heartbeat with metrics to the studio and pull a configuration.
-    hearbeat_interval = 30 # Heartbeat interval in seconds.
-    generation_interval = 10 # API call to dpl to check if there's a new config or a new update.
-    # XXX: Increase this interval to once every few hours, because it blocks for ~30 seconds in the best case.
-    update_check_interval = 60 * 60 * 8 # How often to check if there's an update on the current channel.
-    cpu_usage_list = []
-    mem_usage_list = []
-    preshared_key = base64.b64decode(access_token).hex()
-    generation_timer = time.time() - generation_interval # Start by checking generation.
-    heartbeat_timer = time.time() + hearbeat_interval
-    update_check_timer = time.time() + update_check_interval
-
-    wants_update = False
-
-    # Send initial heartbeat and status to notify dpl.
-    cpu_usage_list.append(psutil.cpu_percent())
-    mem_usage_list.append(psutil.virtual_memory().used / (1024 * 1024))
-
-
-    # XXX: This might cause problems.
-    print('Initial rebuild...')
-    successful_first_build = os_rebuild(state_directory)
-    print('Done with initial rebuild')
-
-    if successful_first_build:
-        print("Rebuilt succesfully.")
-    else:
-        print("First rebuild failed.")
 
-    heartbeat_send(studio_url, xnode_uuid, preshared_key, cpu_usage_list, mem_usage_list, False)
-    status_send(studio_url, xnode_uuid, preshared_key, "online")
+class BatchSupport:
+    '''
+    Whether the Studio has the batch endpoint. It's assumed until the Studio answers 404 or 405, then messages go out
+    one call at a time and the batch endpoint is tried again after retry seconds, in case the Studio was upgraded.
+    '''
+    def __init__(self, retry=60 * 30):
+        self.supported = True
+        self.checked = 0
+        self.retry = retry
 
-    print('Starting main loop.')
-    while True:
-        # Collect metrics.
-        cpu_usage_list.append(psutil.cpu_percent())
-        mem_usage_list.append(psutil.virtual_memory().used / (1024 * 1024))
+    def use_batch(self):
+        return self.supported or self.checked + self.retry < time.time()
 
-        # Check for changes in generation values. If they're mismatched, we have to reconfigure the system.
-        if generation_timer + generation_interval < time.time():
-            generation_data = check_generation(studio_url, xnode_uuid, preshared_key)
+    def record(self, supported):
+        if not supported and self.supported:
+            log.info('Studio has no batch endpoint, sending messages one call at a time.')
+        self.supported = supported
+        self.checked = time.time()
 
-            if generation_data != None:
 
-                configWant = int(generation_data["configWant"])
-                configHave = int(generation_data["configHave"])
-                updateWant = int(generation_data["updateWant"])
-                updateHave = int(generation_data["updateHave"])
-
-                if updateWant > updateHave:
-                    print('Update want and have don\'t match, updating system.')
-
-                    print('Sending push update request to dpl.')
-                    success = push_generation(studio_url, xnode_uuid, preshared_key, updateHave + 1, False)
-
-                    if not success:
-                        print('Failed to push update.')
-                    else:
-                        wants_update = False
-                        heartbeat_send(studio_url, xnode_uuid, preshared_key, cpu_usage_list, mem_usage_list, wants_update)
-
-                        print('Updating machine...')
-                        status_send(studio_url, xnode_uuid, preshared_key, "updating")
-
-                        # WARN: Might restart this program at this point!
-                        if os_update(state_directory):
-                            print('Succesfully updated machine!')
-                        else:
-                            print('This should never run there might be an issue with the code!')
-                            print('Failed to apply update to machine.')
-
-                        status_send(studio_url, xnode_uuid, preshared_key, "online")
-                if configWant > configHave:
-                    print('Config want and have don\'t match, must reconfigure.')
-                    config = config_get(studio_url, xnode_uuid, preshared_key)
-
-                    if config != None:
-                        process_studio_config(config, state_directory)
-
-                        print("Sending configuring status")
-                        status_send(studio_url, xnode_uuid, preshared_key, "configuring")
-                        success = push_generation(studio_url, xnode_uuid, preshared_key, configHave + 1, True)
-
-                        # WARN: This could restart the machine.
-                        rebuild_success = os_rebuild(state_directory)
-
-                        if rebuild_success:
-                            print("Configuration succeeded. Sending online status.")
-                            status_send(studio_url, xnode_uuid, preshared_key, "online")
-                        else:
-                            print("Configuration failed. Reverting!")
-                            status_send(studio_url, xnode_uuid, preshared_key, "online")
-                    else:
-                        print('Couldn\'t fetch valid configuration from dpl.')
-            else:
-                print('No generation data, is the dpl down or is the admin service out of date?')
+def call_endpoint(studio, signer, endpoint, body):
+    # A single signed call, the result has the same shape as a batch result: {"ok": bool, "body": response}.
+    try:
+        response = studio.post('/' + endpoint, headers=signer.headers(body), json=body)
+    except requests.exceptions.RequestException as e:
+        log.warning('Failed to call %s: %s', endpoint, e)
+        return {"ok": False}
+    if not response.ok:
+        log.warning('Failed to call %s, response code not OK: %s', endpoint, response.content[:1024])
+        return {"ok": False}
+    try:
+        return {"ok": True, "body": response.json()}
+    except ValueError:
+        return {"ok": True}
 
-            generation_timer = time.time()
 
-        if heartbeat_timer + hearbeat_interval < time.time():
-            print('Sending heartbeat.')
+def batch_send(studio, xnode_uuid, signer, messages, support):
+    # One request, signed once, for a list of (endpoint, body) messages. Returns the per-message results or None.
+    envelope = {
+        "id": str(xnode_uuid),
+        "messages": [{"type": endpoint, "body": body} for endpoint, body in messages],
+    }
+    try:
+        response = studio.post(BATCH_ENDPOINT, headers=signer.headers(envelope), json=envelope)
+    except requests.exceptions.RequestException as e:
+        log.warning('Failed to send batch of %s messages: %s', len(messages), e)
+        return None
+    if response.status_code in [404, 405]:
+        support.record(False)
+        return None
+    if not response.ok:
+        log.warning('Failed to send batch, response code not OK: %s', response.content[:1024])
+        return None
+    try:
+        results = response.json()["results"]
+    except (ValueError, KeyError, TypeError):
+        results = None
+    if not isinstance(results, list) or len(results) != len(messages):
+        log.warning('Batch response doesn\'t have a result for every message.')
+        return None
+    if not support.supported:
+        support.record(True)
+    return [{"ok": bool(result.get("ok")), "body": result.get("body")} if isinstance(result, dict) else {"ok": False} for result in results]
 
-            heartbeat_send(studio_url, xnode_uuid, preshared_key, cpu_usage_list, mem_usage_list, wants_update)
 
-            heartbeat_timer = time.time()
+def exchange_messages(studio, xnode_uuid, signer, messages, support, stop_on_failure=False):
+    '''
+    Sends (endpoint, body) messages, e.g. ("pushXnodeHeartbeat", heartbeat), in a single round trip when the Studio
+    has the batch endpoint and one call per message otherwise. Returns a result per message.
+    With stop_on_failure the individual calls stop at the first failure, so delivery stays in order.
+    '''
+    if support.use_batch():
+        results = batch_send(studio, xnode_uuid, signer, messages, support)
+        if results != None:
+            for (endpoint, _), result in zip(messages, results):
+                if endpoint == "pushXnodeHeartbeat":
+                    exporter.heartbeats.inc(result="ok" if result["ok"] else "failed")
+            return results
+        if support.supported:
+            # The batch itself failed, the Studio is most likely unreachable.
+            return [{"ok": False} for _ in messages]
+
+    results = []
+    for endpoint, body in messages:
+        if stop_on_failure and len(results) > 0 and not results[-1]["ok"]:
+            results.append({"ok": False})
+            continue
+        results.append(call_endpoint(studio, signer, endpoint, body))
+        if endpoint == "pushXnodeHeartbeat":
+            exporter.heartbeats.inc(result="ok" if results[-1]["ok"] else "failed")
+    return results
+
+
+def delivered_in_order(results):
+    count = 0
+    for result in results:
+        if not result["ok"]:
+            break
+        count += 1
+    return count
+
+
+def valid_generation(generation_data):
+    return isinstance(generation_data, dict) and all(key in generation_data for key in ["configWant", "configHave", "updateWant", "updateHave"])
+
+
+class StudioAgent:
+    '''
+    Runs the Studio integration as a set of independent asyncio tasks, so a long rebuild or update check
+    doesn't stop heartbeats and generation checks from going out.
+    '''
+    def __init__(self, studio, xnode_uuid, access_token, state_directory, garbage_collector=None, generation_poller=None, max_config_size=64 * 1024 * 1024, option_index=None, prefetcher=None, intervals=None):
+        self.studio = studio
+        self.xnode_uuid = xnode_uuid
+        self.signer = MessageSigner(base64.b64decode(access_token))
+        self.state_directory = state_directory
+
+        self.generation_interval = 10 # API call to dpl to check if there's a new config or a new update.
+        # Heartbeat, metric sampling and update check intervals, adapted to how much the node's usage changes.
+        self.intervals = intervals if intervals != None else IntervalController()
+        self.gc_check_interval = 60 * 10 # How often to check disk usage against the gc watermark.
+        self.update_check_report = {"updateChecks": 0, "updateChecksSkippedBuild": 0}
+        self.rebuild_report = {} # Duration of the last build and switch phases, sent with heartbeats.
+        self.failed_config_hash = None # Config that failed to build or switch, not retried until the Studio sends another.
+        self.failed_generation = None # configWant whose config was rejected or failed, not fetched again until it moves.
+        self.max_config_size = max_config_size # Largest config download accepted from the Studio, in bytes.
+        self.option_index = option_index # NixOS option types configs are validated against, if there is one.
+        self.invalid_config_hash = None # Studio hash of the last config that failed validation, it's only reported once.
+        self.prefetcher = prefetcher # Downloads the next system's store paths in parallel before building it, if set.
+
+        self.cpu_metrics = MetricAggregator()
+        self.mem_metrics = MetricAggregator()
+        self.service_collector = ServiceCollector()
+        self.system_cache = SystemCache(state_directory)
+        self.config_store = ConfigStore(state_directory)
+        self.outbox = Outbox(state_directory)
+        self.checkpoint = Checkpoint(state_directory)
+        self.batch_support = BatchSupport()
+        self.renderer = IncrementalRenderer()
+        self.garbage_collector = garbage_collector if garbage_collector != None else GarbageCollector()
+        self.generation_poller = generation_poller if generation_poller != None else GenerationPoller(self.generation_interval)
+        self.wants_update = self.checkpoint.get("wantsUpdate")
+
+        # Rebuilds, updates and update checks all touch the flake and the system profile, only run one at a time.
+        self.system_lock = None
+        self.gc_wanted = None
+        self.heartbeat_wanted = None
+        # Generation values that came back with a heartbeat, handed to the generation task when they need action.
+        self.generation_hint = None
+        self.generation_wakeup = None
+        self.generation_checked = 0 # When a generation check last rode along with a heartbeat.
+
+    def prepare(self):
+        # Locks and events belong to the running event loop, so they're only created once it runs.
+        self.system_lock = asyncio.Lock()
+        self.gc_wanted = asyncio.Event()
+        self.heartbeat_wanted = asyncio.Event()
+        self.generation_wakeup = asyncio.Event()
+
+    async def run(self):
+        await self.startup()
+
+        log.info('Starting main loop.')
+        await asyncio.gather(
+            self.sample_metrics_task(),
+            self.heartbeat_task(),
+            self.generation_task(),
+            self.update_check_task(),
+            self.gc_task(),
+        )
+
+    async def startup(self):
+        self.prepare()
+
+        if self.config_store.config != None:
+            self.service_collector.set_services(config_service_names(self.config_store.config))
+        generation = self.checkpoint.get("generation")
+        if generation != None:
+            for field, value in generation.items():
+                exporter.generation.set(value, field=field)
+
+        # Send initial heartbeat and status to notify dpl.
+        self.sample_metrics()
+
+        current_hash = config_hash(self.state_directory)
+        if self.resume(current_hash):
+            log.info('Running system matches the checkpoint, skipping the initial rebuild.')
+            running = True
+        else:
+            # XXX: This might cause problems.
+            log.info('Initial rebuild...')
+            with self.intervals.rebuilding():
+                running = await os_rebuild(self.state_directory, timings=self.rebuild_report)
+            log.info('Done with initial rebuild')
+
+            if running:
+                log.info("Rebuilt succesfully.", extra=self.rebuild_report)
+                self.system_cache.record(current_hash, current_system_path())
+                self.checkpoint.update(configHash=current_hash, systemPath=current_system_path())
+            else:
+                log.error("First rebuild failed.")
+
+        await self.heartbeat(self.wants_update)
+        pending = self.checkpoint.get("pendingGeneration")
+        if pending != None:
+            # The previous process was restarted by the switch to this generation, before it could acknowledge it.
+            if running:
+                log.info('Acknowledging config generation %s, switched to before the restart.', pending)
+                if not await asyncio.to_thread(push_generation, self.studio, self.xnode_uuid, self.signer, pending, True):
+                    # The Studio keeps asking for it, and the config is found running then.
+                    log.warning('Failed to acknowledge config generation %s.', pending)
+            self.checkpoint.update(pendingGeneration=None)
+        await self.status("online")
+
+    def resume(self, current_hash):
+        # True if the running system already has the config in the state directory, so no initial rebuild is needed.
+        system_path = current_system_path()
+        if self.checkpoint.get("status") == "updating" and self.checkpoint.get("systemPath") not in [None, system_path]:
+            # The previous process was restarted by the switch of an update, so the updated system is what's running.
+            log.info('Restarted by an update, now running %s.', system_path)
+            self.system_cache.record(current_hash, system_path)
+        elif not self.checkpoint.system_matches(current_hash, system_path) and not self.system_cache.is_running(current_hash):
+            return False
+        self.checkpoint.update(configHash=current_hash, systemPath=system_path)
+        return True
 
-            # Reset these lists, don't want to run out of memory.
-            cpu_usage_list = []
-            mem_usage_list = []
+    def set_wants_update(self, wants_update):
+        self.wants_update = wants_update
+        self.checkpoint.update(wantsUpdate=wants_update)
+
+    # Blocking API calls run in a worker thread so they never stall the other tasks.
+    async def status(self, status, progress=None):
+        self.checkpoint.update(status=status)
+        await self.exchange([("pushXnodeStatus", status_message(self.xnode_uuid, status, progress))])
+
+    async def exchange(self, messages, stop_on_failure=False):
+        '''
+        Sends (endpoint, body) messages in one round trip if the Studio supports batches and returns their results.
+        Heartbeats and statuses that aren't delivered go to the outbox. Whatever waits there is delivered first, and if
+        that fails they're queued straight away so the Studio sees them in order.
+        With stop_on_failure nothing after the first message that fails is sent one call at a time, or queued.
+        '''
+        queued = not await self.flush_outbox()
+        results = [{"ok": False} for _ in messages]
+        to_send = [i for i, (endpoint, _) in enumerate(messages) if not (queued and endpoint in QUEUED_KINDS)]
+        if len(to_send) > 0:
+            sent = await asyncio.to_thread(exchange_messages, self.studio, self.xnode_uuid, self.signer, [messages[i] for i in to_send], self.batch_support, stop_on_failure)
+            for i, result in zip(to_send, sent):
+                results[i] = result
+
+        end = len(messages)
+        if stop_on_failure:
+            end = next((i + 1 for i in to_send if not results[i]["ok"]), end)
+        for (endpoint, body), result in zip(messages[:end], results):
+            if not result["ok"] and endpoint in QUEUED_KINDS:
+                self.outbox.put(QUEUED_KINDS[endpoint], body)
+        return results
+
+    async def flush_outbox(self):
+        # Delivers what was queued while the Studio was unreachable, returns True once nothing is left.
+        if self.outbox.pending() == 0:
+            return True
 
-        # Only check for updates if we know we don't already have any updates queued up.
-        if (update_check_timer + update_check_interval < time.time()) and not wants_update:
-            print('Checking for updates...')
+        def send_batch(batch):
+            messages = [(MESSAGE_ENDPOINTS[kind][1:], message) for kind, message in batch]
+            return delivered_in_order(exchange_messages(self.studio, self.xnode_uuid, self.signer, messages, self.batch_support, stop_on_failure=True))
+
+        delivered = await asyncio.to_thread(self.outbox.flush, send_batch)
+        if delivered > 0:
+            log.info('Delivered %s messages queued while offline.', delivered)
+        return self.outbox.pending() == 0
+
+    def progress_reporter(self, status):
+        # Batched rebuild progress updates, sent over the regular status channel.
+        async def report(progress):
+            await self.status(status, progress.as_dict())
+        return report
+
+    async def heartbeat(self, wants_update):
+        messages = [("pushXnodeHeartbeat", self.take_heartbeat(wants_update))]
+
+        # Without long-polling the generation check rides along with the heartbeat, one round trip for both.
+        piggyback = self.generation_poller.long_poll_wait() == 0 and self.generation_wakeup != None
+        if piggyback:
+            messages.append(("getXnodeGeneration", {"id": str(self.xnode_uuid)}))
+
+        results = await self.exchange(messages)
+        if results[0]["ok"]:
+            self.apply_hints(results[0].get("body"))
+        if piggyback and results[1]["ok"] and valid_generation(results[1].get("body")):
+            self.generation_checked = time.time()
+            self.apply_hints(results[1]["body"])
+            self.offer_generation(results[1]["body"])
+
+    def apply_hints(self, body):
+        # The Studio can ask for longer intervals in any response, e.g. while it's under load.
+        if isinstance(body, dict) and isinstance(body.get("intervals"), dict):
+            self.intervals.apply_hints(body["intervals"])
+            if "generation" in body["intervals"]:
+                self.generation_poller.hint(body["intervals"]["generation"])
+
+    def take_heartbeat(self, wants_update):
+        # Summarise the samples since the last heartbeat and start a new interval.
+        cpu_summary = self.cpu_metrics.take()
+        mem_summary = self.mem_metrics.take()
+        services = self.service_collector.collect()
+        extra = self.garbage_collector.report()
+        extra.update(self.update_check_report)
+        extra.update(self.rebuild_report)
+        extra.update(self.intervals.report())
+        extra["outboxDropped"] = self.outbox.dropped
+        message = heartbeat_message(self.xnode_uuid, cpu_summary, mem_summary, wants_update, services, extra)
+        self.intervals.record_heartbeat(heartbeat_levels(message))
+        return message
+
+    def offer_generation(self, generation_data):
+        # Generation values checked outside of the generation task, it only has to wake up if there's work to do.
+        self.generation_poller.record(generation_data, 0)
+        if int(generation_data["configWant"]) > int(generation_data["configHave"]) or int(generation_data["updateWant"]) > int(generation_data["updateHave"]):
+            self.generation_hint = generation_data
+            self.generation_wakeup.set()
+
+    def sample_metrics(self):
+        now = time.time()
+        cpu_percent = psutil.cpu_percent()
+        memory = psutil.virtual_memory()
+        self.cpu_metrics.add(cpu_percent, now)
+        self.mem_metrics.add(memory.used / (1024 * 1024), now)
+
+        disk = psutil.disk_usage('/')
+        levels = {"cpu": cpu_percent, "memory": percentage(memory.used, memory.total), "disk": percentage(disk.used, disk.total)}
+        if self.intervals.record_sample(levels, now) and self.heartbeat_wanted != None:
+            self.heartbeat_wanted.set()
+
+    async def sample_metrics_task(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.sample_metrics()
+            exporter.loop_last_tick.set(time.time())
+            # Anything blocking the loop shows up as the sampler waking up late.
+            started = loop.time()
+            interval = self.intervals.current_sample_interval()
+            await asyncio.sleep(interval)
+            exporter.loop_lag_seconds.observe(max(loop.time() - started - interval, 0))
+
+    async def heartbeat_task(self):
+        while True:
+            # Due when the controller says so, or straight away when usage crosses a threshold.
+            wanted = False
+            try:
+                await asyncio.wait_for(self.heartbeat_wanted.wait(), self.intervals.heartbeat_delay())
+                wanted = True
+            except asyncio.TimeoutError:
+                pass
+            self.heartbeat_wanted.clear()
+            if not wanted and self.intervals.heartbeat_delay() > 0:
+                # Another heartbeat went out in the meantime (e.g. with an update), the interval starts over from there.
+                continue
+            log.debug('Sending heartbeat.')
+            await self.heartbeat(self.wants_update)
+            log.debug('Studio API latency: %s', self.studio.latency_stats())
+
+    async def generation_task(self):
+        while True:
+            # Check for changes in generation values. If they're mismatched, we have to reconfigure the system.
+            if self.generation_hint != None:
+                # Already checked along with a heartbeat.
+                generation_data, self.generation_hint = self.generation_hint, None
+            else:
+                wait = self.generation_poller.long_poll_wait()
+                known = self.generation_poller.known_generation()
+                generation_data = await asyncio.to_thread(check_generation, self.studio, self.xnode_uuid, self.signer, wait, known)
+                self.generation_poller.record(generation_data, wait)
+                self.apply_hints(generation_data)
 
-            status_send(studio_url, xnode_uuid, preshared_key, "checking updates")
-            if flake_update_check(state_directory):
-                print('Update found.')
+            if generation_data != None:
+                generation_data = await self.settle_generation(generation_data)
+                for field in ["configWant", "configHave", "updateWant", "updateHave"]:
+                    exporter.generation.set(int(generation_data[field]), field=field)
+                self.checkpoint.update(generation={field: int(generation_data[field]) for field in ["configWant", "configHave", "updateWant", "updateHave"]})
+                await self.apply_generation(generation_data)
+            else:
+                log.warning('No generation data, is the dpl down or is the admin service out of date?')
+
+            self.generation_wakeup.clear()
+            if self.generation_hint == None:
+                await self.wait_for_generation_check()
+
+    async def wait_for_generation_check(self):
+        # Sleeps until the next poll is due, or until a heartbeat brought back work. A check that rode along with a
+        # heartbeat counts as a poll, the timer starts over from it so the generation isn't checked twice.
+        checked = self.generation_checked
+        delay = self.generation_poller.next_delay()
+        while True:
+            try:
+                await asyncio.wait_for(self.generation_wakeup.wait(), delay)
+                return
+            except asyncio.TimeoutError:
+                pass
+            if self.generation_checked == checked:
+                return
+            checked = self.generation_checked
+            delay = max(checked + self.generation_poller.next_delay() - time.time(), 0)
+
+    async def settle_generation(self, generation_data):
+        # Holds back a config change until configWant stops moving for the poller's quiet period, then returns the
+        # newest generation, so several quick edits in the Studio are fetched and rebuilt once.
+        poller = self.generation_poller
+        config_want = int(generation_data["configWant"])
+        if poller.quiet_period <= 0 or config_want <= int(generation_data["configHave"]) or config_want == self.failed_generation:
+            return generation_data
+
+        deadline = time.time() + poller.max_settle
+        while time.time() < deadline:
+            wait = min(poller.quiet_period, deadline - time.time())
+            long_poll = poller.long_poll_wait() > 0
+            if long_poll:
+                # The Studio answers as soon as the generation moves, or after wait seconds if it doesn't.
+                newer = await asyncio.to_thread(check_generation, self.studio, self.xnode_uuid, self.signer, wait, poller.known_generation())
+            else:
+                await asyncio.sleep(wait)
+                newer = await asyncio.to_thread(check_generation, self.studio, self.xnode_uuid, self.signer)
+            poller.record(newer, wait if long_poll else 0)
+            if newer == None:
+                break
+
+            quiet = newer["configWant"] == generation_data["configWant"]
+            generation_data = newer
+            if not quiet:
+                log.info('Config generation moved to %s while settling, waiting for it to go quiet.', newer["configWant"])
+            elif not long_poll or newer.get("longPoll", False):
+                break
+            # Otherwise the Studio answered straight away without long-polling, so no quiet period has passed yet.
+        return generation_data
+
+    async def apply_generation(self, generation_data):
+        configWant = int(generation_data["configWant"])
+        configHave = int(generation_data["configHave"])
+        updateWant = int(generation_data["updateWant"])
+        updateHave = int(generation_data["updateHave"])
+
+        if updateWant > updateHave:
+            log.info('Update want and have don\'t match, updating system.')
+
+            log.info('Sending push update request to dpl.')
+            # Generation push, heartbeat and status in one round trip, or one call after the other until one fails.
+            wanted_update = self.wants_update
+            self.set_wants_update(False)
+            self.checkpoint.update(status="updating")
+            results = await self.exchange([
+                ("pushXnodeGenerationUpdate", {"id": str(self.xnode_uuid), "generation": updateHave + 1}),
+                ("pushXnodeHeartbeat", self.take_heartbeat(self.wants_update)),
+                ("pushXnodeStatus", status_message(self.xnode_uuid, "updating")),
+            ], stop_on_failure=True)
+
+            if not results[0]["ok"]:
+                log.warning('Failed to push update.')
+                self.set_wants_update(wanted_update)
+                await self.status("online")
+            else:
+                log.info('Updating machine...')
+
+                # WARN: Might restart this program at this point!
+                async with self.system_lock:
+                    with self.intervals.rebuilding():
+                        updated = await os_update(self.state_directory, self.progress_reporter("updating"), self.rebuild_report, self.prefetcher)
+                    if updated:
+                        updated_hash = config_hash(self.state_directory)
+                        self.system_cache.record(updated_hash, current_system_path())
+                        self.checkpoint.update(configHash=updated_hash, systemPath=current_system_path())
+                        self.gc_wanted.set()
+                        # A config that failed to build may build against the new inputs.
+                        self.failed_generation = None
+                if updated:
+                    log.info('Succesfully updated machine!')
+                else:
+                    log.error('Failed to apply update to machine.')
+
+                await self.status("online")
+
+        if configWant > configHave:
+            if configWant == self.failed_generation:
+                log.debug("Config generation %s already failed, waiting for the Studio to send another one.", configWant)
+                return
+            log.info('Config want and have don\'t match, must reconfigure.')
+            config = await asyncio.to_thread(config_get, self.studio, self.xnode_uuid, self.signer, self.max_config_size, self.config_store)
+
+            if config != None:
+                # Malformed values are caught here in microseconds, instead of by nixos-rebuild minutes later.
+                errors = validate_config(config, self.option_index)
+                if len(errors) > 0:
+                    self.failed_generation = configWant
+                    await self.reject_config(config, errors)
+                    return
+                self.invalid_config_hash = None
+
+                async with self.system_lock:
+                    new_config_hash = process_studio_config(config, self.state_directory, self.renderer)
+                    self.service_collector.set_services(config_service_names(config))
+
+                    if self.system_cache.is_running(new_config_hash):
+                        # Cosmetic change in the Studio (name, description, ...), the running system already has this config.
+                        log.info("Rendered config matches the running system, skipping rebuild.")
+                        self.checkpoint.update(configHash=new_config_hash, systemPath=current_system_path())
+                        self.config_store.save(configWant, config)
+                        await asyncio.to_thread(push_generation, self.studio, self.xnode_uuid, self.signer, configWant, True)
+                        return
+
+                    if new_config_hash == self.failed_config_hash:
+                        log.info("This config failed to apply before, waiting for the Studio to send another one.")
+                        self.failed_generation = configWant
+                        return
+
+                    with self.intervals.rebuilding():
+                        rebuild_success = await self.stage_and_switch(new_config_hash, configWant)
+
+                if rebuild_success:
+                    # Only acknowledge the generation once the new config is actually running.
+                    self.failed_config_hash = None
+                    # Only a config that is running becomes the base for the next delta.
+                    self.config_store.save(configWant, config)
+                    # The fetched config is at least as new as configWant, so every generation up to it is applied.
+                    await asyncio.to_thread(push_generation, self.studio, self.xnode_uuid, self.signer, configWant, True)
+                    self.checkpoint.update(pendingGeneration=None)
+                    log.info("Configuration succeeded. Sending online status.", extra=self.rebuild_report)
+                else:
+                    self.failed_config_hash = new_config_hash
+                    self.failed_generation = configWant
+                    log.error("Configuration failed, keeping the running system.", extra=self.rebuild_report)
+                await self.status("online", self.rebuild_report)
+            else:
+                log.warning('Couldn\'t fetch valid configuration from dpl.')
+
+    async def reject_config(self, config, errors):
+        # Invalid configs are never written or built. They're reported once, until the Studio sends a different one.
+        rejected_hash = studio_config_hash(config)
+        if rejected_hash == self.invalid_config_hash:
+            return
+        self.invalid_config_hash = rejected_hash
+        log.error("Config failed validation, keeping the running system: %s", "; ".join(errors[:5]), extra={"configErrors": len(errors)})
+        exporter.rebuilds.inc(result="invalid_config")
+        self.rebuild_report.clear()
+        self.rebuild_report["configErrors"] = errors
+        await self.status("online", self.rebuild_report)
+
+    async def stage_and_switch(self, new_config_hash, generation=None):
+        # Phase one builds the new system while the current one keeps serving, phase two switches to it.
+        # Both are timed and their durations reported to the Studio.
+        self.rebuild_report.clear()
+        log.info("Staging new configuration.")
+        await self.status("building")
+        if self.prefetcher != None:
+            started = time.time()
+            await self.prefetcher.prefetch(self.state_directory, self.progress_reporter("building"))
+            self.rebuild_report["prefetchSeconds"] = time.time() - started
+        started = time.time()
+        system_path = await os_build(self.state_directory, self.progress_reporter("building"))
+        self.rebuild_report["buildSeconds"] = time.time() - started
+        if system_path == None:
+            return False
+
+        # Recorded before switching: if the switch restarts this service, the restarted agent finds the config
+        # already running and only has to push the generation.
+        self.system_cache.record(new_config_hash, system_path)
+        self.checkpoint.update(pendingGeneration=generation)
+
+        log.info("Sending configuring status")
+        await self.status("configuring")
+        started = time.time()
+        # WARN: This could restart the machine.
+        switched = await os_switch(system_path)
+        self.rebuild_report["switchSeconds"] = time.time() - started
+        if switched:
+            self.checkpoint.update(configHash=new_config_hash, systemPath=system_path)
+            self.gc_wanted.set()
+        else:
+            self.checkpoint.update(pendingGeneration=None)
+        return switched
+
+    async def update_check_task(self):
+        # The interval carries on from the last check before a restart, instead of starting over.
+        next_check = self.checkpoint.get("lastUpdateCheck") + self.intervals.current_update_check_interval()
+        while True:
+            await asyncio.sleep(max(next_check - time.time(), 0))
+            next_check = time.time() + self.intervals.current_update_check_interval()
+
+            # Only check for updates if we know we don't already have any updates queued up.
+            if self.wants_update:
+                continue
+
+            log.info('Checking for updates...')
+            await self.status("checking updates")
+            async with self.system_lock:
+                started = time.time()
+                found_update = await flake_update_check(self.state_directory, self.update_check_report, self.prefetcher)
+                exporter.update_check_seconds.observe(time.time() - started, result="update" if found_update else "no_update")
+            self.checkpoint.update(lastUpdateCheck=time.time())
+
+            if found_update:
+                log.info('Update found.')
 
                 # Heartbeat should now include wants update flag.
-                wants_update = True
+                self.set_wants_update(True)
 
-                heartbeat_send(studio_url, xnode_uuid, preshared_key, cpu_usage_list, mem_usage_list, wants_update)
-                status_send(studio_url, xnode_uuid, preshared_key, "online")
+                await self.heartbeat(self.wants_update)
+                await self.status("online")
             else:
-                print('No updates.')
-                status_send(studio_url, xnode_uuid, preshared_key, "online")
+                log.info('No updates.')
+                await self.status("online")
 
-            update_check_timer = time.time()
+    async def gc_task(self):
+        while True:
+            # Check the watermark periodically, and straight after a rebuild added new store paths.
+            try:
+                await asyncio.wait_for(self.gc_wanted.wait(), self.gc_check_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.gc_wanted.clear()
 
-        precision = 1 # (seconds) Increase to trade performance for metric precision.
-        time.sleep(precision)
+            async with self.system_lock:
+                await self.garbage_collector.collect_if_needed()
 
 
-def process_studio_config(studio_json_config, state_directory):
-    # 1 Add flake.nix
-    flake_file = state_directory+"/flake.nix"
-    with open(flake_file, "w") as f:
-        f.write('''
+def fetch_config_studio(studio, xnode_uuid, access_token, state_directory, garbage_collector=None, generation_poller=None, max_config_size=64 * 1024 * 1024, option_index=None, prefetcher=None, intervals=None):
+    # Push a heartbeat with metrics to the studio and pull a configuration.
+    agent = StudioAgent(studio, xnode_uuid, access_token, state_directory, garbage_collector, generation_poller, max_config_size, option_index, prefetcher, intervals)
+    asyncio.run(agent.run())
+
+
+FLAKE_NIX = '''
 {
     description = "Xnode";
 
@@ -332,80 +908,141 @@ def process_studio_config(studio_json_config, state_directory):
         };
     };
 }
-        ''')
+        '''
+
+
+def process_studio_config(studio_json_config, state_directory, renderer=None):
+    # Writes flake.nix and config.nix (only if they changed) and returns the hash of the resulting configuration.
+    # An IncrementalRenderer only re-renders the blocks that changed since its previous config.
+    # 1 Add flake.nix
+    flake_file = state_directory+"/flake.nix"
+    write_file_if_changed(flake_file, FLAKE_NIX)
 
     # 2 Get config path.
     config_path = state_directory+"/config.nix"
 
-    print('Studio json config:')
-    print(studio_json_config)
-
     # 3 Update config by constructing configuration from the new json
-    new_sys_config = "{ config, pkgs, ... }:\n{\n  "
-    for module_config in studio_json_config:
-        # config_type eg. services, users or networking
-        print(studio_json_config[module_config]) # services
-        new_sys_config += module_config + " = {\n  "
-        for submodule in studio_json_config[module_config]:
-            print("______________")
-            if "nixName" in submodule.keys():
-                print("Parsing nix config for", submodule["nixName"])
-                new_sys_config += parse_nix_json(submodule)
-            else:
-                print("No nixName found in:", submodule)
-
-        new_sys_config += "};\n"
-    new_sys_config += "\n}"
-    print(new_sys_config)
+    if renderer != None:
+        new_sys_config = renderer.render(studio_json_config)
+    else:
+        new_sys_config = render_studio_config(studio_json_config)
+    log.info('Rendered %s bytes of nix config for %s', len(new_sys_config), ", ".join(studio_json_config.keys()))
 
     # 3 Write the new config to the .nix file
-    with open(config_path, "w") as f:
-        f.write(new_sys_config)
+    if not write_file_if_changed(config_path, new_sys_config):
+        log.info('Rendered config is unchanged.')
 
+    return config_hash(state_directory)
 
-def flake_update(state_directory):
+
+async def flake_update(state_directory):
     # Update the channel.
-    result = subprocess.run(['/run/current-system/sw/bin/nix', 'flake', 'update', state_directory, '--impure'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if result.returncode != 0:
-        print('Error when running channel command.')
-        print(result.stderr)
+    # tarball-ttl 0 makes nix revalidate cached tarballs with the server, so they're only downloaded again when they changed.
+    returncode, stdout, stderr = await run_command(['/run/current-system/sw/bin/nix', 'flake', 'update', state_directory, '--impure', '--option', 'tarball-ttl', '0'])
+    if returncode != 0:
+        log.error('Error when running channel command: %s', stderr.decode('utf-8', errors='replace'))
         return False
     else:
         return True
 
 
-def os_rebuild(state_directory):
-    print('Running rebuild')
+# The profile nixos-rebuild switch adds generations to, the bootloader entries are built from it.
+SYSTEM_PROFILE = "/nix/var/nix/profiles/system"
+
+
+async def os_build(state_directory, on_progress=None, progress_interval=5):
+    # Phase one of a rebuild: builds (and downloads) the new system without touching the running one.
+    # Returns the store path of the built system, or None if the build failed.
+    # on_progress is awaited with a RebuildProgress at most once every progress_interval seconds while the build runs.
+    log.info('Building system')
+    started = time.time()
+    progress = RebuildProgress()
+    last_report = time.time()
+    pending_report = False
+
+    async def on_line(line):
+        nonlocal last_report, pending_report
+        log.debug('nixos-rebuild: %s', line.rstrip())
+        if progress.feed(line):
+            pending_report = True
+        if on_progress != None and pending_report and last_report + progress_interval < time.time():
+            pending_report = False
+            last_report = time.time()
+            await on_progress(progress)
+
+    # Run from the state directory so the result link lands there, it keeps the staged system safe from gc until the switch.
+    returncode = await stream_command(['/run/current-system/sw/bin/nixos-rebuild', '--verbose', 'build', '--flake', state_directory+"#xnode", '--impure'], on_line, cwd=state_directory)
+
+    if on_progress != None:
+        await on_progress(progress)
+    exporter.rebuild_seconds.observe(time.time() - started, phase="build")
+
+    if returncode != 0:
+        exporter.rebuilds.inc(result="build_failed")
+        log.error("Build failure, last %s lines of output:\n%s", len(progress.log), progress.tail())
+        return None
 
+    system_path = os.path.realpath(os.path.join(state_directory, "result"))
+    log.info("Built %s", system_path, extra=progress.as_dict())
+    return system_path
 
-    result = subprocess.run(['/run/current-system/sw/bin/nixos-rebuild', '--verbose', 'switch', '--flake', state_directory+"#xnode", '--impure'])
 
-    if result.returncode == 0:
-        print("Rebuilt succesfully, log:")
-        print(result.stderr)
+async def os_switch(system_path):
+    # Phase two of a rebuild: makes an already built system the current one, like nixos-rebuild switch does.
+    log.info('Switching to %s', system_path)
+    started = time.time()
 
-        # Clean garbage:
-        print("Running gc:")
-        result = subprocess.run(['/run/current-system/sw/bin/nix-store', '--gc'])
-        print("Done with gc.")
+    async def on_line(line):
+        log.info('switch-to-configuration: %s', line.rstrip())
 
-        return True
-    else:
-        print("Rebuild failure, log:")
-        print(result.stdout)
-        print(result.stderr)
+    returncode = await stream_command(['/run/current-system/sw/bin/nix-env', '--profile', SYSTEM_PROFILE, '--set', system_path], on_line)
+    if returncode != 0:
+        log.error('Failed to add %s to the system profile.', system_path)
         return False
 
+    returncode = await stream_command([os.path.join(system_path, 'bin', 'switch-to-configuration'), 'switch'], on_line)
+    exporter.rebuild_seconds.observe(time.time() - started, phase="switch")
+    if returncode != 0:
+        exporter.rebuilds.inc(result="switch_failed")
+        log.error('Switch to %s failed.', system_path)
+        return False
+    exporter.rebuilds.inc(result="ok")
+    return True
+
+
+async def os_rebuild(state_directory, on_progress=None, progress_interval=5, timings=None, prefetcher=None):
+    # Builds and switches in one go. timings is an optional dict, filled with the duration of each phase.
+    # With a prefetcher, the store paths the build needs are downloaded in parallel first.
+    if prefetcher != None:
+        started = time.time()
+        await prefetcher.prefetch(state_directory, on_progress, progress_interval)
+        if timings != None:
+            timings["prefetchSeconds"] = time.time() - started
+    started = time.time()
+    system_path = await os_build(state_directory, on_progress, progress_interval)
+    if timings != None:
+        timings["buildSeconds"] = time.time() - started
+    if system_path == None:
+        return False
 
-def os_update(state_directory):
-    print('Running update')
+    started = time.time()
+    switched = await os_switch(system_path)
+    if timings != None:
+        timings["switchSeconds"] = time.time() - started
+    if switched:
+        log.info("Rebuilt succesfully.")
+    return switched
+
+
+async def os_update(state_directory, on_progress=None, timings=None, prefetcher=None):
+    log.info('Running update')
 
     # Run flake update.
-    if not flake_update(state_directory):
+    if not await flake_update(state_directory):
         return False
 
     # Just nixos rebuild.
-    return os_rebuild(state_directory)
+    return await os_rebuild(state_directory, on_progress, timings=timings, prefetcher=prefetcher)
 
 
 @contextmanager
@@ -419,71 +1056,90 @@ def backup_and_restore(file_path):
         backup_path = temp_file.name
         # Copy the original file to the temporary file
         shutil.copy(file_path, backup_path)
-        print(f"Backup of {file_path} created at: {backup_path}")
+        log.debug("Backup of %s created at: %s", file_path, backup_path)
     
     try:
         # Yield the path to the backup file (if needed within the context)
         yield backup_path
     finally:
         # After the context, restore the original file from the backup
-        print(f"Restoring {file_path} from backup...")
+        log.debug("Restoring %s from backup...", file_path)
         shutil.copy(backup_path, file_path)
-        print(f"{file_path} restored from backup.")
+        log.debug("%s restored from backup.", file_path)
         
         # Optionally delete the temporary backup file
         if os.path.exists(backup_path):
             os.remove(backup_path)
-            print(f"Temporary backup file {backup_path} deleted.")
-
+            log.debug("Temporary backup file %s deleted.", backup_path)
 
-def flake_update_check(state_directory) -> bool:
-    print('Updating flake inputs...')
 
-    # Remove the /root/.cache/nix directory
-    # Otherwise Nix will just cache the tar file and not redownload it!
+def locked_inputs(flake_lock_path):
+    # The locked revision of every flake input, e.g. {"nixpkgs": {"rev": ..., "narHash": ...}}.
     try:
-        print('Deleting Nix cache directory...')
-        shutil.rmtree("/root/.cache/nix")
-        print('Success! Or no exceptions at least.')
-    except Exception as e:
-        print('Failed to delete directory. Error: ')
-        print(e)
+        with open(flake_lock_path, "r") as f:
+            flake_lock = json.load(f)
+    except (OSError, ValueError) as e:
+        log.warning('Couldn\'t read %s: %s', flake_lock_path, e)
+        return None
+
+    inputs = {}
+    for name, node in flake_lock.get("nodes", {}).items():
+        if "locked" in node:
+            locked = node["locked"]
+            inputs[name] = {"rev": locked.get("rev"), "narHash": locked.get("narHash")}
+    return inputs
+
+
+async def flake_update_check(state_directory, report=None, prefetcher=None) -> bool:
+    # report is an optional dict of counters, updated with how many checks ran and how many could skip the build.
+    # The check builds the updated system, with a prefetcher its store paths are downloaded in parallel first.
+    # The build's result link in the state directory keeps them from gc, so the update itself hardly downloads anything.
+    log.info('Updating flake inputs...')
+    if report != None:
+        report["updateChecks"] = report.get("updateChecks", 0) + 1
 
     # Path to the existing flake.lock file
     flake_lock_path = state_directory + "/flake.lock"
+    inputs_before = locked_inputs(flake_lock_path)
 
     # Backup and restore the flake.lock
     with backup_and_restore(flake_lock_path) as old_flake_lock:
         # Update the flake.
-        if not flake_update(state_directory):
+        if not await flake_update(state_directory):
+            return False
+
+        # Fast path: if no input moved to a new revision the system closure can't have changed.
+        inputs_after = locked_inputs(flake_lock_path)
+        if inputs_before != None and inputs_before == inputs_after:
+            log.info('No flake input changed revision, skipping build.')
+            if report != None:
+                report["updateChecksSkippedBuild"] = report.get("updateChecksSkippedBuild", 0) + 1
             return False
+        log.info('Flake inputs changed: %s -> %s', inputs_before, inputs_after)
+
+        if prefetcher != None:
+            await prefetcher.prefetch(state_directory)
 
         # Run build.
-        print('Running build...')
-        result = subprocess.run(['/run/current-system/sw/bin/nixos-rebuild', '--flake', state_directory+"#xnode", 'build', '--impure'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if result.returncode != 0:
-            print('Error when running build command after flake update.')
-            print(result.stderr)
+        log.info('Running build...')
+        returncode, stdout, stderr = await run_command(['/run/current-system/sw/bin/nixos-rebuild', '--flake', state_directory+"#xnode", 'build', '--impure'], cwd=state_directory)
+        if returncode != 0:
+            log.error('Error when running build command after flake update: %s', stderr.decode('utf-8', errors='replace')[-4096:])
             return False
 
         # Diff the system closure to see if there's a new version.
-        print('Diffing build...')
-        result = subprocess.run(['/run/current-system/sw/bin/nix', 'store', 'diff-closures', './result', '/run/current-system'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        if result.returncode != 0:
-            print('Error when running diff command after build on update check.')
-            print(result.stderr)
-
-        if len(result.stdout) > 0:
-            print('Difference between new and current version, must be an update!')
-            print('Changes: ')
-            print(result.stdout)
-            print('Changes in hex: ')
-            print(result.stdout.hex())
+        log.info('Diffing build...')
+        returncode, stdout, stderr = await run_command(['/run/current-system/sw/bin/nix', 'store', 'diff-closures', './result', '/run/current-system'], cwd=state_directory)
+        if returncode != 0:
+            log.error('Error when running diff command after build on update check: %s', stderr.decode('utf-8', errors='replace')[-4096:])
+
+        if len(stdout) > 0:
+            log.info('Difference between new and current version, must be an update!')
+            log.debug('Changes:\n%s', stdout.decode('utf-8', errors='replace'))
 
             return True
         else:
-            print('No difference between \"updated\" and current version')
-            print(result.stdout)
+            log.info('No difference between \"updated\" and current version')
 
             # No diff, therefore there isn't an update available
             return False